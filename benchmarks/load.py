@@ -0,0 +1,494 @@
+# -*- coding=utf-8 -*-
+
+# End-to-end load on the whole bot, run in its own process against a local
+# stand-in for the Bot API. Updates are generated or replayed from a JSONL
+# file of Telegram updates, at a fixed rate; the fake API can add latency,
+# 429s with `retry_after` and 5xx errors to every call but `getMe` and
+# `getUpdates`. Reports command latency from injection to the first reply,
+# throughput, replies never delivered and broadcast completion times.
+#
+#   python -m benchmarks.load --rate 50 --count 2000 --engine thread
+#   python -m benchmarks.load --rate 50 --count 2000 --rate-429 0.05 --latency 0.05
+#   python -m benchmarks.load --updates recorded.jsonl --rate 20 --set pool.max-workers=8
+
+import configparser
+import email.parser
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+import click
+
+from ingressfsbot import passcode_resolve
+from ingressfsbot.passcode_handler import COMMAND_PASSCODE
+from ingressfsbot._config import (
+    CONF_PASSCODE_PROTAL_COUNT_DEFAULT,
+    CONF_POOL_ENGINE_THREAD,
+    CONF_POOL_ENGINE_ASYNCIO,
+)
+
+from .micro import population
+from .render import make_image
+
+
+TOKEN = "0:LOAD"
+BOT = {"id": 1, "is_bot": True, "username": "LoadBot", "first_name": "Load"}
+FAULTS_EXEMPT = ("getMe", "getUpdates")
+
+
+
+
+class FakeBotAPIHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+    def _reply(self, status, obj, content_type = "application/json"):
+        body = obj if isinstance(obj, bytes) else json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("content-type", content_type)
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def _fields(self):
+        body = self.rfile.read(int(self.headers.get("content-length", 0)))
+        content_type = self.headers.get("content-type", "")
+        if content_type.startswith("application/json"):
+            return json.loads(body) if body else {}
+        if content_type.startswith("multipart/form-data"):
+            message = email.parser.BytesParser().parsebytes(
+                f"content-type: {content_type}\r\n\r\n".encode("latin-1") + body
+            )
+            return {
+                part.get_param("name", header="content-disposition"): part.get_payload(decode=True).decode("utf-8")
+                for part in message.get_payload()
+                if part.get_filename() is None
+            }
+        return dict(parse_qsl(body.decode("utf-8")))
+
+
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        fields = self._fields()
+        status, obj = self.server.call(method, fields)
+        self._reply(status, obj)
+
+
+    def do_GET(self):
+        # The base image, by the URL given in `/passcode image` or as a
+        # file path under `url-file`.
+        self._reply(200, self.server.image, "image/png")
+
+
+
+
+class FakeBotAPI(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        image,
+        latency = 0,
+        jitter = 0,
+        rate_429 = 0,
+        retry_after = 1,
+        rate_5xx = 0,
+        seed = 1,
+    ) -> None:
+        super().__init__(("127.0.0.1", 0), FakeBotAPIHandler)
+        self.image = image
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.rate_5xx = rate_5xx
+        self.rng = random.Random(seed)
+        # Faults only start with the measured run, so setup always works.
+        self.inject = False
+        self.cond = threading.Condition()
+        self.updates = []
+        self.injected = {}
+        self.sent = []
+        self.faults = {"429": 0, "5xx": 0}
+        self.calls = {}
+        self.thread = threading.Thread(target=self.serve_forever, name="FakeBotAPI", daemon=True)
+
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+
+    def start(self):
+        self.thread.start()
+        return self
+
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+    def handle_error(self, request, client_address):
+        # The bot is killed mid-request at the end of every run.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+    def push(self, update):
+        # Renumbered, so replies can be matched to the update by the
+        # message id they reply to.
+        with self.cond:
+            update_id = len(self.updates) + 1
+            update = dict(update, update_id=update_id)
+            update["message"] = dict(update["message"], message_id=update_id)
+            self.updates.append(update)
+            self.injected[update_id] = time.perf_counter()
+            self.cond.notify_all()
+        return update_id
+
+
+    def _fault(self, method):
+        if not self.inject or method in FAULTS_EXEMPT:
+            return None
+        with self.cond:
+            roll = self.rng.random()
+            if roll < self.rate_429:
+                self.faults["429"] += 1
+                return 429, {
+                    "ok": False,
+                    "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }
+            if roll < self.rate_429 + self.rate_5xx:
+                self.faults["5xx"] += 1
+                return 502, {"ok": False, "error_code": 502, "description": "Bad Gateway"}
+        return None
+
+
+    def _get_updates(self, fields):
+        offset = int(fields.get("offset") or 0)
+        t_end = time.time() + float(fields.get("timeout") or 0)
+        with self.cond:
+            while True:
+                # Ids are 1-based list positions.
+                result = self.updates[max(offset - 1, 0):][:int(fields.get("limit") or 100)]
+                if result or time.time() >= t_end:
+                    return result
+                self.cond.wait(t_end - time.time())
+
+
+    def call(self, method, fields):
+        with self.cond:
+            self.calls[method] = self.calls.get(method, 0) + 1
+        if method == "getMe":
+            return 200, {"ok": True, "result": BOT}
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": self._get_updates(fields)}
+        if self.inject and (self.latency or self.jitter):
+            time.sleep(self.latency + self.rng.random() * self.jitter)
+        if (fault := self._fault(method)) is not None:
+            return fault
+        if method == "getFile":
+            return 200, {"ok": True, "result": {"file_id": fields.get("file_id"), "file_path": "photos/passcode.png"}}
+        reply_parameters = fields.get("reply_parameters") or {}
+        if isinstance(reply_parameters, str):
+            reply_parameters = json.loads(reply_parameters)
+        with self.cond:
+            self.sent.append((time.perf_counter(), method, str(fields.get("chat_id")), reply_parameters.get("message_id")))
+            message_id = len(self.sent)
+        result = {"message_id": message_id, "chat": {"id": fields.get("chat_id")}}
+        if method == "sendPhoto":
+            result["photo"] = [{"file_id": f"photo-{message_id}", "width": 90, "height": 90}]
+        return 200, {"ok": True, "result": result}
+
+
+
+
+def _message(uid, text):
+    return {"message": {
+        "chat": {"id": uid, "type": "private"},
+        "from": {"id": uid, "is_bot": False, "username": f"u{uid}", "first_name": f"U{uid}"},
+        "date": int(time.time()),
+        "text": text,
+    }}
+
+
+def generate(users, portals, noise, status_share, seed, interleave = False):
+    # Each user reports every portal in a row, as users do; `interleave`
+    # mixes all users' reports instead.
+    rng = random.Random(seed)
+    reports = list(population(users, portals, 1, noise, seed))
+    if interleave:
+        rng.shuffle(reports)
+    for uid, index, name, media, _ in itertools.cycle(reports):
+        if rng.random() < status_share:
+            yield _message(int(uid), "/passcode status")
+        else:
+            yield _message(int(uid), f"/passcode report {index} {name} {media}")
+
+
+def is_command(update):
+    # Only commands get a reply; anything else in a replay is just load.
+    text = update["message"]["text"]
+    return text.split(None, 1)[0].split("@", 1)[0] == COMMAND_PASSCODE
+
+
+def replay(updates_file):
+    with open(updates_file, "r") as fp:
+        for line in fp:
+            if line.strip():
+                update = json.loads(line)
+                if update.get("message", {}).get("text"):
+                    yield update
+
+
+def run_bot(config_file, engine, font, cwd):
+    # Started in a fresh process, so nothing in the harness is shared with
+    # the bot but the fake API.
+    os.chdir(cwd)
+    passcode_resolve.FONT_NAME = font
+    from ingressfsbot.__main__ import cli
+    cli.main(["-c", config_file, "--engine", engine], standalone_mode=False)
+
+
+def write_config(filename, api, tmpdir, admin_uid, broadcast_interval, overrides):
+    config = configparser.ConfigParser()
+    config.read_dict({
+        "telegram": {
+            "token": TOKEN,
+            "url-bot": f"{api.url}/bot",
+            "url-file": f"{api.url}/file/bot",
+            "poll-timeout": "5",
+        },
+        "passcode": {
+            "admin-uid": str(admin_uid),
+            "data-file": os.path.join(tmpdir, "passcode_data.json"),
+            "image-file": os.path.join(tmpdir, "passcode_image"),
+            "dump-interval": "1",
+            "broadcast-interval": str(broadcast_interval),
+        },
+        # Errors and retries are counted in the results; the log file is
+        # in the temporary directory.
+        "logging": {
+            "verbose-level": "50",
+        },
+    })
+    for override in overrides:
+        key, value = override.split("=", 1)
+        section, option = key.split(".", 1)
+        if not config.has_section(section):
+            config.add_section(section)
+        config.set(section, option, value)
+    with open(filename, "w") as fp:
+        config.write(fp)
+
+
+def wait_replies(api, update_ids, timeout):
+    t_end = time.perf_counter() + timeout
+    while time.perf_counter() < t_end:
+        with api.cond:
+            replied = {message_id for _, _, _, message_id in api.sent}
+        if update_ids <= replied:
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def wait_quiet(api, quiet, timeout):
+    # Done once nothing has been sent for `quiet` seconds.
+    t_end = time.perf_counter() + timeout
+    while time.perf_counter() < t_end:
+        with api.cond:
+            t_last = api.sent[-1][0] if api.sent else 0
+        if time.perf_counter() - t_last >= quiet:
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def _percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    pick = lambda q: values[min(int(len(values) * q), len(values) - 1)]
+    return {
+        "p50": statistics.median(values),
+        "p90": pick(0.90),
+        "p99": pick(0.99),
+        "max": values[-1],
+    }
+
+
+def summarize(api, update_ids, admin_uid, t_start, t_end):
+    with api.cond:
+        injected = dict(api.injected)
+        sent = list(api.sent)
+        faults = dict(api.faults)
+        calls = dict(api.calls)
+    updates = sum(1 for t in injected.values() if t >= t_start)
+    first_reply = {}
+    for t, _, _, message_id in sent:
+        if message_id in update_ids and message_id not in first_reply:
+            first_reply[message_id] = t
+    latencies = [first_reply[update_id] - injected[update_id] for update_id in first_reply]
+    t_last = max(first_reply.values(), default=t_end)
+
+    # Broadcast sends are the ones not replying to anything; each round
+    # starts with the text to the admin.
+    rounds = []
+    for t, method, chat_id, message_id in sent:
+        if message_id is not None or t < t_start:
+            continue
+        if method == "sendMessage" and chat_id == str(admin_uid):
+            rounds.append([t, t, 0])
+        if rounds:
+            rounds[-1][1] = t
+            rounds[-1][2] += 1
+
+    return {
+        "commands": len(update_ids),
+        "updates": updates,
+        "replied": len(first_reply),
+        "dropped": len(update_ids) - len(first_reply),
+        "offered_rate": updates / max(t_end - t_start, 1e-9),
+        "throughput": len(first_reply) / max(t_last - t_start, 1e-9),
+        "latency": _percentiles(latencies),
+        "faults": faults,
+        "calls": calls,
+        "broadcasts": {
+            "rounds": len(rounds),
+            "messages": sum(count for _, _, count in rounds),
+            "completion": _percentiles([t_last_send - t_first for t_first, t_last_send, _ in rounds]),
+        },
+    }
+
+
+def _ms(result, key):
+    return " ".join(f"{q} {value * 1000:.1f}ms" for q, value in result.get(key, {}).items())
+
+
+@click.command()
+@click.option("--engine",       type=click.Choice([CONF_POOL_ENGINE_THREAD, CONF_POOL_ENGINE_ASYNCIO]), default=CONF_POOL_ENGINE_THREAD)
+@click.option("--rate",         type=float, default=20,     help="Updates per second.")
+@click.option("--count",        type=int,   default=1000,   help="Updates to send.")
+@click.option("--updates",      "updates_file", type=click.Path(exists=True, dir_okay=False), help="Replay these JSONL updates instead.")
+@click.option("--users",        type=int,   default=100)
+@click.option("--portals",      type=int,   default=CONF_PASSCODE_PROTAL_COUNT_DEFAULT)
+@click.option("--noise",        type=float, default=0.2,    help="Share of generated reports that disagree.")
+@click.option("--status-share", type=float, default=0.1,    help="Share of generated updates that are `status`.")
+@click.option("--interleave",   is_flag=True,               help="Mix generated users instead of one user's reports in a row.")
+@click.option("--trusted",      type=int,   default=20,     help="Users the admin trusts, who get broadcasts.")
+@click.option("--broadcast-interval", type=int, default=2)
+@click.option("--latency",      type=float, default=0,      help="Seconds added to every API call.")
+@click.option("--jitter",       type=float, default=0,      help="Up to this many seconds more, at random.")
+@click.option("--rate-429",     type=float, default=0,      help="Share of calls answered 429.")
+@click.option("--retry-after",  type=int,   default=1)
+@click.option("--rate-5xx",     type=float, default=0,      help="Share of calls answered 502.")
+@click.option("--drain",        type=float, default=60,     help="Seconds to wait for replies after the last update.")
+@click.option("--seed",         type=int,   default=1)
+@click.option("--font",         default=passcode_resolve.FONT_NAME, help="TrueType font name or path.")
+@click.option("--set",          "overrides", multiple=True, help="Bot config as section.option=value.")
+@click.option("--output",       type=click.Path(dir_okay=False), help="Write JSON here instead of stdout.")
+def cli(
+    engine, rate, count, updates_file, users, portals, noise, status_share, interleave, trusted, broadcast_interval,
+    latency, jitter, rate_429, retry_after, rate_5xx, drain, seed, font, overrides, output,
+):
+    admin_uid = users + 1
+    api = FakeBotAPI(make_image(1440, 3200), latency, jitter, rate_429, retry_after, rate_5xx, seed).start()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config_file = os.path.join(tmpdir, "load.cfg")
+        write_config(config_file, api, tmpdir, admin_uid, broadcast_interval, overrides)
+        bot = multiprocessing.get_context("spawn").Process(
+            target=run_bot,
+            args=(config_file, engine, font, tmpdir),
+            name="Bot",
+        )
+        bot.start()
+        try:
+            # Setup, not measured: the image, the pattern, and trusted users
+            # who have to be known before the admin can trust them.
+            setup = [
+                _message(admin_uid, f"/passcode image {api.url}/passcode.png"),
+                _message(admin_uid, "/passcode patt " + ("@#$" * portals)[:portals]),
+            ]
+            setup += [_message(uid, "/passcode status") for uid in range(1, trusted + 1)]
+            setup_ids = {api.push(update) for update in setup}
+            if not wait_replies(api, setup_ids, 60):
+                raise click.ClickException("The bot did not answer the setup commands.")
+            setup_ids = {api.push(_message(admin_uid, f"/passcode trust u{uid}")) for uid in range(1, trusted + 1)}
+            if not wait_replies(api, setup_ids, 60):
+                raise click.ClickException("The bot did not answer the trust commands.")
+            wait_quiet(api, 0.5, 10)
+
+            stream = replay(updates_file) if updates_file else generate(users, portals, noise, status_share, seed, interleave)
+            click.echo(f"Sending {count} updates at {rate}/s to the {engine} engine.", err=True)
+            update_ids = set()
+            api.inject = True
+            t_start = time.perf_counter()
+            for i, update in enumerate(itertools.islice(stream, count)):
+                delay = t_start + i / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                update_id = api.push(update)
+                if is_command(update):
+                    update_ids.add(update_id)
+            t_end = time.perf_counter()
+            wait_replies(api, update_ids, drain)
+            wait_quiet(api, broadcast_interval * 2 + 1, drain)
+        finally:
+            bot.terminate()
+            bot.join()
+            api.close()
+
+    result = summarize(api, update_ids, admin_uid, t_start, t_end)
+    result["args"] = {
+        "engine": engine,
+        "rate": rate,
+        "count": count,
+        "updates": updates_file,
+        "users": users,
+        "interleave": interleave,
+        "trusted": trusted,
+        "latency": latency,
+        "jitter": jitter,
+        "rate_429": rate_429,
+        "rate_5xx": rate_5xx,
+        "set": list(overrides),
+    }
+    click.echo(
+        f"{result['replied']}/{result['commands']} replied, {result['dropped']} dropped, "
+        f"{result['throughput']:.1f}/s; latency {_ms(result, 'latency')}",
+        err=True,
+    )
+    click.echo(
+        f"{result['broadcasts']['rounds']} broadcasts, {result['broadcasts']['messages']} messages; "
+        f"completion {_ms(result['broadcasts'], 'completion')}",
+        err=True,
+    )
+    if output:
+        with open(output, "w") as fp:
+            json.dump(result, fp, indent=2)
+    else:
+        click.echo(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    cli()
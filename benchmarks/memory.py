@@ -0,0 +1,98 @@
+# -*- coding=utf-8 -*-
+
+# Memory held by report history, with the old dict-per-report layout kept
+# forever against compact records under each history policy.
+#
+#   python -m benchmarks.memory --users 10000 --portals 11 --reports 3
+
+import gc
+import json
+import random
+import tracemalloc
+
+import click
+
+from ingressfsbot import passcode_data
+from ingressfsbot.passcode_data import PasscodeData
+from ingressfsbot._config import (
+    CONF_PASSCODE_HISTORY_ALL,
+    CONF_PASSCODE_HISTORY_LATEST,
+    CONF_PASSCODE_HISTORY_LAST,
+)
+
+
+MEDIAS = ["a", "5", "xyz", "q", "w", "7", "k", "m", "p", "3", "t"]
+
+
+def reports(users, portals, count, seed):
+    # Every field is built per report, the way a parsed message yields
+    # fresh strings even when they repeat.
+    rng = random.Random(seed)
+    for r in range(count):
+        for uid in range(1, users + 1):
+            for index in range(1, portals + 1):
+                media = MEDIAS[index - 1] if rng.random() < 0.8 else rng.choice(MEDIAS)
+                yield str(uid), str(index), "".join(["N", str(index)]), "".join([media]), float(r)
+
+
+def build_legacy(users, portals, count, seed):
+    user_reports = {}
+    for uid, index, name, media, t in reports(users, portals, count, seed):
+        user_reports.setdefault(uid, {}).setdefault(index, []).append({
+            "time": t,
+            "name": name,
+            "media": media
+        })
+    return user_reports
+
+
+def build(users, portals, count, seed, history, limit):
+    data = PasscodeData()
+    data.set_history(history, limit)
+    for uid, index, name, media, t in reports(users, portals, count, seed):
+        data.add_report({"id": uid}, index, name, media, t)
+    return data
+
+
+def measure(fn, *args):
+    gc.collect()
+    tracemalloc.start()
+    obj = fn(*args)
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return obj, size
+
+
+@click.command()
+@click.option("--users",    type=int,   default=10000)
+@click.option("--portals",  type=int,   default=11)
+@click.option("--reports",  "count",    type=int,   default=3,  help="Reports per user and portal.")
+@click.option("--limit",    type=int,   default=2,  help="History limit for the `last` policy.")
+@click.option("--seed",     type=int,   default=1)
+def cli(users, portals, count, limit, seed):
+    total = users * portals * count
+    click.echo(f"{total} reports from {users} users on {portals} portals.")
+    click.echo(f"{'layout':<24}{'kept':>10}{'MiB':>10}{'B/report':>10}{'dump MiB':>10}")
+    runs = (
+        ("dict, all (before)", build_legacy, ()),
+        ("record, all", build, (CONF_PASSCODE_HISTORY_ALL, 1)),
+        (f"record, last {limit}", build, (CONF_PASSCODE_HISTORY_LAST, limit)),
+        ("record, latest", build, (CONF_PASSCODE_HISTORY_LATEST, 1)),
+    )
+    for label, fn, args in runs:
+        obj, size = measure(fn, users, portals, count, seed, *args)
+        # Record runs also hold PasscodeData's tallies, which the bare
+        # legacy layout does not; the dump covers the report history only.
+        user_reports = obj if isinstance(obj, dict) else passcode_data.to_dict(obj)["user_reports"]
+        kept = sum(len(history) for reports_uid in user_reports.values() for history in reports_uid.values())
+        dump = len(json.dumps(user_reports))
+        click.echo(
+            f"{label:<24}{kept:>10}{size / 2 ** 20:>10.1f}"
+            f"{size / total:>10.1f}{dump / 2 ** 20:>10.1f}"
+        )
+        del obj, user_reports
+
+
+if __name__ == "__main__":
+    cli()
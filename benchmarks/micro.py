@@ -0,0 +1,211 @@
+# -*- coding=utf-8 -*-
+
+# Microbenchmarks for the hot paths of PasscodeData and passcode_resolve on
+# a synthetic report population. Runs offline: the base image is served
+# from loopback. Results are JSON; with a baseline, any case slower than
+# the threshold fails the run.
+#
+#   python -m benchmarks.micro --output bench.json
+#   python -m benchmarks.micro --baseline bench.json --threshold 0.1
+
+import itertools
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import timeit
+
+import click
+
+from ingressfsbot import passcode_data
+from ingressfsbot import passcode_resolve
+from ingressfsbot.passcode_data import PasscodeData
+from ingressfsbot._config import (
+    CONF_PASSCODE_PROTAL_COUNT_DEFAULT,
+    CONF_PASSCODE_IMAGE_FORMAT_DEFAULT,
+    CONF_PASSCODE_HISTORY_LAST,
+)
+
+from .render import make_image
+from .render import serve_content
+
+
+MEDIAS = "abcdefghijklmnopqrstuvwxyz0123456789"
+
+
+def population(users, portals, depth, noise, seed):
+    # Every portal has one true name and media; a `noise` share of reports
+    # get a random media instead, and some of those a wrong name too.
+    rng = random.Random(seed)
+    truth = {str(index): (f"N{index}", rng.choice(MEDIAS)) for index in range(1, portals + 1)}
+    t = 0.0
+    for _ in range(depth):
+        for uid in range(1, users + 1):
+            for index, (name, media) in truth.items():
+                if rng.random() < noise:
+                    media = rng.choice(MEDIAS)
+                    if rng.random() < 0.5:
+                        name = f"N{rng.randint(1, portals)}"
+                t += 1
+                yield str(uid), index, name, media, t
+
+
+def build(users, portals, depth, noise, seed):
+    data = PasscodeData()
+    data.set_history(CONF_PASSCODE_HISTORY_LAST, depth)
+    for uid in range(1, users + 1):
+        data.add_user({"id": uid, "username": f"u{uid}", "first_name": f"U{uid}"})
+    for uid, index, name, media, t in population(users, portals, depth, noise, seed):
+        data.add_report({"id": uid}, index, name, media, t)
+    data.publish()
+    return data
+
+
+def cases(data, args, url, tmpdir):
+    # Each case is a name and a no-argument callable; state that a call
+    # changes is cycled so repeated calls keep doing the same work.
+    users, portals, noise = args["users"], args["portals"], args["noise"]
+    image_format = args["image_format"]
+    reports = data.get_trustable_reports()
+    patt = ("@#$" * portals)[:portals]
+    text = passcode_data.dumps(data)
+    data_file = os.path.join(tmpdir, "passcode_data.json")
+    passcode_data.dump(data_file, data)
+    image_file = os.path.join(tmpdir, f"passcode.{image_format}")
+
+    stream = itertools.cycle(list(population(users, portals, 1, noise, args["seed"] + 1)))
+    def add_report():
+        uid, index, name, media, t = next(stream)
+        data.add_report({"id": uid}, index, name, media, t)
+
+    user_ids = itertools.cycle([{"id": uid} for uid in range(1, users + 1)])
+    # More distinct report sets than the output cache holds, so every
+    # render misses it.
+    rng = random.Random(args["seed"])
+    renders = itertools.cycle([
+        [(str(index), f"N{index}", rng.choice(MEDIAS)) for index in range(1, portals + 1)]
+        for _ in range(passcode_resolve.OUTPUT_CACHE_SIZE + 1)
+    ])
+
+    return {
+        "add_report":               add_report,
+        "get_trustable_reports":    data.get_trustable_reports,
+        "get_trustable":            data.get_trustable,
+        "get_user_reports":         lambda: data.get_user_reports(next(user_ids)),
+        "dumps":                    lambda: passcode_data.dumps(data),
+        "loads":                    lambda: passcode_data.loads(text),
+        "dump":                     lambda: passcode_data.dump(data_file, data),
+        "load":                     lambda: passcode_data.load(data_file),
+        "generate_passcode_string": lambda: passcode_resolve.generate_passcode_string(patt, reports),
+        "generate_passcode_image":  lambda: passcode_resolve.generate_passcode_image(url, next(renders), image_file, image_format),
+        "generate_passcode_image_cached": lambda: passcode_resolve.generate_passcode_image(url, reports, image_file, image_format),
+    }
+
+
+def measure(fn, repeat, min_time):
+    timer = timeit.Timer(fn)
+    number, elapsed = timer.autorange()
+    number = max(1, int(number * min_time / max(elapsed, 1e-9)))
+    times = [t / number for t in timer.repeat(repeat, number)]
+    return {
+        "number": number,
+        "repeat": repeat,
+        "best": min(times),
+        "median": statistics.median(times),
+        "stdev": statistics.stdev(times) if repeat > 1 else 0.0,
+    }
+
+
+def compare(results, baseline, threshold):
+    # Best rounds, as slower ones mostly measure whatever else the machine
+    # was doing; the median is still reported for spotting noisy runs.
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get("results", {}).get(name)
+        if not base:
+            continue
+        result["baseline"] = base["best"]
+        result["ratio"] = result["best"] / base["best"]
+        if result["ratio"] > 1 + threshold:
+            regressions.append(name)
+    return regressions
+
+
+def _format(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f}{unit}"
+    return f"{seconds / 1e-9:.0f}ns"
+
+
+@click.command()
+@click.option("--users",        type=int,   default=1000)
+@click.option("--portals",      type=int,   default=CONF_PASSCODE_PROTAL_COUNT_DEFAULT, help="As `portal-count`.")
+@click.option("--depth",        type=int,   default=3,      help="Reports kept per user and portal.")
+@click.option("--noise",        type=float, default=0.2,    help="Share of reports that disagree.")
+@click.option("--seed",         type=int,   default=1)
+@click.option("--repeat",       type=int,   default=5)
+@click.option("--min-time",     type=float, default=0.2,    help="Seconds per round.")
+@click.option("--only",         multiple=True,              help="Run just these cases.")
+@click.option("--image",        type=click.Path(exists=True, dir_okay=False), help="Fixture base image, generated if unset.")
+@click.option("--size",         type=(int, int), default=(1440, 3200), help="Generated base image size.")
+@click.option("--format",       "image_format", default=CONF_PASSCODE_IMAGE_FORMAT_DEFAULT)
+@click.option("--font",         default=passcode_resolve.FONT_NAME, help="TrueType font name or path.")
+@click.option("--output",       type=click.Path(dir_okay=False), help="Write JSON here instead of stdout.")
+@click.option("--baseline",     type=click.File("r"),       help="Earlier JSON output to compare against.")
+@click.option("--threshold",    type=float, default=0.1,    help="Slowdown over the baseline that fails the run.")
+def cli(users, portals, depth, noise, seed, repeat, min_time, only, image, size, image_format, font, output, baseline, threshold):
+    passcode_resolve.FONT_NAME = font
+    args = {
+        "users": users,
+        "portals": portals,
+        "depth": depth,
+        "noise": noise,
+        "seed": seed,
+        "image_format": image_format,
+    }
+    if image:
+        with open(image, "rb") as fp:
+            content = fp.read()
+    else:
+        content = make_image(*size)
+    server, url = serve_content(content)
+    passcode_resolve.get_base_image(url)
+
+    data = build(users, portals, depth, noise, seed)
+    results = {}
+    click.echo(f"{'case':<32}{'best':>12}{'median':>12}", err=True)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, fn in cases(data, args, url, tmpdir).items():
+            if only and name not in only:
+                continue
+            results[name] = measure(fn, repeat, min_time)
+            click.echo(f"{name:<32}{_format(results[name]['best']):>12}{_format(results[name]['median']):>12}", err=True)
+    server.shutdown()
+
+    regressions = []
+    if baseline:
+        regressions = compare(results, json.load(baseline), threshold)
+        for name in regressions:
+            click.echo(f"Regression: {name} at {results[name]['ratio']:.2f}x the baseline.", err=True)
+
+    report = {
+        "args": args,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "results": results,
+        "regressions": regressions,
+    }
+    if output:
+        with open(output, "w") as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        click.echo(json.dumps(report, indent=2))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    cli()
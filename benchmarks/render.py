@@ -0,0 +1,140 @@
+# -*- coding=utf-8 -*-
+
+# Command latency while passcode images are rendered concurrently, with
+# rendering in the worker threads and offloaded to a process pool.
+#
+#   python -m benchmarks.render --renders 4 --processes 2
+
+import io
+import multiprocessing
+import random
+import statistics
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import click
+
+from PIL import Image
+
+from ingressfsbot import passcode_resolve
+from ingressfsbot.passcode_data import PasscodeData
+
+
+def make_image(width, height):
+    im_io = io.BytesIO()
+    Image.effect_noise((width, height), 64).convert("RGB").save(im_io, format="PNG")
+    return im_io.getvalue()
+
+
+def serve_image(width, height):
+    return serve_content(make_image(width, height))
+
+
+def serve_content(content):
+    # The bot only fetches the base image by URL, so fixtures are served
+    # from a loopback server.
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("content-type", "image/png")
+            self.send_header("content-length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/passcode.png"
+
+
+def command(data, uid):
+    # Roughly what a `/passcode report` costs on a worker thread.
+    data.add_report({"id": uid}, str(random.randint(1, 11)), "", random.choice("abcdef"))
+    data.publish()
+    return data.get_user_reports({"id": uid})
+
+
+def run(url, renders, processes, duration, interval, image_format):
+    pool = ThreadPoolExecutor(max_workers=32)
+    render_pool = None
+    if processes > 0:
+        render_pool = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("forkserver"),
+            initializer=passcode_resolve.warm_worker,
+            initargs=(passcode_resolve.FONT_NAME,),
+        )
+        # Start the workers before measuring.
+        list(render_pool.map(passcode_resolve.warm_worker, [passcode_resolve.FONT_NAME] * processes))
+
+    data = PasscodeData()
+    stop = threading.Event()
+    rendered = [0]
+
+    def render_loop():
+        while not stop.is_set():
+            # Random media so the output cache never hits.
+            reports = [(str(i), f"N{i}", random.choice("abcdefgh")) for i in range(1, 12)]
+            passcode_resolve.render_passcode_image(url, reports, image_format, executor=render_pool)
+            rendered[0] += 1
+
+    for _ in range(renders):
+        pool.submit(render_loop)
+
+    latencies = []
+    t_end = time.perf_counter() + duration
+    while time.perf_counter() < t_end:
+        t0 = time.perf_counter()
+        pool.submit(command, data, random.randint(1, 100)).result()
+        latencies.append(time.perf_counter() - t0)
+        time.sleep(interval)
+
+    stop.set()
+    pool.shutdown(wait=True)
+    if render_pool:
+        render_pool.shutdown(wait=True)
+
+    latencies.sort()
+    return {
+        "commands": len(latencies),
+        "p50": statistics.median(latencies),
+        "p95": latencies[int(len(latencies) * 0.95)],
+        "p99": latencies[int(len(latencies) * 0.99)],
+        "max": latencies[-1],
+        "renders/s": rendered[0] / duration,
+    }
+
+
+@click.command()
+@click.option("--renders",      type=int,   default=4,          help="Concurrent render loops.")
+@click.option("--processes",    type=int,   default=2,          help="Render processes for the offloaded run.")
+@click.option("--duration",     type=float, default=10,         help="Seconds per run.")
+@click.option("--interval",     type=float, default=0.01,       help="Seconds between commands.")
+@click.option("--size",         type=(int, int), default=(1440, 3200), help="Base image size.")
+@click.option("--format",       "image_format", default="jpeg")
+@click.option("--font",         default=passcode_resolve.FONT_NAME, help="TrueType font name or path.")
+def cli(renders, processes, duration, interval, size, image_format, font):
+    passcode_resolve.FONT_NAME = font
+    server, url = serve_image(*size)
+    passcode_resolve.get_base_image(url)
+    click.echo(f"{'mode':<16}{'commands':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'renders/s':>11}")
+    for mode, _processes in (("in-thread", 0), (f"processes={processes}", processes)):
+        result = run(url, renders, _processes, duration, interval, image_format)
+        click.echo(
+            f"{mode:<16}{result['commands']:>10}"
+            f"{result['p50'] * 1000:>10.2f}{result['p95'] * 1000:>10.2f}"
+            f"{result['p99'] * 1000:>10.2f}{result['max'] * 1000:>10.2f}"
+            f"{result['renders/s']:>11.2f}"
+        )
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    cli()
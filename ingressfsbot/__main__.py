@@ -11,13 +11,25 @@ from . import _config
 from . import __url__
 from . import __version__
 
-from .main_thread import main
+from . import main_async
+from . import main_cluster
+from . import main_thread
 from ._config import (
+    CONF_POOL,
+    CONF_POOL_ENGINE,
+    CONF_POOL_ENGINE_THREAD,
+    CONF_POOL_ENGINE_ASYNCIO,
     CONF_TELEGRAM,
     CONF_TELEGRAM_TOKEN,
     CONF_PASSCODE,
     CONF_PASSCODE_ADMIN_UID,
     CONF_PASSCODE_DATA_FILE,
+    CONF_CLUSTER,
+    CONF_CLUSTER_ROLE,
+    CONF_CLUSTER_ROLE_SINGLE,
+    CONF_CLUSTER_ROLE_INGESTOR,
+    CONF_CLUSTER_ROLE_WORKER,
+    CONF_CLUSTER_PARTITION,
     CONF_LOGGING,
     CONF_LOGGING_VERBOSE_LEVEL,
     CONF_LOGGING_FILE_LEVEL,
@@ -31,6 +43,9 @@ from ._config import (
 @click.option("--token", "-t",      type=click.STRING)
 @click.option("--admin", "-a",      type=click.STRING)
 @click.option("--datafile",         type=click.Path(dir_okay=False))
+@click.option("--engine",           type=click.Choice([CONF_POOL_ENGINE_THREAD, CONF_POOL_ENGINE_ASYNCIO]))
+@click.option("--role",             type=click.Choice([CONF_CLUSTER_ROLE_SINGLE, CONF_CLUSTER_ROLE_INGESTOR, CONF_CLUSTER_ROLE_WORKER]))
+@click.option("--partition",        type=click.INT)
 @click.option("--logfile",          type=click.Path(dir_okay=False))
 @click.option("--verbose", "-v",    type=click.INT, count=True)
 def cli(
@@ -38,6 +53,9 @@ def cli(
     token=None,
     admin=None,
     datafile=None,
+    engine=None,
+    role=None,
+    partition=None,
     logfile=None,
     verbose=0,
 ):
@@ -55,6 +73,12 @@ def cli(
         _config.set(CONF_PASSCODE, CONF_PASSCODE_ADMIN_UID, admin)
     if not datafile is None:
         _config.set(CONF_PASSCODE, CONF_PASSCODE_DATA_FILE, datafile)
+    if not engine is None:
+        _config.set(CONF_POOL, CONF_POOL_ENGINE, engine)
+    if not role is None:
+        _config.set(CONF_CLUSTER, CONF_CLUSTER_ROLE, role)
+    if not partition is None:
+        _config.set(CONF_CLUSTER, CONF_CLUSTER_PARTITION, str(partition))
     if not logfile is None:
         _config.set(CONF_LOGGING, CONF_LOGGING_FILE_PATH, logfile)
     
@@ -69,7 +93,15 @@ def cli(
         logging.getLogger("httpx").setLevel(httpx_log_level)
         logging.getLogger("httpcore").setLevel(httpx_log_level)
 
-    main()
+    # Ingestor and workers always run the thread engine.
+    if _config.get(CONF_CLUSTER, CONF_CLUSTER_ROLE) == CONF_CLUSTER_ROLE_INGESTOR:
+        main_cluster.main_ingestor()
+    elif _config.get(CONF_CLUSTER, CONF_CLUSTER_ROLE) == CONF_CLUSTER_ROLE_WORKER:
+        main_cluster.main_worker()
+    elif _config.get(CONF_POOL, CONF_POOL_ENGINE) == CONF_POOL_ENGINE_ASYNCIO:
+        main_async.main()
+    else:
+        main_thread.main()
 
 
 if __name__ == "__main__":
@@ -16,9 +16,18 @@ CONFIG_FILE = "./conf.d"
 CONF_POOL = "pool"
 CONF_POOL_MAX_WORKERS = "max-workers"
 CONF_POOL_THREAD_PREFIX = "thread-prefix"
+CONF_POOL_ENGINE = "engine"
+CONF_POOL_SEND_WORKERS = "send-workers"
+CONF_POOL_BACKGROUND_WORKERS = "background-workers"
 
 CONF_POOL_MAX_WORKERS_DEFAULT = 32
 CONF_POOL_THREAD_PREFIX_DEFAULT = "Worker #"
+CONF_POOL_ENGINE_DEFAULT = "thread"
+CONF_POOL_SEND_WORKERS_DEFAULT = 8
+CONF_POOL_BACKGROUND_WORKERS_DEFAULT = 4
+
+CONF_POOL_ENGINE_THREAD = "thread"
+CONF_POOL_ENGINE_ASYNCIO = "asyncio"
 
 CONF_TELEGRAM = "telegram"
 CONF_TELEGRAM_TOKEN = "token"
@@ -26,10 +35,137 @@ CONF_TELEGRAM_URL_BOT = "url-bot"
 CONF_TELEGRAM_URL_FILE = "url-file"
 CONF_TELEGRAM_USER_AGENT = "user-agent"
 CONF_TELEGRAM_TIMEOUT = "timeout"
+CONF_TELEGRAM_POLL_TIMEOUT = "poll-timeout"
+CONF_TELEGRAM_POLL_INTERVAL = "poll-interval"
+CONF_TELEGRAM_POLL_BACKOFF_MIN = "poll-backoff-min"
+CONF_TELEGRAM_POLL_BACKOFF_MAX = "poll-backoff-max"
+CONF_TELEGRAM_POOL_CONNECTIONS = "pool-connections"
+CONF_TELEGRAM_POOL_KEEPALIVE = "pool-keepalive"
+CONF_TELEGRAM_KEEPALIVE_EXPIRY = "keepalive-expiry"
+CONF_TELEGRAM_HTTP2 = "http2"
+CONF_TELEGRAM_INGESTION = "ingestion"
+CONF_TELEGRAM_RETRIES = "retries"
+CONF_TELEGRAM_RETRY_BACKOFF_MIN = "retry-backoff-min"
+CONF_TELEGRAM_RETRY_BACKOFF_MAX = "retry-backoff-max"
+CONF_TELEGRAM_BREAKER_THRESHOLD = "breaker-threshold"
+CONF_TELEGRAM_BREAKER_RESET = "breaker-reset"
 
 CONF_TELEGRAM_URL_BOT_DEFAULT = "https://api.telegram.org/bot"
 CONF_TELEGRAM_URL_FILE_DEFAULT = "https://api.telegram.org/file/bot"
 CONF_TELEGRAM_USER_AGENT_DEFAULT = f"IngressFSBot/{__version__}"
+CONF_TELEGRAM_POLL_TIMEOUT_DEFAULT = 30
+CONF_TELEGRAM_POLL_INTERVAL_DEFAULT = 0
+CONF_TELEGRAM_POLL_BACKOFF_MIN_DEFAULT = 1
+CONF_TELEGRAM_POLL_BACKOFF_MAX_DEFAULT = 60
+CONF_TELEGRAM_POOL_CONNECTIONS_DEFAULT = 64
+CONF_TELEGRAM_POOL_KEEPALIVE_DEFAULT = 32
+CONF_TELEGRAM_KEEPALIVE_EXPIRY_DEFAULT = 30
+CONF_TELEGRAM_HTTP2_DEFAULT = False
+CONF_TELEGRAM_INGESTION_DEFAULT = "polling"
+CONF_TELEGRAM_RETRIES_DEFAULT = 3
+CONF_TELEGRAM_RETRY_BACKOFF_MIN_DEFAULT = 0.5
+CONF_TELEGRAM_RETRY_BACKOFF_MAX_DEFAULT = 10
+CONF_TELEGRAM_BREAKER_THRESHOLD_DEFAULT = 5
+CONF_TELEGRAM_BREAKER_RESET_DEFAULT = 30
+
+CONF_TELEGRAM_INGESTION_POLLING = "polling"
+CONF_TELEGRAM_INGESTION_WEBHOOK = "webhook"
+
+CONF_WEBHOOK = "webhook"
+CONF_WEBHOOK_URL = "url"
+CONF_WEBHOOK_BIND = "bind"
+CONF_WEBHOOK_PORT = "port"
+CONF_WEBHOOK_PATH = "path"
+CONF_WEBHOOK_WORKERS = "workers"
+CONF_WEBHOOK_SECRET_TOKEN = "secret-token"
+CONF_WEBHOOK_MAX_BODY = "max-body"
+
+CONF_WEBHOOK_BIND_DEFAULT = "127.0.0.1"
+CONF_WEBHOOK_PORT_DEFAULT = 8443
+CONF_WEBHOOK_PATH_DEFAULT = "/"
+CONF_WEBHOOK_WORKERS_DEFAULT = 8
+CONF_WEBHOOK_SECRET_TOKEN_DEFAULT = ""
+# Updates are a few KiB; anything far past that is not from Telegram.
+CONF_WEBHOOK_MAX_BODY_DEFAULT = 1 << 20
+
+CONF_RENDER = "render"
+CONF_RENDER_PROCESSES = "processes"
+
+CONF_RENDER_PROCESSES_DEFAULT = 0
+
+CONF_DELIVERY = "delivery"
+CONF_DELIVERY_RATE = "rate"
+CONF_DELIVERY_CHAT_RATE = "chat-rate"
+CONF_DELIVERY_CHAT_BURST = "chat-burst"
+CONF_DELIVERY_GROUP_RATE = "group-rate"
+CONF_DELIVERY_MAX_RETRIES = "max-retries"
+
+CONF_DELIVERY_RATE_DEFAULT = 30
+CONF_DELIVERY_CHAT_RATE_DEFAULT = 1
+CONF_DELIVERY_CHAT_BURST_DEFAULT = 2
+CONF_DELIVERY_GROUP_RATE_DEFAULT = 1 / 3
+CONF_DELIVERY_MAX_RETRIES_DEFAULT = 5
+
+CONF_METRICS = "metrics"
+CONF_METRICS_BIND = "bind"
+CONF_METRICS_PORT = "port"
+
+CONF_METRICS_BIND_DEFAULT = "127.0.0.1"
+CONF_METRICS_PORT_DEFAULT = 0
+
+CONF_INGRESS = "ingress"
+CONF_INGRESS_CAPACITY = "capacity"
+CONF_INGRESS_POLICY = "policy"
+CONF_INGRESS_DEFER_TIMEOUT = "defer-timeout"
+CONF_INGRESS_USER_RATE = "user-rate"
+CONF_INGRESS_USER_BURST = "user-burst"
+CONF_INGRESS_ORDER_BY = "order-by"
+
+CONF_INGRESS_CAPACITY_DEFAULT = 1000
+CONF_INGRESS_POLICY_DEFAULT = "shed"
+CONF_INGRESS_DEFER_TIMEOUT_DEFAULT = 5
+CONF_INGRESS_USER_RATE_DEFAULT = 1
+# Twice the default portal count: reporting every portal in a row, then
+# correcting a few, is the usual way to use the bot.
+CONF_INGRESS_USER_BURST_DEFAULT = 22
+CONF_INGRESS_ORDER_BY_DEFAULT = "user"
+
+CONF_INGRESS_POLICY_SHED = "shed"
+CONF_INGRESS_POLICY_DEFER = "defer"
+CONF_INGRESS_ORDER_BY_USER = "user"
+CONF_INGRESS_ORDER_BY_CHAT = "chat"
+CONF_INGRESS_ORDER_BY_NONE = "none"
+
+CONF_LOCKTRACE = "locktrace"
+CONF_LOCKTRACE_ENABLED = "enabled"
+CONF_LOCKTRACE_SLOW_HOLD = "slow-hold"
+CONF_LOCKTRACE_SAMPLE_INTERVAL = "sample-interval"
+
+CONF_LOCKTRACE_ENABLED_DEFAULT = False
+CONF_LOCKTRACE_SLOW_HOLD_DEFAULT = 0.05
+CONF_LOCKTRACE_SAMPLE_INTERVAL_DEFAULT = 0.01
+
+CONF_CLUSTER = "cluster"
+CONF_CLUSTER_ROLE = "role"
+CONF_CLUSTER_PARTITION = "partition"
+CONF_CLUSTER_PARTITIONS = "partitions"
+CONF_CLUSTER_QUEUE_BACKEND = "queue-backend"
+CONF_CLUSTER_QUEUE_FILE = "queue-file"
+CONF_CLUSTER_POLL_INTERVAL = "poll-interval"
+CONF_CLUSTER_BATCH_SIZE = "batch-size"
+
+CONF_CLUSTER_ROLE_DEFAULT = "single"
+CONF_CLUSTER_PARTITION_DEFAULT = 0
+CONF_CLUSTER_PARTITIONS_DEFAULT = 2
+CONF_CLUSTER_QUEUE_BACKEND_DEFAULT = "sqlite"
+CONF_CLUSTER_QUEUE_FILE_DEFAULT = "passcode_updates.db"
+CONF_CLUSTER_POLL_INTERVAL_DEFAULT = 0.2
+CONF_CLUSTER_BATCH_SIZE_DEFAULT = 100
+
+CONF_CLUSTER_ROLE_SINGLE = "single"
+CONF_CLUSTER_ROLE_INGESTOR = "ingestor"
+CONF_CLUSTER_ROLE_WORKER = "worker"
+CONF_CLUSTER_QUEUE_BACKEND_SQLITE = "sqlite"
 
 CONF_PASSCODE = "passcode"
 CONF_PASSCODE_DATA_FILE = "data-file"
@@ -39,6 +175,17 @@ CONF_PASSCODE_ADMIN_UID = "admin-uid"
 CONF_PASSCODE_PROTAL_COUNT = "portal-count"
 CONF_PASSCODE_DUMP_INTERVAL = "dump-interval"
 CONF_PASSCODE_BROADCAST_INTERVAL = "broadcast-interval"
+CONF_PASSCODE_DUMP_MAX_WAIT = "dump-max-wait"
+CONF_PASSCODE_BROADCAST_MAX_WAIT = "broadcast-max-wait"
+CONF_PASSCODE_BACKEND = "backend"
+CONF_PASSCODE_JOURNAL_FILE = "journal-file"
+CONF_PASSCODE_JOURNAL_FSYNC = "journal-fsync"
+CONF_PASSCODE_SNAPSHOT_INTERVAL = "snapshot-interval"
+CONF_PASSCODE_SESSIONS_FILE = "sessions-file"
+CONF_PASSCODE_SESSION_IDLE = "session-idle"
+CONF_PASSCODE_HISTORY = "history"
+CONF_PASSCODE_HISTORY_LIMIT = "history-limit"
+CONF_PASSCODE_ARCHIVE_FILE = "archive-file"
 
 CONF_PASSCODE_DATA_FILE_DEFAULT = "passcode_data.json"
 CONF_PASSCODE_IMAGE_FILE_DEFAULT = "passcode_image"
@@ -47,6 +194,27 @@ CONF_PASSCODE_ADMIN_UID_DEFAULT = ""
 CONF_PASSCODE_PROTAL_COUNT_DEFAULT = 11
 CONF_PASSCODE_DUMP_INTERVAL_DEFAULT = 10
 CONF_PASSCODE_BROADCAST_INTERVAL_DEFAULT = 60
+CONF_PASSCODE_DUMP_MAX_WAIT_DEFAULT = 60
+# Like the old fixed interval, a broadcast goes out at most one interval
+# after the first change; every report until then goes into it.
+CONF_PASSCODE_BROADCAST_MAX_WAIT_DEFAULT = CONF_PASSCODE_BROADCAST_INTERVAL_DEFAULT
+CONF_PASSCODE_BACKEND_DEFAULT = "json"
+CONF_PASSCODE_JOURNAL_FSYNC_DEFAULT = False
+CONF_PASSCODE_SNAPSHOT_INTERVAL_DEFAULT = 600
+CONF_PASSCODE_SESSIONS_FILE_DEFAULT = "passcode_sessions.json"
+CONF_PASSCODE_SESSION_IDLE_DEFAULT = 3600
+CONF_PASSCODE_HISTORY_DEFAULT = "all"
+CONF_PASSCODE_HISTORY_LIMIT_DEFAULT = 1
+CONF_PASSCODE_ARCHIVE_FILE_DEFAULT = "passcode_archive.jsonl"
+
+CONF_PASSCODE_BACKEND_JSON = "json"
+CONF_PASSCODE_BACKEND_JOURNAL = "journal"
+CONF_PASSCODE_BACKEND_SQLITE = "sqlite"
+
+CONF_PASSCODE_HISTORY_ALL = "all"
+CONF_PASSCODE_HISTORY_LATEST = "latest"
+CONF_PASSCODE_HISTORY_LAST = "last"
+CONF_PASSCODE_HISTORY_ARCHIVE = "archive"
 
 CONF_LOGGING = "logging"
 CONF_LOGGING_VERBOSE_LEVEL = "verbose-level"
@@ -62,11 +230,72 @@ _config.read_dict({
     CONF_POOL: {
         CONF_POOL_MAX_WORKERS: CONF_POOL_MAX_WORKERS_DEFAULT,
         CONF_POOL_THREAD_PREFIX: CONF_POOL_THREAD_PREFIX_DEFAULT,
+        CONF_POOL_ENGINE: CONF_POOL_ENGINE_DEFAULT,
+        CONF_POOL_SEND_WORKERS: CONF_POOL_SEND_WORKERS_DEFAULT,
+        CONF_POOL_BACKGROUND_WORKERS: CONF_POOL_BACKGROUND_WORKERS_DEFAULT,
     },
     CONF_TELEGRAM: {
         CONF_TELEGRAM_URL_BOT: CONF_TELEGRAM_URL_BOT_DEFAULT,
         CONF_TELEGRAM_URL_FILE: CONF_TELEGRAM_URL_FILE_DEFAULT,
         CONF_TELEGRAM_USER_AGENT: CONF_TELEGRAM_USER_AGENT_DEFAULT,
+        CONF_TELEGRAM_POLL_TIMEOUT: CONF_TELEGRAM_POLL_TIMEOUT_DEFAULT,
+        CONF_TELEGRAM_POLL_INTERVAL: CONF_TELEGRAM_POLL_INTERVAL_DEFAULT,
+        CONF_TELEGRAM_POLL_BACKOFF_MIN: CONF_TELEGRAM_POLL_BACKOFF_MIN_DEFAULT,
+        CONF_TELEGRAM_POLL_BACKOFF_MAX: CONF_TELEGRAM_POLL_BACKOFF_MAX_DEFAULT,
+        CONF_TELEGRAM_POOL_CONNECTIONS: CONF_TELEGRAM_POOL_CONNECTIONS_DEFAULT,
+        CONF_TELEGRAM_POOL_KEEPALIVE: CONF_TELEGRAM_POOL_KEEPALIVE_DEFAULT,
+        CONF_TELEGRAM_KEEPALIVE_EXPIRY: CONF_TELEGRAM_KEEPALIVE_EXPIRY_DEFAULT,
+        CONF_TELEGRAM_HTTP2: CONF_TELEGRAM_HTTP2_DEFAULT,
+        CONF_TELEGRAM_INGESTION: CONF_TELEGRAM_INGESTION_DEFAULT,
+        CONF_TELEGRAM_RETRIES: CONF_TELEGRAM_RETRIES_DEFAULT,
+        CONF_TELEGRAM_RETRY_BACKOFF_MIN: CONF_TELEGRAM_RETRY_BACKOFF_MIN_DEFAULT,
+        CONF_TELEGRAM_RETRY_BACKOFF_MAX: CONF_TELEGRAM_RETRY_BACKOFF_MAX_DEFAULT,
+        CONF_TELEGRAM_BREAKER_THRESHOLD: CONF_TELEGRAM_BREAKER_THRESHOLD_DEFAULT,
+        CONF_TELEGRAM_BREAKER_RESET: CONF_TELEGRAM_BREAKER_RESET_DEFAULT,
+    },
+    CONF_WEBHOOK: {
+        CONF_WEBHOOK_BIND: CONF_WEBHOOK_BIND_DEFAULT,
+        CONF_WEBHOOK_PORT: CONF_WEBHOOK_PORT_DEFAULT,
+        CONF_WEBHOOK_PATH: CONF_WEBHOOK_PATH_DEFAULT,
+        CONF_WEBHOOK_WORKERS: CONF_WEBHOOK_WORKERS_DEFAULT,
+        CONF_WEBHOOK_SECRET_TOKEN: CONF_WEBHOOK_SECRET_TOKEN_DEFAULT,
+        CONF_WEBHOOK_MAX_BODY: CONF_WEBHOOK_MAX_BODY_DEFAULT,
+    },
+    CONF_RENDER: {
+        CONF_RENDER_PROCESSES: CONF_RENDER_PROCESSES_DEFAULT,
+    },
+    CONF_DELIVERY: {
+        CONF_DELIVERY_RATE: CONF_DELIVERY_RATE_DEFAULT,
+        CONF_DELIVERY_CHAT_RATE: CONF_DELIVERY_CHAT_RATE_DEFAULT,
+        CONF_DELIVERY_CHAT_BURST: CONF_DELIVERY_CHAT_BURST_DEFAULT,
+        CONF_DELIVERY_GROUP_RATE: CONF_DELIVERY_GROUP_RATE_DEFAULT,
+        CONF_DELIVERY_MAX_RETRIES: CONF_DELIVERY_MAX_RETRIES_DEFAULT,
+    },
+    CONF_METRICS: {
+        CONF_METRICS_BIND: CONF_METRICS_BIND_DEFAULT,
+        CONF_METRICS_PORT: CONF_METRICS_PORT_DEFAULT,
+    },
+    CONF_INGRESS: {
+        CONF_INGRESS_CAPACITY: CONF_INGRESS_CAPACITY_DEFAULT,
+        CONF_INGRESS_POLICY: CONF_INGRESS_POLICY_DEFAULT,
+        CONF_INGRESS_DEFER_TIMEOUT: CONF_INGRESS_DEFER_TIMEOUT_DEFAULT,
+        CONF_INGRESS_USER_RATE: CONF_INGRESS_USER_RATE_DEFAULT,
+        CONF_INGRESS_USER_BURST: CONF_INGRESS_USER_BURST_DEFAULT,
+        CONF_INGRESS_ORDER_BY: CONF_INGRESS_ORDER_BY_DEFAULT,
+    },
+    CONF_LOCKTRACE: {
+        CONF_LOCKTRACE_ENABLED: CONF_LOCKTRACE_ENABLED_DEFAULT,
+        CONF_LOCKTRACE_SLOW_HOLD: CONF_LOCKTRACE_SLOW_HOLD_DEFAULT,
+        CONF_LOCKTRACE_SAMPLE_INTERVAL: CONF_LOCKTRACE_SAMPLE_INTERVAL_DEFAULT,
+    },
+    CONF_CLUSTER: {
+        CONF_CLUSTER_ROLE: CONF_CLUSTER_ROLE_DEFAULT,
+        CONF_CLUSTER_PARTITION: CONF_CLUSTER_PARTITION_DEFAULT,
+        CONF_CLUSTER_PARTITIONS: CONF_CLUSTER_PARTITIONS_DEFAULT,
+        CONF_CLUSTER_QUEUE_BACKEND: CONF_CLUSTER_QUEUE_BACKEND_DEFAULT,
+        CONF_CLUSTER_QUEUE_FILE: CONF_CLUSTER_QUEUE_FILE_DEFAULT,
+        CONF_CLUSTER_POLL_INTERVAL: CONF_CLUSTER_POLL_INTERVAL_DEFAULT,
+        CONF_CLUSTER_BATCH_SIZE: CONF_CLUSTER_BATCH_SIZE_DEFAULT,
     },
     CONF_PASSCODE: {
         CONF_PASSCODE_DATA_FILE: CONF_PASSCODE_DATA_FILE_DEFAULT,
@@ -75,6 +304,16 @@ _config.read_dict({
         CONF_PASSCODE_PROTAL_COUNT: CONF_PASSCODE_PROTAL_COUNT_DEFAULT,
         CONF_PASSCODE_DUMP_INTERVAL: CONF_PASSCODE_DUMP_INTERVAL_DEFAULT,
         CONF_PASSCODE_BROADCAST_INTERVAL: CONF_PASSCODE_BROADCAST_INTERVAL_DEFAULT,
+        CONF_PASSCODE_DUMP_MAX_WAIT: CONF_PASSCODE_DUMP_MAX_WAIT_DEFAULT,
+        CONF_PASSCODE_BROADCAST_MAX_WAIT: CONF_PASSCODE_BROADCAST_MAX_WAIT_DEFAULT,
+        CONF_PASSCODE_BACKEND: CONF_PASSCODE_BACKEND_DEFAULT,
+        CONF_PASSCODE_JOURNAL_FSYNC: CONF_PASSCODE_JOURNAL_FSYNC_DEFAULT,
+        CONF_PASSCODE_SNAPSHOT_INTERVAL: CONF_PASSCODE_SNAPSHOT_INTERVAL_DEFAULT,
+        CONF_PASSCODE_SESSIONS_FILE: CONF_PASSCODE_SESSIONS_FILE_DEFAULT,
+        CONF_PASSCODE_SESSION_IDLE: CONF_PASSCODE_SESSION_IDLE_DEFAULT,
+        CONF_PASSCODE_HISTORY: CONF_PASSCODE_HISTORY_DEFAULT,
+        CONF_PASSCODE_HISTORY_LIMIT: CONF_PASSCODE_HISTORY_LIMIT_DEFAULT,
+        CONF_PASSCODE_ARCHIVE_FILE: CONF_PASSCODE_ARCHIVE_FILE_DEFAULT,
     },
     CONF_LOGGING: {
         CONF_LOGGING_VERBOSE_LEVEL: CONF_LOGGING_VERBOSE_LEVEL_DEFAULT,
@@ -0,0 +1,402 @@
+# -*- coding=utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+
+import asyncio
+import heapq
+import itertools
+import time
+
+from collections import deque
+from concurrent.futures import Executor
+from concurrent.futures import Future
+from dataclasses import dataclass
+from dataclasses import field
+from threading import Condition
+from threading import Lock
+from threading import Thread
+from typing import Any
+
+from . import metrics
+from .telegram import TelegramError
+
+from ._config import (
+    CONF_DELIVERY_RATE_DEFAULT,
+    CONF_DELIVERY_CHAT_RATE_DEFAULT,
+    CONF_DELIVERY_CHAT_BURST_DEFAULT,
+    CONF_DELIVERY_GROUP_RATE_DEFAULT,
+    CONF_DELIVERY_MAX_RETRIES_DEFAULT,
+)
+
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.time_last = time.monotonic()
+
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.time_last) * self.rate)
+        self.time_last = now
+
+
+    def wait(self, now):
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+
+
+@dataclass
+class DeliveryStatus:
+    name: str
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    retried: int = 0
+    sealed: bool = False
+    time_start: float = field(default_factory=time.time)
+    time_done: float | None = None
+
+
+    @property
+    def done(self):
+        return self.sealed and self.sent + self.failed == self.total
+
+
+    def __str__(self):
+        cost = (self.time_done or time.time()) - self.time_start
+        state = "done" if self.done else "pending"
+        return (
+            f"{self.name}: {state}, {self.sent}/{self.total} sent, "
+            f"{self.failed} failed, {self.retried} retried, {cost:.1f}s"
+        )
+
+
+
+
+@dataclass
+class DeliveryJob:
+    tg: Any
+    chat_id: int | str
+    method: str
+    obj: dict
+    files: dict | None
+    priority: int
+    seq: int
+    status: DeliveryStatus | None = None
+    attempts: int = 0
+    future: Future = field(default_factory=Future)
+
+
+
+
+class DeliveryChat:
+
+    def __init__(self, bucket) -> None:
+        self.bucket = bucket
+        self.jobs = deque()
+        self.busy = False
+        self.time_not_before = 0
+
+
+
+
+class DeliveryQueue:
+
+    # Pure bookkeeping, no I/O: drivers ask `next` for a job that may be
+    # sent right now and report back through `done`. Each chat has one job
+    # in flight at most, so sends to a chat keep their order.
+
+    def __init__(
+        self,
+        rate = CONF_DELIVERY_RATE_DEFAULT,
+        chat_rate = CONF_DELIVERY_CHAT_RATE_DEFAULT,
+        chat_burst = CONF_DELIVERY_CHAT_BURST_DEFAULT,
+        group_rate = CONF_DELIVERY_GROUP_RATE_DEFAULT,
+        max_retries = CONF_DELIVERY_MAX_RETRIES_DEFAULT,
+    ) -> None:
+        self.lock = Lock()
+        # No burst on the global bucket: Telegram counts messages per second,
+        # so a full bucket plus its refill would double that in the first one.
+        self.bucket = TokenBucket(rate, 1)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.counter = itertools.count()
+        self.chats: dict[Any, DeliveryChat] = {}
+        self.ready = []
+        self.delayed = []
+
+
+    def _chat(self, chat_id):
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            # Negative ids are groups and channels, which Telegram limits
+            # far more strictly than private chats.
+            if str(chat_id).startswith("-"):
+                bucket = TokenBucket(self.group_rate, 1)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            chat = self.chats[chat_id] = DeliveryChat(bucket)
+        return chat
+
+
+    def _wake(self, chat_id, chat, now):
+        if chat.busy or not chat.jobs:
+            return
+        job = chat.jobs[0]
+        if chat.time_not_before > now:
+            heapq.heappush(self.delayed, (chat.time_not_before, job.seq, chat_id))
+        else:
+            heapq.heappush(self.ready, (job.priority, job.seq, chat_id))
+
+
+    def put(self, tg, chat_id, method, obj, files = None, priority = PRIORITY_BULK, status = None):
+        with self.lock:
+            job = DeliveryJob(tg, chat_id, method, obj, files, priority, next(self.counter), status)
+            if status is not None:
+                status.total += 1
+            chat = self._chat(chat_id)
+            chat.jobs.append(job)
+            if len(chat.jobs) == 1:
+                self._wake(chat_id, chat, time.monotonic())
+            elif job.priority < chat.jobs[0].priority and not chat.busy:
+                # An interactive reply queued behind bulk traffic lifts the
+                # whole chat, it still keeps its place in the chat's order.
+                heapq.heappush(self.ready, (job.priority, job.seq, chat_id))
+            return job
+
+
+    def seal(self, status):
+        with self.lock:
+            status.sealed = True
+            self._finish_status(status)
+
+
+    def next(self):
+        # Returns `(job, None)`, or `(None, wait)` with the seconds until a
+        # job may become ready; `wait` is None when nothing is queued.
+        with self.lock:
+            now = time.monotonic()
+            while self.delayed and self.delayed[0][0] <= now:
+                _, _, chat_id = heapq.heappop(self.delayed)
+                chat = self.chats[chat_id]
+                if not chat.busy and chat.jobs:
+                    heapq.heappush(self.ready, (chat.jobs[0].priority, chat.jobs[0].seq, chat_id))
+            while self.ready:
+                wait = self.bucket.wait(now)
+                if wait:
+                    return None, wait
+                _, seq, chat_id = heapq.heappop(self.ready)
+                chat = self.chats[chat_id]
+                if chat.busy or not chat.jobs or chat.time_not_before > now:
+                    # Stale entry, the chat was woken up more than once.
+                    continue
+                wait = chat.bucket.wait(now)
+                if wait:
+                    chat.time_not_before = now + wait
+                    self._wake(chat_id, chat, now)
+                    continue
+                chat.bucket.take(now)
+                self.bucket.take(now)
+                chat.busy = True
+                return chat.jobs[0], None
+            if self.delayed:
+                return None, max(0, self.delayed[0][0] - now)
+            # Idle: forget chats whose bucket has refilled, a new bucket
+            # would start out full anyway.
+            for chat_id in [
+                chat_id for chat_id, chat in self.chats.items()
+                if not chat.busy and not chat.jobs
+                and chat.time_not_before <= now and chat.bucket.full(now)
+            ]:
+                del self.chats[chat_id]
+            return None, None
+
+
+    def done(self, job, result = None, error = None):
+        with self.lock:
+            now = time.monotonic()
+            chat = self.chats[job.chat_id]
+            chat.busy = False
+            retry_after = error.retry_after if isinstance(error, TelegramError) else None
+            if retry_after is not None and job.attempts < self.max_retries:
+                job.attempts += 1
+                metrics.DELIVERY_MESSAGES.inc("retried")
+                if job.status is not None:
+                    job.status.retried += 1
+                logger.warning(f"Rate limited sending to {job.chat_id}. Retrying in {retry_after}s.")
+                chat.time_not_before = max(chat.time_not_before, now + retry_after)
+                self._wake(job.chat_id, chat, now)
+                return False
+            chat.jobs.popleft()
+            self._wake(job.chat_id, chat, now)
+            if job.status is not None:
+                if error is None:
+                    job.status.sent += 1
+                else:
+                    job.status.failed += 1
+                self._finish_status(job.status)
+        metrics.DELIVERY_MESSAGES.inc("sent" if error is None else "failed")
+        if error is None:
+            job.future.set_result(result)
+        else:
+            logger.error(f"Failed sending {job.method} to {job.chat_id}.")
+            logger.debug(error)
+            job.future.set_exception(error)
+        return True
+
+
+    def depth(self):
+        with self.lock:
+            return sum(len(chat.jobs) for chat in self.chats.values())
+
+
+    def cancel(self):
+        # Drops everything not yet in flight, so nobody keeps waiting on a
+        # send that will never happen.
+        with self.lock:
+            jobs = []
+            for chat in self.chats.values():
+                while len(chat.jobs) > (1 if chat.busy else 0):
+                    jobs.append(chat.jobs.pop())
+            self.ready.clear()
+            self.delayed.clear()
+        for job in jobs:
+            job.future.cancel()
+        return len(jobs)
+
+
+    def _finish_status(self, status):
+        if status.done and status.time_done is None:
+            status.time_done = time.time()
+            logger.info(f"Delivered {status}.")
+
+
+
+
+class Delivery:
+
+    # Thread driver: one dispatcher thread paces the queue and sends on
+    # the pool.
+
+    def __init__(self, pool: Executor, **queue_args) -> None:
+        self.pool = pool
+        self.queue = DeliveryQueue(**queue_args)
+        self.cond = Condition()
+        self.closed = False
+        self.thread = Thread(target=self._run, name="Delivery", daemon=True)
+        self.thread.start()
+
+
+    def submit(self, tg, chat_id, method, obj, files = None, priority = PRIORITY_BULK, status = None):
+        job = self.queue.put(tg, chat_id, method, obj, files, priority, status)
+        with self.cond:
+            self.cond.notify()
+        return job.future
+
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if self.closed:
+                    return
+                job, wait = self.queue.next()
+                if job is None:
+                    self.cond.wait(wait)
+                    continue
+            self.pool.submit(self._send, job)
+
+
+    def _send(self, job):
+        try:
+            result = getattr(job.tg, job.method)(job.obj, files=job.files)
+        except Exception as e:
+            self.queue.done(job, error=e)
+        else:
+            self.queue.done(job, result=result)
+        with self.cond:
+            self.cond.notify()
+
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        if (count := self.queue.cancel()):
+            logger.warning(f"Dropped {count} undelivered messages.")
+
+
+
+
+class AsyncDelivery:
+
+    # Asyncio driver: the dispatcher is a task on `loop` and every send is
+    # a task of its own.
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, **queue_args) -> None:
+        self.loop = loop
+        self.queue = DeliveryQueue(**queue_args)
+        self.event = asyncio.Event()
+        self.tasks = set()
+        self.task = loop.create_task(self._run())
+
+
+    def submit(self, tg, chat_id, method, obj, files = None, priority = PRIORITY_BULK, status = None):
+        job = self.queue.put(tg, chat_id, method, obj, files, priority, status)
+        self.loop.call_soon_threadsafe(self.event.set)
+        return job.future
+
+
+    async def _run(self):
+        while True:
+            self.event.clear()
+            job, wait = self.queue.next()
+            if job is None:
+                try:
+                    await asyncio.wait_for(self.event.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            task = self.loop.create_task(self._send(job))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+
+    async def _send(self, job):
+        try:
+            result = await getattr(job.tg, job.method)(job.obj, files=job.files)
+        except Exception as e:
+            self.queue.done(job, error=e)
+        else:
+            self.queue.done(job, result=result)
+        self.event.set()
+
+
+    def close(self):
+        self.task.cancel()
+        if (count := self.queue.cancel()):
+            logger.warning(f"Dropped {count} undelivered messages.")
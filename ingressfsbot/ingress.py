@@ -0,0 +1,153 @@
+# -*- coding=utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+
+import time
+
+from dataclasses import dataclass
+from threading import Condition
+
+from . import metrics
+from .delivery import TokenBucket
+
+from ._config import (
+    CONF_INGRESS_CAPACITY_DEFAULT,
+    CONF_INGRESS_POLICY_DEFAULT,
+    CONF_INGRESS_DEFER_TIMEOUT_DEFAULT,
+    CONF_INGRESS_USER_RATE_DEFAULT,
+    CONF_INGRESS_USER_BURST_DEFAULT,
+    CONF_INGRESS_POLICY_DEFER,
+)
+
+
+BUCKETS_PRUNE_MIN = 1024
+
+
+@dataclass
+class IngressStats:
+    admitted: int = 0
+    throttled: int = 0
+    deferred: int = 0
+    shed: int = 0
+    depth: int = 0
+    depth_max: int = 0
+
+
+
+
+class IngressQueue:
+
+    # Admission in front of the handler pool. Each user first has to get a
+    # token from their own bucket, then the update has to fit in `capacity`
+    # updates queued or running. When it does not, it is shed right away,
+    # or with the `defer` policy the caller blocks up to `defer_timeout`
+    # for room, which holds back the poll loop or the webhook request.
+    # A user is told once per throttle window, which lasts until one of
+    # their updates is admitted again.
+
+    def __init__(
+        self,
+        capacity = CONF_INGRESS_CAPACITY_DEFAULT,
+        policy = CONF_INGRESS_POLICY_DEFAULT,
+        defer_timeout = CONF_INGRESS_DEFER_TIMEOUT_DEFAULT,
+        user_rate = CONF_INGRESS_USER_RATE_DEFAULT,
+        user_burst = CONF_INGRESS_USER_BURST_DEFAULT,
+        exempt = (),
+    ) -> None:
+        self.capacity = capacity
+        self.policy = policy
+        self.defer_timeout = defer_timeout
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.exempt = frozenset(str(key) for key in exempt if key)
+        self.cond = Condition()
+        self.buckets: dict[str, TokenBucket] = {}
+        self.buckets_prune = BUCKETS_PRUNE_MIN
+        self.throttled: set[str] = set()
+        self.stats = IngressStats()
+
+
+    def _wait(self, key, now):
+        # Seconds until the user gets a token, 0 when they have one now.
+        if self.user_rate <= 0 or key in self.exempt:
+            return 0
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.buckets_prune:
+                # Forget users whose bucket has refilled, a new bucket would
+                # start out full anyway.
+                for _key in [_key for _key, _bucket in self.buckets.items() if _bucket.full(now)]:
+                    del self.buckets[_key]
+                    self.throttled.discard(_key)
+                self.buckets_prune = max(BUCKETS_PRUNE_MIN, len(self.buckets) * 2)
+            bucket = self.buckets[key] = TokenBucket(self.user_rate, self.user_burst)
+        if (wait := bucket.wait(now)):
+            return wait
+        bucket.take(now)
+        return 0
+
+
+    def _count(self, result):
+        setattr(self.stats, result, getattr(self.stats, result) + 1)
+        metrics.INGRESS.inc(result)
+
+
+    def admit(self, key, submit, throttled = None):
+        # `submit` starts the work and returns its future; the slot is freed
+        # once that is done. `throttled` is called with the seconds to wait
+        # on the first throttled update of a window. Returns whether the
+        # update was admitted.
+        key = str(key)
+        notify = False
+        with self.cond:
+            wait = self._wait(key, time.monotonic())
+            if wait:
+                self._count("throttled")
+                logger.debug(f"Throttled an update from {key}.")
+                notify = key not in self.throttled
+                self.throttled.add(key)
+            else:
+                self.throttled.discard(key)
+                if self.stats.depth >= self.capacity:
+                    if self.policy == CONF_INGRESS_POLICY_DEFER:
+                        self._count("deferred")
+                        self.cond.wait_for(lambda: self.stats.depth < self.capacity, self.defer_timeout)
+                    if self.stats.depth >= self.capacity:
+                        self._count("shed")
+                        logger.warning(f"Ingress queue full at {self.capacity}. Shed an update from {key}.")
+                        return False
+                self._count("admitted")
+                self.stats.depth += 1
+                self.stats.depth_max = max(self.stats.depth_max, self.stats.depth)
+        if wait:
+            # Outside the lock, the reply goes through the delivery queue.
+            if notify and throttled is not None:
+                throttled(wait)
+            return False
+        try:
+            future = submit()
+        except Exception:
+            self._done(None)
+            raise
+        future.add_done_callback(self._done)
+        return True
+
+
+    def _done(self, future):
+        with self.cond:
+            self.stats.depth -= 1
+            self.cond.notify()
+
+
+    def get_stats(self):
+        with self.cond:
+            return IngressStats(**vars(self.stats))
+
+
+    def register_metrics(self, registry = metrics.REGISTRY):
+        registry.register(metrics.GaugeFunc(
+            "ingressfsbot_ingress_depth",
+            "Admitted updates queued or running.",
+            lambda: self.stats.depth,
+        ))
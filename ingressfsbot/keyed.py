@@ -0,0 +1,73 @@
+# -*- coding=utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+
+import heapq
+import itertools
+
+from concurrent.futures import Executor
+from concurrent.futures import Future
+from threading import Lock
+from typing import Any
+
+from . import metrics
+
+
+class KeyedExecutor:
+
+    # Jobs with the same key run one at a time, lowest `order` first (in
+    # submission order by default); different keys run in parallel on
+    # `executor`. `order` only sorts the jobs waiting at the time, a job
+    # submitted after a later one has started still runs after it. A key
+    # only exists while it has jobs, and each job goes back through the
+    # executor's queue, so a busy key cannot hold on to a worker while
+    # other keys wait.
+
+    def __init__(self, executor: Executor) -> None:
+        self.executor = executor
+        self.lock = Lock()
+        self.queues: dict[Any, list] = {}
+        self.counter = itertools.count()
+
+
+    def submit(self, key, fn, /, *args, order = None, **kwargs):
+        future = Future()
+        with self.lock:
+            seq = next(self.counter)
+            queue = self.queues.get(key)
+            idle = queue is None
+            if idle:
+                queue = self.queues[key] = []
+            heapq.heappush(queue, (seq if order is None else order, seq, future, fn, args, kwargs))
+        if idle:
+            self.executor.submit(self._run, key)
+        return future
+
+
+    def _run(self, key):
+        with self.lock:
+            _, _, future, fn, args, kwargs = heapq.heappop(self.queues[key])
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+        finally:
+            with self.lock:
+                more = bool(self.queues[key])
+                if not more:
+                    del self.queues[key]
+            if more:
+                self.executor.submit(self._run, key)
+
+
+    def register_metrics(self, registry = metrics.REGISTRY):
+        registry.register(metrics.GaugeFunc(
+            "ingressfsbot_keyed_keys",
+            "Keys with jobs waiting or running on the keyed executor.",
+            lambda: len(self.queues),
+        ))
@@ -0,0 +1,262 @@
+# -*- coding=utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+
+import sys
+import time
+import traceback
+import weakref
+
+from collections import deque
+from dataclasses import dataclass
+from dataclasses import field
+from threading import Condition
+from threading import Lock
+from threading import Thread
+from threading import get_ident
+
+from . import metrics
+
+from ._config import (
+    CONF_LOCKTRACE_SLOW_HOLD_DEFAULT,
+    CONF_LOCKTRACE_SAMPLE_INTERVAL_DEFAULT,
+)
+
+
+SLOW_HOLDS_KEPT = 100
+SAMPLES_PER_HOLD = 5
+
+LOCK_WAIT_SECONDS = metrics.REGISTRY.register(metrics.Histogram(
+    "ingressfsbot_lock_wait_seconds",
+    "Time spent waiting for a traced lock, while tracing is on.",
+    ("lock", "site"),
+))
+LOCK_HOLD_SECONDS = metrics.REGISTRY.register(metrics.Histogram(
+    "ingressfsbot_lock_hold_seconds",
+    "Time a traced lock was held, while tracing is on.",
+    ("lock", "site"),
+))
+
+
+@dataclass
+class SiteStats:
+    count: int = 0
+    time_wait: float = 0
+    time_hold: float = 0
+    time_hold_max: float = 0
+
+
+
+
+@dataclass
+class SlowHold:
+    lock: str
+    site: str
+    hold: float
+    time: float = field(default_factory=time.time)
+    stacks: list = field(default_factory=list)
+
+
+    def __str__(self):
+        when = time.strftime("%H:%M:%S", time.localtime(self.time))
+        return f"{when} {self.lock}/{self.site} held {self.hold * 1000:.1f}ms"
+
+
+
+
+class LockTracer:
+
+    # While enabled, every traced lock records wait and hold times per call
+    # site, and a sampler thread grabs the holder's stack whenever a lock
+    # has been held past `slow_hold`. Disabled, a traced lock costs one
+    # attribute check per acquisition.
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.slow_hold = CONF_LOCKTRACE_SLOW_HOLD_DEFAULT
+        self.sample_interval = CONF_LOCKTRACE_SAMPLE_INTERVAL_DEFAULT
+        self.locks = weakref.WeakSet()
+        self.stats_lock = Lock()
+        self.stats: dict[tuple, SiteStats] = {}
+        self.slow = deque(maxlen=SLOW_HOLDS_KEPT)
+        self.cond = Condition()
+        self.thread = None
+
+
+    def enable(self, slow_hold = None, sample_interval = None):
+        with self.cond:
+            if slow_hold is not None:
+                self.slow_hold = slow_hold
+            if sample_interval is not None:
+                self.sample_interval = sample_interval
+            self.enabled = True
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = Thread(target=self._sample, name="LockTracer", daemon=True)
+                self.thread.start()
+            self.cond.notify()
+        logger.info(f"Lock tracing on, slow holds from {self.slow_hold * 1000:.0f}ms.")
+
+
+    def disable(self):
+        with self.cond:
+            self.enabled = False
+            self.cond.notify()
+        logger.info("Lock tracing off.")
+
+
+    def reset(self):
+        with self.stats_lock:
+            self.stats.clear()
+            self.slow.clear()
+
+
+    def _sample(self):
+        while True:
+            with self.cond:
+                if not self.enabled:
+                    return
+                self.cond.wait(self.sample_interval)
+            frames = sys._current_frames()
+            now = time.perf_counter()
+            for lock in list(self.locks):
+                time_acquired, holder = lock.time_acquired, lock.holder
+                if time_acquired is None or now - time_acquired < self.slow_hold:
+                    continue
+                frame = frames.get(holder)
+                if frame is None:
+                    continue
+                stack = "".join(traceback.format_stack(frame))
+                # Only keep it if the same hold is still going on.
+                if lock.time_acquired == time_acquired and len(lock.samples) < SAMPLES_PER_HOLD:
+                    lock.samples.append(stack)
+
+
+    def record(self, lock, site, wait, hold, samples):
+        LOCK_WAIT_SECONDS.observe(wait, lock.name, site)
+        LOCK_HOLD_SECONDS.observe(hold, lock.name, site)
+        with self.stats_lock:
+            stats = self.stats.get((lock.name, site))
+            if stats is None:
+                stats = self.stats[(lock.name, site)] = SiteStats()
+            stats.count += 1
+            stats.time_wait += wait
+            stats.time_hold += hold
+            stats.time_hold_max = max(stats.time_hold_max, hold)
+            if hold < self.slow_hold:
+                return
+            slow = SlowHold(lock.name, site, hold, stacks=samples)
+            self.slow.append(slow)
+        logger.warning(f"Slow lock hold: {slow}.")
+        for stack in samples[:1]:
+            logger.debug(stack)
+
+
+    def summary(self, limit = 10):
+        with self.stats_lock:
+            stats = sorted(self.stats.items(), key=lambda item: item[1].time_hold, reverse=True)[:limit]
+            slow = list(self.slow)[-limit:]
+        lines = [f"Lock tracing {'on' if self.enabled else 'off'}, slow from {self.slow_hold * 1000:.0f}ms."]
+        for (name, site), _stats in stats:
+            lines.append(
+                f"{name}/{site}: {_stats.count}x, "
+                f"wait {_stats.time_wait / _stats.count * 1000:.2f}ms, "
+                f"hold {_stats.time_hold / _stats.count * 1000:.2f}ms "
+                f"(max {_stats.time_hold_max * 1000:.1f}ms)"
+            )
+        for _slow in slow:
+            lines.append(str(_slow))
+            if _slow.stacks:
+                # The innermost frame is where the holder was stuck.
+                lines.append("  " + _slow.stacks[0].rstrip().splitlines()[-2].strip())
+        return "\n".join(lines)
+
+
+TRACER = LockTracer()
+
+
+
+
+class _Site:
+
+    __slots__ = ("lock", "site")
+
+    def __init__(self, lock, site) -> None:
+        self.lock = lock
+        self.site = site
+
+
+    def __enter__(self):
+        self.lock.acquire(site=self.site)
+        return self.lock
+
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+
+
+
+class TracedLock:
+
+    # A drop-in `threading.Lock`; `with lock.site("dump"):` labels the
+    # acquisition for tracing, a bare `with lock:` counts as "unknown".
+
+    def __init__(self, name, tracer = TRACER) -> None:
+        self.name = name
+        self.tracer = tracer
+        self.lock = Lock()
+        self.time_acquired = None
+        self.holder = None
+        self.site_current = None
+        self.wait = 0
+        self.samples = []
+        tracer.locks.add(self)
+
+
+    def acquire(self, blocking = True, timeout = -1, site = "unknown"):
+        if not self.tracer.enabled:
+            return self.lock.acquire(blocking, timeout)
+        t0 = time.perf_counter()
+        if not self.lock.acquire(blocking, timeout):
+            return False
+        self.holder = get_ident()
+        self.site_current = site
+        self.samples = []
+        self.time_acquired = time.perf_counter()
+        self.wait = self.time_acquired - t0
+        return True
+
+
+    def release(self):
+        time_acquired = self.time_acquired
+        if time_acquired is None:
+            self.lock.release()
+            return
+        hold = time.perf_counter() - time_acquired
+        site, wait, samples = self.site_current, self.wait, self.samples
+        self.time_acquired = None
+        self.lock.release()
+        self.tracer.record(self, site, wait, hold, samples)
+
+
+    def locked(self):
+        return self.lock.locked()
+
+
+    def site(self, site):
+        # Off, callers get the bare lock and pay nothing for tracing. A
+        # release after tracing was turned on in between is still fine, as
+        # only acquisitions made while on are timed.
+        if not self.tracer.enabled:
+            return self.lock
+        return _Site(self, site)
+
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.release()
@@ -0,0 +1,159 @@
+# -*- coding=utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+
+import asyncio
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+
+from . import _config
+from .telegram import AsyncTelegram
+from .passcode_handler import PasscodeHandler
+from .passcode_handler import COMMAND_PASSCODE
+from .keyed import KeyedExecutor
+from .metrics import route_hook
+from .router import Router
+from .webhook import WebhookServer
+from ._config import (
+    CONF_INGRESS,
+    CONF_INGRESS_ORDER_BY,
+    CONF_INGRESS_POLICY_DEFER,
+    CONF_INGRESS_POLICY_SHED,
+)
+from .main_thread import (
+    get_pool_args,
+    get_telegram_args,
+    get_passcode_args,
+    get_poll_args,
+    get_set_webhook_args,
+    get_webhook_args,
+    get_ingress,
+    make_dispatch,
+    is_webhook,
+    start_metrics,
+    start_locktrace,
+)
+
+
+async def serve_webhook(server):
+    # The webhook server is thread based and submits updates from its own
+    # workers. `serve_forever` gets a thread of its own instead of a pool
+    # worker, and the server is shut down once this is cancelled.
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+
+
+    def serve():
+        try:
+            server.serve_forever()
+        finally:
+            loop.call_soon_threadsafe(stopped.set)
+
+
+    thread = Thread(target=serve, name="Webhook", daemon=True)
+    thread.start()
+    logger.info(f"Serving webhook on {server.server_address}.")
+    try:
+        await stopped.wait()
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+
+async def _main():
+
+    # The pool is only used for work that would block the event loop, such
+    # as handling commands, dumping data and rendering the passcode image.
+    # Commands go through the keyed executor, just as in the thread engine,
+    # so one user's updates never run at the same time.
+    pool = ThreadPoolExecutor(**get_pool_args())
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(pool)
+
+    async with AsyncTelegram(**get_telegram_args()) as tg:
+        passcode_args = get_passcode_args()
+        passcode_handler = PasscodeHandler(
+            pool=pool,
+            broadcaster=tg,
+            loop=loop,
+            **passcode_args,
+        )
+        ingress = get_ingress(passcode_args)
+        if ingress.policy == CONF_INGRESS_POLICY_DEFER:
+            # Waiting for room would block the event loop; the checks that
+            # shed updates never do.
+            logger.warning(f"Ingress policy {CONF_INGRESS_POLICY_DEFER} blocks the event loop. Shedding instead.")
+            ingress.policy = CONF_INGRESS_POLICY_SHED
+        keyed = KeyedExecutor(pool)
+        order_by = _config.get(CONF_INGRESS, CONF_INGRESS_ORDER_BY)
+        router = Router()
+        router.register(COMMAND_PASSCODE, passcode_handler.handle, passcode_handler.commands)
+        router.add_hook(route_hook)
+        passcode_handler.register_metrics()
+        ingress.register_metrics()
+        keyed.register_metrics()
+        metrics_server = start_metrics()
+        start_locktrace()
+        # Never blocks, so it is called from the event loop and from webhook
+        # workers alike.
+        dispatch = make_dispatch(router, tg, pool, keyed, ingress, order_by, passcode_handler.reply_throttled)
+
+
+        try:
+            me = await tg.getMe()
+            logger.info(f"Bot id={me['id']}")
+            logger.info(f"Bot username={me['username']}")
+            logger.info(f"Bot first_name={me['first_name']}")
+            logger.debug(me)
+
+
+            if is_webhook():
+                if (set_webhook_args := get_set_webhook_args()):
+                    await tg.setWebhook(set_webhook_args)
+                await serve_webhook(WebhookServer(dispatch, **get_webhook_args()))
+                return
+
+            poll_args = get_poll_args(tg.timeout)
+            poll_obj = poll_args["obj"]
+            backoff = 0
+            loop_acc_count = 0
+            while True:
+                loop_acc_count += 1
+                loop_t0 = time.time()
+                try:
+                    updates = await tg.getUpdates(poll_obj, timeout=poll_args["timeout"])
+                except Exception as e:
+                    backoff = min(max(backoff * 2, poll_args["backoff_min"]), poll_args["backoff_max"])
+                    logger.error(f"Failed updating. Retrying in {backoff}s.")
+                    logger.debug(e, stack_info=True)
+                    await asyncio.sleep(backoff)
+                    continue
+                backoff = 0
+                try:
+                    logger.debug(updates)
+                    if updates:
+                        for update in updates:
+                            poll_obj["offset"] = max(poll_obj["offset"], update["update_id"] + 1)
+                            dispatch(update)
+                except Exception as e:
+                    logger.error("Failed processing update.")
+                    logger.debug(e, stack_info=True)
+
+                logger.debug(f"Task Count: {pool._work_queue.qsize()}.")
+                logger.debug(f"Loop Count: {loop_acc_count}.")
+                logger.debug(f"Loop Cost: {time.time() - loop_t0}s.")
+                if not updates and (t := loop_t0 + poll_args["interval"] - time.time()) > 0:
+                    await asyncio.sleep(t)
+        finally:
+            if metrics_server:
+                metrics_server.close()
+            passcode_handler.close()
+
+
+def main():
+    asyncio.run(_main())
+
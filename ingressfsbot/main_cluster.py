@@ -0,0 +1,181 @@
+# -*- coding=utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+
+import sqlite3
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import _config
+from .telegram import Telegram
+from .passcode_handler import PasscodeHandler
+from .passcode_handler import COMMAND_PASSCODE
+from .passcode_session import SessionBindings
+from . import metrics
+from .metrics import route_hook
+from .router import Router
+from .update_queue import open_update_queue
+from .update_queue import partition_of
+from .main_thread import (
+    get_pool_args,
+    get_telegram_args,
+    get_passcode_args,
+    get_queue_args,
+    get_set_webhook_args,
+    is_webhook,
+    poll,
+    serve_webhook,
+    start_metrics,
+    start_locktrace,
+)
+from ._config import (
+    CONF_DELIVERY_RATE_DEFAULT,
+    CONF_PASSCODE,
+    CONF_PASSCODE_SESSIONS_FILE,
+    CONF_PASSCODE_BACKEND,
+    CONF_PASSCODE_BACKEND_SQLITE,
+    CONF_CLUSTER,
+    CONF_CLUSTER_PARTITION,
+    CONF_CLUSTER_POLL_INTERVAL,
+    CONF_CLUSTER_BATCH_SIZE,
+)
+
+
+# Split deployment: one ingestor owns `getUpdates` (or the webhook) and
+# appends every update to the update queue; workers, one per partition,
+# handle the updates that hash to their partition.
+#
+# With the json and journal backends each worker holds its sessions in
+# memory, so updates are partitioned by session and all the traffic of one
+# session, the default one included, goes to a single worker. The sqlite
+# backend is shared: every worker sees the others' writes, so updates are
+# partitioned by user and one session scales out over all workers. Each
+# session is still broadcast only by the worker its name hashes to.
+
+
+def is_shared_backend():
+    return _config.get(CONF_PASSCODE, CONF_PASSCODE_BACKEND) == CONF_PASSCODE_BACKEND_SQLITE
+
+
+def register_queue_metrics(update_queue, registry = metrics.REGISTRY):
+    registry.register(metrics.GaugeFunc(
+        "ingressfsbot_update_queue_depth",
+        "Updates queued and not yet committed, per partition.",
+        lambda: {(partition,): count for partition, count in update_queue.lag().items()},
+        ("partition",),
+    ))
+
+
+def main_ingestor():
+
+    tg = Telegram(**get_telegram_args())
+    update_queue = open_update_queue(**get_queue_args())
+    bindings = SessionBindings(_config.get(CONF_PASSCODE, CONF_PASSCODE_SESSIONS_FILE))
+    # Only used to filter, so nothing but commands reaches the queue.
+    router = Router()
+    router.register(COMMAND_PASSCODE, None)
+    register_queue_metrics(update_queue)
+    metrics_server = start_metrics()
+
+    me = tg.getMe()
+    logger.info(f"Bot id={me['id']}")
+    logger.info(f"Bot username={me['username']}")
+    shared = is_shared_backend()
+    logger.info(f"Ingesting into {update_queue.queue_file} with {update_queue.partitions} partitions.")
+    if not shared and update_queue.partitions > 1:
+        logger.warning("Partitioned by session, each session runs on one worker. Use the sqlite backend to spread one session over all of them.")
+
+
+    def dispatch(update):
+        if router.route(update) is None:
+            return
+        message = update["message"]
+        session_name = bindings.get(message["chat"]["id"])
+        key = str(message["from"]["id"]) if shared else None
+        # Keep trying rather than drop the update, both `poll` and the
+        # webhook only acknowledge it once this returns.
+        while True:
+            try:
+                update_queue.put(update, session_name, key)
+                return
+            except sqlite3.Error as e:
+                logger.error(f"Failed queueing update {update['update_id']}. Retrying.")
+                logger.debug(e)
+                time.sleep(1)
+
+
+    try:
+        if is_webhook():
+            if (set_webhook_args := get_set_webhook_args()):
+                tg.setWebhook(set_webhook_args)
+            serve_webhook(dispatch)
+        else:
+            poll(tg, dispatch, offset=update_queue.get_offset())
+    finally:
+        if metrics_server:
+            metrics_server.close()
+        update_queue.close()
+        tg.close()
+
+
+def main_worker():
+
+    queue_args = get_queue_args()
+    partitions = queue_args["partitions"]
+    partition = _config.getint(CONF_CLUSTER, CONF_CLUSTER_PARTITION)
+    if not 0 <= partition < partitions:
+        raise ValueError(f"Partition {partition} out of range for {partitions} partitions.")
+    poll_interval = _config.getfloat(CONF_CLUSTER, CONF_CLUSTER_POLL_INTERVAL)
+    batch_size = _config.getint(CONF_CLUSTER, CONF_CLUSTER_BATCH_SIZE)
+
+    pool = ThreadPoolExecutor(**get_pool_args())
+    tg = Telegram(**get_telegram_args())
+    passcode_args = get_passcode_args()
+    # Every worker paces its own sends, so they share the bot's global limit.
+    delivery_args = passcode_args["delivery_args"]
+    delivery_args["rate"] = delivery_args.get("rate", CONF_DELIVERY_RATE_DEFAULT) / partitions
+    shared = is_shared_backend()
+    passcode_handler = PasscodeHandler(
+        pool=pool,
+        broadcaster=tg,
+        broadcast_owner=(lambda name: partition_of(name, partitions) == partition) if shared else None,
+        **passcode_args,
+    )
+    router = Router()
+    router.register(COMMAND_PASSCODE, passcode_handler.handle, passcode_handler.commands)
+    update_queue = open_update_queue(**queue_args)
+    router.add_hook(route_hook)
+    passcode_handler.register_metrics()
+    register_queue_metrics(update_queue)
+    # The ingestor serves on the configured port, workers right after it.
+    metrics_server = start_metrics(1 + partition)
+    start_locktrace()
+    logger.info(f"Working on partition {partition} of {update_queue.queue_file}.")
+
+
+    try:
+        while True:
+            if shared:
+                passcode_handler.poll_broadcasts(passcode_handler.session_bindings.names())
+            rows = update_queue.fetch(partition, batch_size)
+            if not rows:
+                time.sleep(poll_interval)
+                continue
+            # Handled one by one on this thread to keep each partition in
+            # order; the offset only moves once the whole batch is done.
+            for seq, session_name, update in rows:
+                if (route := router.route(update)) is not None:
+                    router.call(route, tg, update, session_name=session_name)
+            # The debounced dump may still be pending, so what the batch
+            # changed is written out before the batch is dropped; a crash
+            # before this line gets the batch handled again.
+            passcode_handler.flush_sessions({session_name for _, session_name, _ in rows})
+            update_queue.commit(partition, rows[-1][0])
+    finally:
+        if metrics_server:
+            metrics_server.close()
+        passcode_handler.close()
+        update_queue.close()
+        tg.close()
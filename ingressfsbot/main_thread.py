@@ -6,21 +6,65 @@ logger = logging.getLogger(__name__)
 import time
 
 from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from httpx._config import Limits
 from httpx._config import Timeout
 
 from . import _config
+from . import passcode_data
 from .telegram import Telegram
 from .passcode_handler import PasscodeHandler
+from .passcode_handler import COMMAND_PASSCODE
+from .ingress import IngressQueue
+from .keyed import KeyedExecutor
+from .metrics import MetricsServer
+from .metrics import route_hook
+from .locktrace import TRACER
+from .router import Router
+from .webhook import WebhookServer
 from ._config import (
     CONF_POOL,
     CONF_POOL_MAX_WORKERS,
     CONF_POOL_THREAD_PREFIX,
+    CONF_POOL_SEND_WORKERS,
+    CONF_POOL_BACKGROUND_WORKERS,
     CONF_TELEGRAM,
     CONF_TELEGRAM_TOKEN,
     CONF_TELEGRAM_URL_BOT,
     CONF_TELEGRAM_URL_FILE,
     CONF_TELEGRAM_USER_AGENT,
     CONF_TELEGRAM_TIMEOUT,
+    CONF_TELEGRAM_POLL_TIMEOUT,
+    CONF_TELEGRAM_POLL_INTERVAL,
+    CONF_TELEGRAM_POLL_BACKOFF_MIN,
+    CONF_TELEGRAM_POLL_BACKOFF_MAX,
+    CONF_TELEGRAM_POOL_CONNECTIONS,
+    CONF_TELEGRAM_POOL_KEEPALIVE,
+    CONF_TELEGRAM_KEEPALIVE_EXPIRY,
+    CONF_TELEGRAM_HTTP2,
+    CONF_TELEGRAM_INGESTION,
+    CONF_TELEGRAM_RETRIES,
+    CONF_TELEGRAM_RETRY_BACKOFF_MIN,
+    CONF_TELEGRAM_RETRY_BACKOFF_MAX,
+    CONF_TELEGRAM_BREAKER_THRESHOLD,
+    CONF_TELEGRAM_BREAKER_RESET,
+    CONF_TELEGRAM_INGESTION_WEBHOOK,
+    CONF_RENDER,
+    CONF_RENDER_PROCESSES,
+    CONF_DELIVERY,
+    CONF_DELIVERY_RATE,
+    CONF_DELIVERY_CHAT_RATE,
+    CONF_DELIVERY_CHAT_BURST,
+    CONF_DELIVERY_GROUP_RATE,
+    CONF_DELIVERY_MAX_RETRIES,
+    CONF_WEBHOOK,
+    CONF_WEBHOOK_URL,
+    CONF_WEBHOOK_BIND,
+    CONF_WEBHOOK_PORT,
+    CONF_WEBHOOK_PATH,
+    CONF_WEBHOOK_WORKERS,
+    CONF_WEBHOOK_SECRET_TOKEN,
+    CONF_WEBHOOK_MAX_BODY,
     CONF_PASSCODE,
     CONF_PASSCODE_DATA_FILE,
     CONF_PASSCODE_IMAGE_FILE,
@@ -29,22 +73,66 @@ from ._config import (
     CONF_PASSCODE_PROTAL_COUNT,
     CONF_PASSCODE_DUMP_INTERVAL,
     CONF_PASSCODE_BROADCAST_INTERVAL,
+    CONF_PASSCODE_DUMP_MAX_WAIT,
+    CONF_PASSCODE_BROADCAST_MAX_WAIT,
+    CONF_PASSCODE_BACKEND,
+    CONF_PASSCODE_SESSIONS_FILE,
+    CONF_PASSCODE_SESSION_IDLE,
+    CONF_PASSCODE_HISTORY,
+    CONF_PASSCODE_HISTORY_LIMIT,
+    CONF_PASSCODE_ARCHIVE_FILE,
+    CONF_PASSCODE_BACKEND_JOURNAL,
+    CONF_PASSCODE_JOURNAL_FILE,
+    CONF_PASSCODE_JOURNAL_FSYNC,
+    CONF_PASSCODE_SNAPSHOT_INTERVAL,
+    CONF_INGRESS,
+    CONF_INGRESS_CAPACITY,
+    CONF_INGRESS_POLICY,
+    CONF_INGRESS_DEFER_TIMEOUT,
+    CONF_INGRESS_USER_RATE,
+    CONF_INGRESS_USER_BURST,
+    CONF_INGRESS_ORDER_BY,
+    CONF_INGRESS_ORDER_BY_USER,
+    CONF_INGRESS_ORDER_BY_CHAT,
+    CONF_METRICS,
+    CONF_METRICS_BIND,
+    CONF_METRICS_PORT,
+    CONF_LOCKTRACE,
+    CONF_LOCKTRACE_ENABLED,
+    CONF_LOCKTRACE_SLOW_HOLD,
+    CONF_LOCKTRACE_SAMPLE_INTERVAL,
+    CONF_INGRESS_USER_BURST_DEFAULT,
+    CONF_PASSCODE_PROTAL_COUNT_DEFAULT,
+    CONF_CLUSTER,
+    CONF_CLUSTER_PARTITIONS,
+    CONF_CLUSTER_QUEUE_BACKEND,
+    CONF_CLUSTER_QUEUE_FILE,
 )
 
 
-POLL_INTERVAL = 5
+def _long_poll_timeout(timeout, poll_timeout):
+    # The server holds a long poll open for up to `poll_timeout` seconds, so
+    # the read timeout has to outlast it or every idle poll ends in an error.
+    if timeout.read is None:
+        return timeout
+    return Timeout(
+        connect=timeout.connect,
+        read=timeout.read + poll_timeout,
+        write=timeout.write,
+        pool=timeout.pool,
+    )
 
 
-def main():
-
+def get_pool_args():
     pool_args = {}
     if _config.has_option(CONF_POOL, CONF_POOL_MAX_WORKERS):
         pool_args["max_workers"] = _config.getint(CONF_POOL, CONF_POOL_MAX_WORKERS)
     if _config.has_option(CONF_POOL, CONF_POOL_THREAD_PREFIX):
         pool_args["thread_name_prefix"] = _config.get(CONF_POOL, CONF_POOL_THREAD_PREFIX)
-    pool = ThreadPoolExecutor(**pool_args)
+    return pool_args
 
 
+def get_telegram_args():
     telegram_args = {}
     if _config.has_option(CONF_TELEGRAM, CONF_TELEGRAM_TOKEN):
         telegram_args["token"] = _config.get(CONF_TELEGRAM, CONF_TELEGRAM_TOKEN)
@@ -56,13 +144,28 @@ def main():
         telegram_args["user_agent"] = _config.get(CONF_TELEGRAM, CONF_TELEGRAM_USER_AGENT)
     if _config.has_option(CONF_TELEGRAM, CONF_TELEGRAM_TIMEOUT):
         telegram_args["timeout"] = Timeout(timeout = _config.getfloat(CONF_TELEGRAM, CONF_TELEGRAM_TIMEOUT))
-    tg = Telegram(**telegram_args)
+    telegram_args["limits"] = Limits(
+        max_connections=_config.getint(CONF_TELEGRAM, CONF_TELEGRAM_POOL_CONNECTIONS),
+        max_keepalive_connections=_config.getint(CONF_TELEGRAM, CONF_TELEGRAM_POOL_KEEPALIVE),
+        keepalive_expiry=_config.getfloat(CONF_TELEGRAM, CONF_TELEGRAM_KEEPALIVE_EXPIRY),
+    )
+    if _config.has_option(CONF_TELEGRAM, CONF_TELEGRAM_HTTP2):
+        telegram_args["http2"] = _config.getboolean(CONF_TELEGRAM, CONF_TELEGRAM_HTTP2)
+    if _config.has_option(CONF_TELEGRAM, CONF_TELEGRAM_RETRIES):
+        telegram_args["retries"] = _config.getint(CONF_TELEGRAM, CONF_TELEGRAM_RETRIES)
+    if _config.has_option(CONF_TELEGRAM, CONF_TELEGRAM_RETRY_BACKOFF_MIN):
+        telegram_args["retry_backoff_min"] = _config.getfloat(CONF_TELEGRAM, CONF_TELEGRAM_RETRY_BACKOFF_MIN)
+    if _config.has_option(CONF_TELEGRAM, CONF_TELEGRAM_RETRY_BACKOFF_MAX):
+        telegram_args["retry_backoff_max"] = _config.getfloat(CONF_TELEGRAM, CONF_TELEGRAM_RETRY_BACKOFF_MAX)
+    if _config.has_option(CONF_TELEGRAM, CONF_TELEGRAM_BREAKER_THRESHOLD):
+        telegram_args["breaker_threshold"] = _config.getint(CONF_TELEGRAM, CONF_TELEGRAM_BREAKER_THRESHOLD)
+    if _config.has_option(CONF_TELEGRAM, CONF_TELEGRAM_BREAKER_RESET):
+        telegram_args["breaker_reset"] = _config.getfloat(CONF_TELEGRAM, CONF_TELEGRAM_BREAKER_RESET)
+    return telegram_args
 
 
-    passcode_args = {
-        "pool": pool,
-        "broadcaster": tg,
-    }
+def get_passcode_args():
+    passcode_args = {}
     if _config.has_option(CONF_PASSCODE, CONF_PASSCODE_DATA_FILE):
         passcode_args["data_file"] = _config.get(CONF_PASSCODE, CONF_PASSCODE_DATA_FILE)
     if _config.has_option(CONF_PASSCODE, CONF_PASSCODE_IMAGE_FILE):
@@ -77,51 +180,300 @@ def main():
         passcode_args["dump_interval"] = _config.getint(CONF_PASSCODE, CONF_PASSCODE_DUMP_INTERVAL)
     if _config.has_option(CONF_PASSCODE, CONF_PASSCODE_BROADCAST_INTERVAL):
         passcode_args["broadcast_interval"] = _config.getint(CONF_PASSCODE, CONF_PASSCODE_BROADCAST_INTERVAL)
-    passcode_handler = PasscodeHandler(**passcode_args)
+    if _config.has_option(CONF_PASSCODE, CONF_PASSCODE_DUMP_MAX_WAIT):
+        passcode_args["dump_max_wait"] = _config.getint(CONF_PASSCODE, CONF_PASSCODE_DUMP_MAX_WAIT)
+    if _config.has_option(CONF_PASSCODE, CONF_PASSCODE_BROADCAST_MAX_WAIT):
+        passcode_args["broadcast_max_wait"] = _config.getint(CONF_PASSCODE, CONF_PASSCODE_BROADCAST_MAX_WAIT)
+    if _config.has_option(CONF_PASSCODE, CONF_PASSCODE_BACKEND):
+        passcode_args["backend"] = _config.get(CONF_PASSCODE, CONF_PASSCODE_BACKEND)
+    if _config.has_option(CONF_PASSCODE, CONF_PASSCODE_SESSIONS_FILE):
+        passcode_args["sessions_file"] = _config.get(CONF_PASSCODE, CONF_PASSCODE_SESSIONS_FILE)
+    if _config.has_option(CONF_PASSCODE, CONF_PASSCODE_SESSION_IDLE):
+        passcode_args["session_idle"] = _config.getint(CONF_PASSCODE, CONF_PASSCODE_SESSION_IDLE)
+    passcode_args["storage_args"] = get_storage_args()
+    passcode_args["history_args"] = get_history_args()
+    passcode_args["delivery_args"] = get_delivery_args()
+    if _config.has_option(CONF_RENDER, CONF_RENDER_PROCESSES):
+        passcode_args["render_processes"] = _config.getint(CONF_RENDER, CONF_RENDER_PROCESSES)
+    if _config.has_option(CONF_POOL, CONF_POOL_SEND_WORKERS):
+        passcode_args["send_workers"] = _config.getint(CONF_POOL, CONF_POOL_SEND_WORKERS)
+    if _config.has_option(CONF_POOL, CONF_POOL_BACKGROUND_WORKERS):
+        passcode_args["background_workers"] = _config.getint(CONF_POOL, CONF_POOL_BACKGROUND_WORKERS)
+    return passcode_args
 
 
-    # handle_list = []
-    # handle_list.append(passcode_handler.handle)
+def get_ingress_args():
+    ingress_args = {}
+    if _config.has_option(CONF_INGRESS, CONF_INGRESS_CAPACITY):
+        ingress_args["capacity"] = _config.getint(CONF_INGRESS, CONF_INGRESS_CAPACITY)
+    if _config.has_option(CONF_INGRESS, CONF_INGRESS_POLICY):
+        ingress_args["policy"] = _config.get(CONF_INGRESS, CONF_INGRESS_POLICY)
+    if _config.has_option(CONF_INGRESS, CONF_INGRESS_DEFER_TIMEOUT):
+        ingress_args["defer_timeout"] = _config.getfloat(CONF_INGRESS, CONF_INGRESS_DEFER_TIMEOUT)
+    if _config.has_option(CONF_INGRESS, CONF_INGRESS_USER_RATE):
+        ingress_args["user_rate"] = _config.getfloat(CONF_INGRESS, CONF_INGRESS_USER_RATE)
+    if _config.has_option(CONF_INGRESS, CONF_INGRESS_USER_BURST):
+        ingress_args["user_burst"] = _config.getint(CONF_INGRESS, CONF_INGRESS_USER_BURST)
+    return ingress_args
 
 
-    me = tg.getMe()
-    logger.info(f"Bot id={me['id']}")
-    logger.info(f"Bot username={me['username']}")
-    logger.info(f"Bot first_name={me['first_name']}")
-    logger.debug(me)
+def get_delivery_args():
+    delivery_args = {}
+    if _config.has_option(CONF_DELIVERY, CONF_DELIVERY_RATE):
+        delivery_args["rate"] = _config.getfloat(CONF_DELIVERY, CONF_DELIVERY_RATE)
+    if _config.has_option(CONF_DELIVERY, CONF_DELIVERY_CHAT_RATE):
+        delivery_args["chat_rate"] = _config.getfloat(CONF_DELIVERY, CONF_DELIVERY_CHAT_RATE)
+    if _config.has_option(CONF_DELIVERY, CONF_DELIVERY_CHAT_BURST):
+        delivery_args["chat_burst"] = _config.getint(CONF_DELIVERY, CONF_DELIVERY_CHAT_BURST)
+    if _config.has_option(CONF_DELIVERY, CONF_DELIVERY_GROUP_RATE):
+        delivery_args["group_rate"] = _config.getfloat(CONF_DELIVERY, CONF_DELIVERY_GROUP_RATE)
+    if _config.has_option(CONF_DELIVERY, CONF_DELIVERY_MAX_RETRIES):
+        delivery_args["max_retries"] = _config.getint(CONF_DELIVERY, CONF_DELIVERY_MAX_RETRIES)
+    return delivery_args
+
+
+def get_storage_args():
+    storage_args = {}
+    if _config.get(CONF_PASSCODE, CONF_PASSCODE_BACKEND) == CONF_PASSCODE_BACKEND_JOURNAL:
+        if _config.has_option(CONF_PASSCODE, CONF_PASSCODE_JOURNAL_FILE):
+            storage_args["journal_file"] = _config.get(CONF_PASSCODE, CONF_PASSCODE_JOURNAL_FILE)
+        if _config.has_option(CONF_PASSCODE, CONF_PASSCODE_JOURNAL_FSYNC):
+            storage_args["journal_fsync"] = _config.getboolean(CONF_PASSCODE, CONF_PASSCODE_JOURNAL_FSYNC)
+        if _config.has_option(CONF_PASSCODE, CONF_PASSCODE_SNAPSHOT_INTERVAL):
+            storage_args["snapshot_interval"] = _config.getint(CONF_PASSCODE, CONF_PASSCODE_SNAPSHOT_INTERVAL)
+    return storage_args
+
+
+def get_history_args():
+    history_args = {}
+    if _config.has_option(CONF_PASSCODE, CONF_PASSCODE_HISTORY):
+        history_args["history"] = passcode_data.check_history(_config.get(CONF_PASSCODE, CONF_PASSCODE_HISTORY))
+    if _config.has_option(CONF_PASSCODE, CONF_PASSCODE_HISTORY_LIMIT):
+        history_args["history_limit"] = _config.getint(CONF_PASSCODE, CONF_PASSCODE_HISTORY_LIMIT)
+    if _config.has_option(CONF_PASSCODE, CONF_PASSCODE_ARCHIVE_FILE):
+        history_args["archive_file"] = _config.get(CONF_PASSCODE, CONF_PASSCODE_ARCHIVE_FILE)
+    return history_args
+
+
+def get_metrics_args():
+    metrics_args = {}
+    if _config.has_option(CONF_METRICS, CONF_METRICS_BIND):
+        metrics_args["bind"] = _config.get(CONF_METRICS, CONF_METRICS_BIND)
+    if _config.has_option(CONF_METRICS, CONF_METRICS_PORT):
+        metrics_args["port"] = _config.getint(CONF_METRICS, CONF_METRICS_PORT)
+    return metrics_args
+
+
+def start_metrics(port_offset = 0):
+    # Port 0 leaves metrics off. Processes sharing one config, like the
+    # cluster roles, each serve on `port + port_offset`.
+    metrics_args = get_metrics_args()
+    if not metrics_args.get("port"):
+        return None
+    metrics_args["port"] += port_offset
+    return MetricsServer(**metrics_args).start()
+
+
+def get_locktrace_args():
+    locktrace_args = {}
+    if _config.has_option(CONF_LOCKTRACE, CONF_LOCKTRACE_SLOW_HOLD):
+        locktrace_args["slow_hold"] = _config.getfloat(CONF_LOCKTRACE, CONF_LOCKTRACE_SLOW_HOLD)
+    if _config.has_option(CONF_LOCKTRACE, CONF_LOCKTRACE_SAMPLE_INTERVAL):
+        locktrace_args["sample_interval"] = _config.getfloat(CONF_LOCKTRACE, CONF_LOCKTRACE_SAMPLE_INTERVAL)
+    return locktrace_args
+
+
+def start_locktrace():
+    # Off by default; `/passcode locks on` turns it on at runtime too.
+    locktrace_args = get_locktrace_args()
+    TRACER.slow_hold = locktrace_args.get("slow_hold", TRACER.slow_hold)
+    TRACER.sample_interval = locktrace_args.get("sample_interval", TRACER.sample_interval)
+    if _config.getboolean(CONF_LOCKTRACE, CONF_LOCKTRACE_ENABLED):
+        TRACER.enable()
+
+
+def get_queue_args():
+    queue_args = {
+        "backend": _config.get(CONF_CLUSTER, CONF_CLUSTER_QUEUE_BACKEND),
+        "queue_file": _config.get(CONF_CLUSTER, CONF_CLUSTER_QUEUE_FILE),
+        "partitions": _config.getint(CONF_CLUSTER, CONF_CLUSTER_PARTITIONS),
+    }
+    return queue_args
+
+
+def get_poll_args(timeout):
+    poll_timeout = _config.getint(CONF_TELEGRAM, CONF_TELEGRAM_POLL_TIMEOUT)
+    poll_args = {
+        "obj": {"offset": 0, "allowed_updates": ["message"]},
+        "timeout": _long_poll_timeout(timeout, max(poll_timeout, 0)),
+        "interval": _config.getfloat(CONF_TELEGRAM, CONF_TELEGRAM_POLL_INTERVAL),
+        "backoff_min": _config.getfloat(CONF_TELEGRAM, CONF_TELEGRAM_POLL_BACKOFF_MIN),
+        "backoff_max": _config.getfloat(CONF_TELEGRAM, CONF_TELEGRAM_POLL_BACKOFF_MAX),
+    }
+    if poll_timeout > 0:
+        poll_args["obj"]["timeout"] = poll_timeout
+    return poll_args
+
+
+def get_webhook_args():
+    webhook_args = {}
+    if _config.has_option(CONF_WEBHOOK, CONF_WEBHOOK_BIND):
+        webhook_args["bind"] = _config.get(CONF_WEBHOOK, CONF_WEBHOOK_BIND)
+    if _config.has_option(CONF_WEBHOOK, CONF_WEBHOOK_PORT):
+        webhook_args["port"] = _config.getint(CONF_WEBHOOK, CONF_WEBHOOK_PORT)
+    if _config.has_option(CONF_WEBHOOK, CONF_WEBHOOK_PATH):
+        webhook_args["path"] = _config.get(CONF_WEBHOOK, CONF_WEBHOOK_PATH)
+    if _config.has_option(CONF_WEBHOOK, CONF_WEBHOOK_WORKERS):
+        webhook_args["workers"] = _config.getint(CONF_WEBHOOK, CONF_WEBHOOK_WORKERS)
+    if _config.has_option(CONF_WEBHOOK, CONF_WEBHOOK_SECRET_TOKEN):
+        webhook_args["secret_token"] = _config.get(CONF_WEBHOOK, CONF_WEBHOOK_SECRET_TOKEN)
+    if _config.has_option(CONF_WEBHOOK, CONF_WEBHOOK_MAX_BODY):
+        webhook_args["max_body"] = _config.getint(CONF_WEBHOOK, CONF_WEBHOOK_MAX_BODY)
+    return webhook_args
+
+
+def get_set_webhook_args():
+    if not _config.has_option(CONF_WEBHOOK, CONF_WEBHOOK_URL):
+        return None
+    set_webhook_args = {
+        "url": _config.get(CONF_WEBHOOK, CONF_WEBHOOK_URL),
+        "allowed_updates": ["message"],
+    }
+    if _config.get(CONF_WEBHOOK, CONF_WEBHOOK_SECRET_TOKEN):
+        set_webhook_args["secret_token"] = _config.get(CONF_WEBHOOK, CONF_WEBHOOK_SECRET_TOKEN)
+    return set_webhook_args
 
 
-    offset = 0
-    loop_t0 = time.time()
+def is_webhook():
+    return _config.get(CONF_TELEGRAM, CONF_TELEGRAM_INGESTION) == CONF_TELEGRAM_INGESTION_WEBHOOK
+
+
+def poll(tg, dispatch, offset = 0):
+    poll_args = get_poll_args(tg.timeout)
+    poll_obj = poll_args["obj"]
+    poll_obj["offset"] = offset
+    backoff = 0
     loop_acc_count = 0
-    loop_con_count = 0
     while True:
         loop_acc_count += 1
+        loop_t0 = time.time()
         try:
-            updates = tg.getUpdates({"offset": offset, "allowed_updates": ["message"]})
+            updates = tg.getUpdates(poll_obj, timeout=poll_args["timeout"])
         except Exception as e:
-            logger.error("Failed updating.")
+            backoff = min(max(backoff * 2, poll_args["backoff_min"]), poll_args["backoff_max"])
+            logger.error(f"Failed updating. Retrying in {backoff}s.")
             logger.debug(e, stack_info=True)
+            time.sleep(backoff)
             continue
+        backoff = 0
         try:
             logger.debug(updates)
             if updates:
                 for update in updates:
-                    offset = max(offset, update["update_id"] + 1)
-                    pool.submit(passcode_handler.handle, tg, update)
+                    poll_obj["offset"] = max(poll_obj["offset"], update["update_id"] + 1)
+                    dispatch(update)
         except Exception as e:
             logger.error("Failed processing update.")
             logger.debug(e, stack_info=True)
-        
-        loop_tx = loop_t0 + loop_con_count * POLL_INTERVAL
-        logger.debug(f"Task Count: {pool._work_queue.qsize()}.")
+
         logger.debug(f"Loop Count: {loop_acc_count}.")
-        logger.debug(f"Loop Cost: {time.time() - loop_tx}s.")
-        logger.debug(f"Runing smoothly for {loop_con_count} loops.")
-        if (t := loop_tx + POLL_INTERVAL - time.time()) > 0:
-            loop_con_count += 1
+        logger.debug(f"Loop Cost: {time.time() - loop_t0}s.")
+        # A non-empty batch means more may be waiting, so poll again at once;
+        # only idle polls are spaced out by `poll-interval`.
+        if not updates and (t := loop_t0 + poll_args["interval"] - time.time()) > 0:
             time.sleep(t)
-        else:
-            loop_con_count = 0
-            loop_t0 = time.time()
 
+
+def get_submit(router, route, tg, update, pool, keyed, order_by):
+    # Updates from one user (or chat) run one at a time, in the order they
+    # are dispatched, and by `update_id` among those waiting together;
+    # others run in parallel. Nothing reorders an update that is dispatched
+    # late, say by a webhook worker, after a later one has started.
+    message = update["message"]
+    if order_by == CONF_INGRESS_ORDER_BY_USER:
+        return partial(keyed.submit, message["from"]["id"], router.call, route, tg, update, order=update["update_id"])
+    if order_by == CONF_INGRESS_ORDER_BY_CHAT:
+        return partial(keyed.submit, message["chat"]["id"], router.call, route, tg, update, order=update["update_id"])
+    return partial(pool.submit, router.call, route, tg, update)
+
+
+def get_ingress(passcode_args):
+    # The admin is never throttled, setting up a session takes a burst; and
+    # nobody reporting every portal in a row is either.
+    ingress_args = get_ingress_args()
+    ingress_args["user_burst"] = max(
+        ingress_args.get("user_burst", CONF_INGRESS_USER_BURST_DEFAULT),
+        passcode_args.get("portal_count", CONF_PASSCODE_PROTAL_COUNT_DEFAULT),
+    )
+    return IngressQueue(**ingress_args, exempt=(passcode_args.get("admin_uid"),))
+
+
+def make_dispatch(router, tg, pool, keyed, ingress, order_by, throttled):
+
+    def dispatch(update):
+        # Everything but commands is dropped right here, and floods and
+        # overload at admission, both before any shared state is touched.
+        if (route := router.route(update)) is None:
+            return
+        message = update["message"]
+        submit = get_submit(router, route, tg, update, pool, keyed, order_by)
+        ingress.admit(message["from"]["id"], submit, partial(throttled, tg, message))
+        logger.debug(f"Task Count: {pool._work_queue.qsize()}.")
+
+    return dispatch
+
+
+def serve_webhook(dispatch):
+    server = WebhookServer(dispatch, **get_webhook_args())
+    logger.info(f"Serving webhook on {server.server_address}.")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+
+
+def main():
+
+    pool = ThreadPoolExecutor(**get_pool_args())
+    tg = Telegram(**get_telegram_args())
+    passcode_args = get_passcode_args()
+    passcode_handler = PasscodeHandler(
+        pool=pool,
+        broadcaster=tg,
+        **passcode_args,
+    )
+    ingress = get_ingress(passcode_args)
+    keyed = KeyedExecutor(pool)
+    order_by = _config.get(CONF_INGRESS, CONF_INGRESS_ORDER_BY)
+
+
+    router = Router()
+    router.register(COMMAND_PASSCODE, passcode_handler.handle, passcode_handler.commands)
+    router.add_hook(route_hook)
+    passcode_handler.register_metrics()
+    ingress.register_metrics()
+    keyed.register_metrics()
+    metrics_server = start_metrics()
+    start_locktrace()
+    dispatch = make_dispatch(router, tg, pool, keyed, ingress, order_by, passcode_handler.reply_throttled)
+
+
+    me = tg.getMe()
+    logger.info(f"Bot id={me['id']}")
+    logger.info(f"Bot username={me['username']}")
+    logger.info(f"Bot first_name={me['first_name']}")
+    logger.debug(me)
+
+
+    try:
+        if is_webhook():
+            if (set_webhook_args := get_set_webhook_args()):
+                tg.setWebhook(set_webhook_args)
+            serve_webhook(dispatch)
+        else:
+            poll(tg, dispatch)
+    finally:
+        if metrics_server:
+            metrics_server.close()
+        passcode_handler.close()
+        tg.close()
@@ -0,0 +1,282 @@
+# -*- coding=utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+
+import bisect
+import math
+import threading
+
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from threading import Lock
+
+from ._config import (
+    CONF_METRICS_BIND_DEFAULT,
+    CONF_METRICS_PORT_DEFAULT,
+)
+
+
+# Prometheus text exposition without the client library. Recording is a
+# dict lookup and a few additions under a per-metric lock; everything else
+# happens when the endpoint is scraped.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+BUCKETS_SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra = ()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{_escape(value)}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+
+
+class Metric:
+
+    kind = "untyped"
+
+    def __init__(self, name, help, labels = ()) -> None:
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.lock = Lock()
+        self.values = {}
+
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return [f"{self.name}{_labels(self.label_names, labels)} {_number(value)}" for labels, value in items]
+
+
+
+
+class Counter(Metric):
+
+    kind = "counter"
+
+    def inc(self, *labels, amount = 1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+
+
+class Gauge(Metric):
+
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+
+
+
+class GaugeFunc(Metric):
+
+    # Read at scrape time; `fn` returns a number, or a dict of label value
+    # tuples to numbers.
+
+    kind = "gauge"
+
+    def __init__(self, name, help, fn, labels = ()) -> None:
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+
+    def samples(self):
+        try:
+            values = self.fn()
+        except Exception as e:
+            logger.debug(e)
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [
+            f"{self.name}{_labels(self.label_names, labels)} {_number(value)}"
+            for labels, value in sorted(values.items())
+        ]
+
+
+
+
+class Histogram(Metric):
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels = (), buckets = BUCKETS_SECONDS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+
+    def observe(self, value, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # Per-bucket counts, then the sum.
+                counts = self.values[labels] = [0] * len(self.buckets) + [0]
+            counts[i] += 1
+            counts[-1] += value
+
+
+    def samples(self):
+        with self.lock:
+            items = sorted((labels, list(counts)) for labels, counts in self.values.items())
+        lines = []
+        for labels, counts in items:
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                le = _labels(self.label_names, labels, (("le", _number(bound)),))
+                lines.append(f"{self.name}_bucket{le} {total}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {_number(counts[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {total}")
+        return lines
+
+
+
+
+class Registry:
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.metrics: dict[str, Metric] = {}
+
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines += metric.header()
+            lines += metric.samples()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+UPDATES = REGISTRY.register(Counter(
+    "ingressfsbot_updates_total",
+    "Updates received, by the command they were routed to; empty when dropped.",
+    ("command",),
+))
+COMMAND_SECONDS = REGISTRY.register(Histogram(
+    "ingressfsbot_command_seconds",
+    "Time spent handling a routed command.",
+    ("command",),
+))
+COMMAND_ERRORS = REGISTRY.register(Counter(
+    "ingressfsbot_command_errors_total",
+    "Routed commands that raised.",
+    ("command",),
+))
+TELEGRAM_SECONDS = REGISTRY.register(Histogram(
+    "ingressfsbot_telegram_seconds",
+    "Bot API request latency, per attempt.",
+    ("method", "status"),
+))
+DUMP_SECONDS = REGISTRY.register(Histogram(
+    "ingressfsbot_dump_seconds",
+    "Time spent dumping a session.",
+    ("session",),
+))
+DUMP_BYTES = REGISTRY.register(Gauge(
+    "ingressfsbot_dump_bytes",
+    "Size of the data file after the last dump.",
+    ("session",),
+))
+RENDER_SECONDS = REGISTRY.register(Histogram(
+    "ingressfsbot_render_seconds",
+    "Time spent rendering a passcode image, cache hits included.",
+))
+INGRESS = REGISTRY.register(Counter(
+    "ingressfsbot_ingress_total",
+    "Routed updates by admission result: admitted, throttled, deferred or shed.",
+    ("result",),
+))
+DELIVERY_MESSAGES = REGISTRY.register(Counter(
+    "ingressfsbot_delivery_messages_total",
+    "Outbound messages by result.",
+    ("result",),
+))
+
+
+def route_hook(name, elapsed, error):
+    COMMAND_SECONDS.observe(elapsed, name)
+    if error is not None:
+        COMMAND_ERRORS.inc(name)
+
+
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_response(404)
+            self.send_header("content-length", "0")
+            self.end_headers()
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("content-type", CONTENT_TYPE)
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+
+
+class MetricsServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        registry = REGISTRY,
+        bind = CONF_METRICS_BIND_DEFAULT,
+        port = CONF_METRICS_PORT_DEFAULT,
+    ) -> None:
+        self.registry = registry
+        super().__init__((bind, port), MetricsRequestHandler)
+        self.thread = threading.Thread(target=self.serve_forever, name="Metrics", daemon=True)
+
+
+    def start(self):
+        self.thread.start()
+        logger.info(f"Serving metrics on {self.server_address}.")
+        return self
+
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
@@ -3,20 +3,131 @@
 import logging
 logger = logging.getLogger(__name__)
 
+import os
+import sys
 import time
 import json
 
-from dataclasses import dataclass, field, asdict
+from collections import Counter
+from dataclasses import dataclass, field, fields
+from typing import NamedTuple
+
+from ._config import (
+    CONF_PASSCODE_HISTORY_ALL,
+    CONF_PASSCODE_HISTORY_LATEST,
+    CONF_PASSCODE_HISTORY_LAST,
+    CONF_PASSCODE_HISTORY_ARCHIVE,
+)
+
+
+HISTORIES = (
+    CONF_PASSCODE_HISTORY_ALL,
+    CONF_PASSCODE_HISTORY_LATEST,
+    CONF_PASSCODE_HISTORY_LAST,
+    CONF_PASSCODE_HISTORY_ARCHIVE,
+)
+
+
+def check_history(history):
+    if history not in HISTORIES:
+        raise ValueError(f"Unknown passcode history {history}, expected one of {', '.join(HISTORIES)}.")
+    return history
+
+
+def from_dict(obj):
+    return PasscodeData(**{
+        _field.name: obj[_field.name]
+        for _field in fields(PasscodeData)
+        if _field.name in obj
+    })
+
+
+def loads(text):
+    return from_dict(json.loads(text))
+
+
+def copy_data(data):
+    # Copies what writers change in place, down to each report list; reports
+    # are immutable and user dicts only ever replaced. Cheap enough to take
+    # under the data lock, `as_json` and `json.dumps` come after it.
+    obj = {_field.name: getattr(data, _field.name) for _field in fields(PasscodeData)}
+    obj["user_reports"] = {
+        uid: {index: list(history) for index, history in reports.items()}
+        for uid, reports in data.user_reports.items()
+    }
+    obj["user_trusted"] = list(data.user_trusted)
+    obj["user_info"] = dict(data.user_info)
+    return obj
+
+
+def as_json(obj):
+    # Reports go out as dicts, which every version can read.
+    return dict(obj, user_reports={
+        uid: {index: [report._asdict() for report in history] for index, history in reports.items()}
+        for uid, reports in obj["user_reports"].items()
+    })
+
+
+def to_dict(data):
+    return as_json(copy_data(data))
+
+
+def dumps(data):
+    return json.dumps(to_dict(data))
 
 
 def load(filename):
     with open(filename, "r") as fp:
-        return PasscodeData(**json.load(fp))
+        return loads(fp.read())
 
 
 def dump(filename, data):
-    with open(filename, "w") as fp:
-        json.dump(asdict(data), fp)
+    write(filename, dumps(data))
+
+
+def write(filename, text):
+    # Write aside and rename over the target, so a crash mid-write never
+    # leaves a truncated data file behind.
+    filename_tmp = f"{filename}.tmp"
+    with open(filename_tmp, "w") as fp:
+        fp.write(text)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(filename_tmp, filename)
+
+
+
+def _votes(item):
+    value, count = item
+    return count, value == ""
+
+
+
+class Report(NamedTuple):
+    time:   float
+    name:   str
+    media:  str
+
+
+def to_report(obj):
+    # Dicts in data files, lists in the few written as tuples.
+    if isinstance(obj, dict):
+        obj = (obj["time"], obj["name"], obj["media"])
+    t, name, media = obj
+    # Names and media repeat across thousands of users, share one copy.
+    return Report(t, sys.intern(name), sys.intern(media))
+
+
+
+@dataclass(frozen=True)
+class PasscodeSnapshot:
+    generation:         int         = 0
+    passcode_url:       str         = ""
+    passcode_patt:      str         = ""
+    trustable_reports:  tuple       = ()
+    trustable_users:    tuple       = ()
+    trusted_users:      tuple       = ()
+    trusted_uids:       frozenset   = frozenset()
 
 
 
@@ -33,36 +144,218 @@ class PasscodeData:
     min_rate:       int     = 0.5
 
 
+    def __post_init__(self):
+        # Running per-index tallies of every user's latest report, kept in
+        # step by `add_report` so consensus never rescans all users.
+        self._names = {}
+        self._medias = {}
+        self._consensus = {}
+        self._trustable_reports = None
+        # Per-user count of latest reports agreeing with the consensus media,
+        # adjusted only for the voters of an index whose consensus moved.
+        self._voters = {}
+        self._correct = {}
+        self._trustable = set()
+        self._order = {}
+        # Secondary indexes: username to uid, and the trusted uids as an
+        # ordered set. `user_trusted` stays a list for the JSON format.
+        self._usernames = {}
+        for uid, user in self.user_info.items():
+            if user.get("username"):
+                self._usernames[user["username"]] = uid
+        self._trusted = dict.fromkeys(self.user_trusted)
+        self.user_trusted = list(self._trusted)
+        for uid in self.user_reports:
+            self._order[uid] = len(self._order)
+            for index in self.user_reports[uid]:
+                history = self.user_reports[uid][index] = list(map(to_report, self.user_reports[uid][index]))
+                if history:
+                    self._tally(uid, index, None, history[-1])
+        # Immutable view for lock-free readers. Writers bump the generation
+        # on every mutation and call `publish` before releasing their lock.
+        self._generation = 0
+        self.snapshot = PasscodeSnapshot(generation=-1)
+        self.publish()
+        # Set by a journaling storage to receive every mutation.
+        self.journal = None
+        self.history = CONF_PASSCODE_HISTORY_ALL
+        self.history_limit = 1
+        self.archive = None
+
+
+    def set_history(self, history, limit = 1, archive = None):
+        # Only the latest report of an index is ever read. `all` keeps every
+        # report, `latest` only that one; with `last` older ones are dropped
+        # once there are more than `limit`, with `archive` handed to it.
+        self.history = check_history(history)
+        self.history_limit = 1 if history == CONF_PASSCODE_HISTORY_LATEST else max(limit, 1)
+        self.archive = archive if history == CONF_PASSCODE_HISTORY_ARCHIVE else None
+        for uid, reports in self.user_reports.items():
+            for index, reports_index in reports.items():
+                self._trim(uid, index, reports_index)
+
+
+    def _trim(self, uid, index, reports):
+        if self.history == CONF_PASSCODE_HISTORY_ALL or len(reports) <= self.history_limit:
+            return
+        if self.archive is not None:
+            self.archive.append(uid, index, reports[:-self.history_limit])
+        del reports[:-self.history_limit]
+
+
+    def _record(self, op, *args):
+        if self.journal is not None:
+            self.journal.append(op, *args)
+
+
+    def publish(self):
+        if self.snapshot.generation == self._generation:
+            return self.snapshot
+        trustable_reports, trustable_users = self.get_trustable()
+        trusted_uids = self._trusted
+        self.snapshot = PasscodeSnapshot(
+            generation=self._generation,
+            passcode_url=self.passcode_url,
+            passcode_patt=self.passcode_patt,
+            trustable_reports=tuple(trustable_reports),
+            trustable_users=tuple(trustable_users),
+            trusted_users=tuple(self.user_info[uid] for uid in trusted_uids),
+            trusted_uids=frozenset(trusted_uids),
+        )
+        return self.snapshot
+
+
+    def _consensus_media(self, index):
+        if index in self._consensus:
+            return self._consensus[index][1].lower()
+        return None
+
+
+    def _credit(self, uid, delta):
+        self._correct[uid] = self._correct.get(uid, 0) + delta
+        if self._correct[uid] > self.min_correct:
+            self._trustable.add(uid)
+        else:
+            self._trustable.discard(uid)
+
+
+    def _tally(self, uid, index, old, new):
+        if not index in self._names:
+            self._names[index] = Counter()
+            self._medias[index] = Counter()
+            self._voters[index] = {}
+        names = self._names[index]
+        medias = self._medias[index]
+        voters = self._voters[index]
+        current = self._consensus_media(index)
+        if old:
+            names[old.name] -= 1
+            if not names[old.name]:
+                del names[old.name]
+            medias[old.media] -= 1
+            if not medias[old.media]:
+                del medias[old.media]
+            old_media = old.media.lower()
+            voters[old_media].discard(uid)
+            if not voters[old_media]:
+                del voters[old_media]
+            if old_media == current:
+                self._credit(uid, -1)
+        names[new.name] += 1
+        medias[new.media] += 1
+        new_media = new.media.lower()
+        if not new_media in voters:
+            voters[new_media] = set()
+        voters[new_media].add(uid)
+        if new_media == current:
+            self._credit(uid, 1)
+
+        consensus = self._resolve(index)
+        if consensus != self._consensus.get(index):
+            if consensus:
+                self._consensus[index] = consensus
+            else:
+                del self._consensus[index]
+            self._trustable_reports = None
+            updated = self._consensus_media(index)
+            if updated != current:
+                for _uid in voters.get(current, ()):
+                    self._credit(_uid, -1)
+                for _uid in voters.get(updated, ()):
+                    self._credit(_uid, 1)
+
+
+    def _resolve(self, index):
+        names = self._names[index]
+        medias = self._medias[index]
+        total = sum(names.values())
+        _name = ""
+        _media = ""
+        # Most votes wins. A tie goes to "", as it always did: it hashes to
+        # 0 and came first in the set the old full scan counted over. Other
+        # ties go to the value first voted for.
+        name, count = max(names.items(), key=_votes)
+        if count >= self.min_count and count >= self.min_rate * total:
+            _name = name
+        media, count = max(medias.items(), key=_votes)
+        if count >= self.min_count and count > self.min_rate * total:
+            _media = media
+        if _name or _media:
+            return (_name, _media)
+        return None
+
+
     def set_passcode_url(self, url):
+        self._record("set_passcode_url", url)
         self.passcode_url = url
+        self._generation += 1
 
 
     def set_passcode_patt(self, patt):
+        self._record("set_passcode_patt", patt)
         self.passcode_patt = patt
+        self._generation += 1
 
 
     def add_user(self, user):
         uid = str(user["id"])
-        self.user_info[uid] = user
-
-
-    def add_report(self, user, index, name, media):
+        old = self.user_info.get(uid)
+        if old != user:
+            self._record("add_user", user)
+            if old and old.get("username") and self._usernames.get(old["username"]) == uid:
+                del self._usernames[old["username"]]
+            if user.get("username"):
+                self._usernames[user["username"]] = uid
+            self.user_info[uid] = user
+            self._generation += 1
+
+
+    def add_report(self, user, index, name, media, t=None):
         uid = str(user["id"])
+        t = time.time() if t is None else t
+        self._record("add_report", {"id": uid}, index, name, media, t)
         if not uid in self.user_reports:
             self.user_reports[uid] = {}
+            self._order[uid] = len(self._order)
         if not index in self.user_reports[uid]:
             self.user_reports[uid][index] = []
-        self.user_reports[uid][index].append({
-            "time": time.time(),
-            "name": name,
-            "media": media
-        })
+        reports = self.user_reports[uid][index]
+        old = reports[-1] if reports else None
+        new = to_report((t, name, media))
+        reports.append(new)
+        self._trim(uid, index, reports)
+        if not old or old.name != name or old.media != media:
+            self._tally(uid, index, old, new)
+            self._generation += 1
 
 
     def add_trusted_user(self, user):
         uid = str(user["id"])
-        if uid not in self.user_trusted:
+        if uid not in self._trusted:
+            self._record("add_trusted_user", {"id": uid})
+            self._trusted[uid] = None
             self.user_trusted.append(uid)
+            self._generation += 1
 
 
     def get_passcode_url(self):
@@ -73,55 +366,50 @@ class PasscodeData:
         return self.passcode_patt
 
 
+    def get_user(self, uid):
+        return self.user_info.get(uid)
+
+
     def get_user_by_username(self, username):
-        for uid in self.user_info:
-            if self.user_info[uid]["username"] == username:
-                return self.user_info[uid]
+        uid = self._usernames.get(username)
+        if uid is not None:
+            return self.user_info[uid]
 
 
     def get_user_trusted(self, user):
         uid = str(user["id"])
-        return uid in self.user_trusted
+        return uid in self._trusted
 
 
     def get_user_trustable(self, user):
         uid = str(user["id"])
-        trustable_users = self.get_trustable_users()
-        for user in trustable_users:
-            if str(user["id"]) == uid:
-                return True
-        return False
+        return uid in self._trustable
 
 
     def get_user_reports(self, user):
         uid = str(user["id"])
         reports = set()
-        for index in self.user_reports[uid]:
+        # Copy the items first, this may be read without the writer's lock.
+        for index, history in list(self.user_reports[uid].items()):
             entry = (
                 index,
-                self.user_reports[uid][index][-1]["name"],
-                self.user_reports[uid][index][-1]["media"],
+                history[-1].name,
+                history[-1].media,
             )
             reports.add(entry)
         return sorted(list(reports))
 
 
     def get_trusted_users(self):
-        return [self.user_info[uid] for uid in set(self.user_trusted)]
+        return [self.user_info[uid] for uid in list(self._trusted)]
 
 
     def get_trustable(self):
-        trustable_users = []
-        users_stat = {}
         trustable_reports = self.get_trustable_reports()
-        _trustable_reports = {_index: (_name, _media) for _index, _name, _media in trustable_reports}
-        for uid in self.user_reports:
-            users_stat[uid] = 0
-            for index in self.user_reports[uid]:
-                if index in _trustable_reports and _trustable_reports[index][1].lower() == self.user_reports[uid][index][-1]["media"].lower():
-                    users_stat[uid] += 1
-            if users_stat[uid] > self.min_correct:
-                trustable_users.append(self.user_info[uid])
+        trustable_users = [
+            self.user_info[uid]
+            for uid in sorted(self._trustable, key=self._order.__getitem__)
+        ]
         return trustable_reports, trustable_users
 
 
@@ -131,38 +419,10 @@ class PasscodeData:
 
 
     def get_trustable_reports(self):
-        names = {}
-        medias = {}
-        indexes = set()
-        for uid in self.user_reports:
-            for index in self.user_reports[uid]:
-                indexes.add(index)
-                if not index in names:
-                    names[index] = []
-                if not index in medias:
-                    medias[index] = []
-                names[index].append(self.user_reports[uid][index][-1]["name"])
-                medias[index].append(self.user_reports[uid][index][-1]["media"])
-        trustable_names = {}
-        trustable_medias = {}
-        trustable_reports = set()
-        for index in indexes:
-            for name in set(names[index]):
-                _count = names[index].count(name)
-                if (not index in trustable_names and _count >= self.min_count and _count >= self.min_rate * len(names[index])):
-                    trustable_names[index] = name
-                elif (index in trustable_names and _count > names[index].count(trustable_names[index])):
-                    trustable_names[index] = name
-            for media in set(medias[index]):
-                _count = medias[index].count(media)
-                if (not index in trustable_medias and _count >= self.min_count and _count > self.min_rate * len(medias[index])):
-                    trustable_medias[index] = media
-                elif (index in trustable_medias and _count > medias[index].count(trustable_medias[index])):
-                    trustable_medias[index] = media
-            _name = trustable_names[index] if index in trustable_names else ""
-            _media = trustable_medias[index] if index in trustable_medias else ""
-            if _name or _media:
-                _report = (index, _name, _media)
-                trustable_reports.add(_report)
-        return sorted(list(trustable_reports))
+        if self._trustable_reports is None:
+            self._trustable_reports = sorted(
+                (_index, _name, _media)
+                for _index, (_name, _media) in self._consensus.items()
+            )
+        return list(self._trustable_reports)
 
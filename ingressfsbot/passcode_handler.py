@@ -3,16 +3,35 @@
 import logging
 logger = logging.getLogger(__name__)
 
+import asyncio
+import math
+import multiprocessing
 import os
 import shlex
 import time
 
+from concurrent.futures import ProcessPoolExecutor
 from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+from functools import partial
 from functools import wraps
-from threading import Lock
+from threading import Event
+from typing import Callable
 
-from . import passcode_data
+from . import metrics
 from . import passcode_resolve
+from .locktrace import TRACER
+from .locktrace import TracedLock
+from .delivery import AsyncDelivery
+from .delivery import Delivery
+from .delivery import DeliveryStatus
+from .delivery import PRIORITY_INTERACTIVE
+from .passcode_session import PasscodeSession
+from .passcode_session import SessionBindings
+from .passcode_session import SESSION_DEFAULT
+from .passcode_session import SESSION_NAME_PATTERN
+from .passcode_session import session_file
+from .scheduler import Scheduler
 from .telegram import Telegram
 
 from ._config import (
@@ -23,9 +42,25 @@ from ._config import (
     CONF_PASSCODE_PROTAL_COUNT_DEFAULT,
     CONF_PASSCODE_DUMP_INTERVAL_DEFAULT,
     CONF_PASSCODE_BROADCAST_INTERVAL_DEFAULT,
+    CONF_PASSCODE_DUMP_MAX_WAIT_DEFAULT,
+    CONF_PASSCODE_BROADCAST_MAX_WAIT_DEFAULT,
+    CONF_PASSCODE_BACKEND_DEFAULT,
+    CONF_PASSCODE_SESSIONS_FILE_DEFAULT,
+    CONF_PASSCODE_SESSION_IDLE_DEFAULT,
+    CONF_RENDER_PROCESSES_DEFAULT,
+    CONF_POOL_SEND_WORKERS_DEFAULT,
+    CONF_POOL_BACKGROUND_WORKERS_DEFAULT,
 )
 
 
+COMMAND_PASSCODE = "/passcode"
+COMMAND_PREFIX = "_cmd_"
+
+SCHEDULE_DUMP = "dump"
+SCHEDULE_BROADCAST = "broadcast"
+SCHEDULE_SESSIONS = "sessions"
+
+
 MESSAGE_CMD_FAILED = """
 Unrecognized command.
 Use "`/passcode help`" for help.
@@ -36,6 +71,7 @@ MESSAGE_HELP = """
 `/passcode report` \<index\> \<latitude\>, \<longitude\> \<media\>
 `/passcode unknown`
 `/passcode status`
+`/passcode session` \[name\]
 """
 
 MESSAGE_REPORT_RECIEVED = """
@@ -75,6 +111,18 @@ List trusted users:
 ========EOLS========
 """
 
+MESSAGE_THROTTLED = """
+Too many commands, some were ignored.
+Try again in {}s.
+"""
+
+MESSAGE_SESSION = """
+Session of this chat: {}
+"""
+
+MESSAGE_BROADCAST_SESSION = """
+Session: {}"""
+
 MESSAGE_BROADCAST_PASSCODE = """
 Based on current passcode media info we get, we have the trustable reports below:
 ====================
@@ -86,34 +134,29 @@ Passcode guess is:
 """
 
 
-def _echo_message(tg, message, text, **kwargs):
+def _echo_message(message, text, **kwargs):
     data = {
         "chat_id": message["chat"]["id"],
         "reply_parameters": {"message_id": message["message_id"]},
         "text": text,
     }
     data.update(kwargs)
-    tg.sendMessage(data)
+    return data
 
 
 def _with_data(do_dump=False, do_broadcast=False):
     def _decorator(method):
+        site = method.__name__.removeprefix(COMMAND_PREFIX)
         @wraps(method)
-        def wrapper(self, tg, message, *args, **kwargs):
+        def wrapper(self, session, tg, message, *args, **kwargs):
             _ret = False
-            with self.lock:
-                _ret = method(self, tg, message, *args, **kwargs)
-                now = time.time()
-                if do_dump and now > self.cache_time_last_dump:
-                    self.pool.submit(self.dump)
-                if do_broadcast and now > self.cache_time_last_broadcast:
-                    cache_trustable_reports = tuple(self.passcode_data.get_trustable_reports())
-                    if (
-                        (cache_trustable_reports != self.cache_reports_last_broadcast_submit) and
-                        (cache_trustable_reports != self.cache_reports_last_broadcast_send)
-                    ):
-                        self.cache_reports_last_broadcast_submit = cache_trustable_reports
-                        self.pool.submit(self.broadcast)
+            with session.lock.site(site):
+                _ret = method(self, session, tg, message, *args, **kwargs)
+                snapshot = session.passcode_data.publish()
+                if do_dump:
+                    self.submit_dump(session)
+                if do_broadcast and self.owns_broadcast(session.name):
+                    self._check_broadcast(session, snapshot)
             return _ret
         return wrapper
     return _decorator
@@ -121,11 +164,11 @@ def _with_data(do_dump=False, do_broadcast=False):
 
 def _with_admin(method):
     @wraps(method)
-    def wrapper(self, tg, message, *args, **kwargs):
+    def wrapper(self, session, tg, message, *args, **kwargs):
         uid = message["from"]["id"]
         if str(uid) != self.admin_uid:
             return self.command_failed(tg, message)
-        return method(self, tg, message, *args, **kwargs)
+        return method(self, session, tg, message, *args, **kwargs)
     return wrapper
 
 
@@ -144,70 +187,265 @@ class PasscodeHandler:
         portal_count = CONF_PASSCODE_PROTAL_COUNT_DEFAULT,
         dump_interval = CONF_PASSCODE_DUMP_INTERVAL_DEFAULT,
         broadcast_interval = CONF_PASSCODE_BROADCAST_INTERVAL_DEFAULT,
+        dump_max_wait = CONF_PASSCODE_DUMP_MAX_WAIT_DEFAULT,
+        broadcast_max_wait = CONF_PASSCODE_BROADCAST_MAX_WAIT_DEFAULT,
+        backend = CONF_PASSCODE_BACKEND_DEFAULT,
+        storage_args: dict | None = None,
+        history_args: dict | None = None,
+        delivery_args: dict | None = None,
+        render_processes = CONF_RENDER_PROCESSES_DEFAULT,
+        send_workers = CONF_POOL_SEND_WORKERS_DEFAULT,
+        background_workers = CONF_POOL_BACKGROUND_WORKERS_DEFAULT,
+        sessions_file = CONF_PASSCODE_SESSIONS_FILE_DEFAULT,
+        session_idle = CONF_PASSCODE_SESSION_IDLE_DEFAULT,
+        broadcast_owner: Callable[[str], bool] | None = None,
+        loop: asyncio.AbstractEventLoop | None = None,
     ) -> None:
 
-        self.lock = Lock()
         self.pool = pool
         self.broadcaster = broadcaster
-        self.passcode_data = passcode_data.PasscodeData()
+        self.loop = loop
+        self.tasks = set()
+        # Bulkheads: outbound sends and background jobs (dumps, broadcasts,
+        # sweeps) get pools of their own, so neither can starve command
+        # handling, and a broadcast waiting on its upload never waits on a
+        # worker it is itself holding. Zero workers shares `pool` instead;
+        # the event loop engine sends without a pool at all.
+        self.send_pool = pool
+        if send_workers > 0 and loop is None:
+            self.send_pool = ThreadPoolExecutor(max_workers=send_workers, thread_name_prefix="Send #")
+        self.background_pool = pool
+        if background_workers > 0:
+            self.background_pool = ThreadPoolExecutor(max_workers=background_workers, thread_name_prefix="Background #")
+        self.scheduler = Scheduler(self.background_pool)
+        if loop is None:
+            self.delivery = Delivery(self.send_pool, **(delivery_args or {}))
+        else:
+            self.delivery = AsyncDelivery(loop, **(delivery_args or {}))
+        # Rendering is CPU bound; in processes it stops competing for the
+        # GIL with command handling. Without processes it stays in-thread.
+        self.render_pool = None
+        if render_processes > 0:
+            self.render_pool = ProcessPoolExecutor(
+                max_workers=render_processes,
+                # Forking this process would copy locks held by its threads.
+                mp_context=multiprocessing.get_context("forkserver"),
+                initializer=passcode_resolve.warm_worker,
+                initargs=(passcode_resolve.FONT_NAME,),
+            )
+            # Workers are only started on demand. One job each starts them
+            # all now, font loaded, so the first broadcast waits for neither.
+            warm = wait([
+                self.render_pool.submit(passcode_resolve.warm_worker, passcode_resolve.FONT_NAME)
+                for _ in range(render_processes)
+            ])
+            for future in warm.done:
+                if future.exception() is not None:
+                    logger.error(f"Failed starting render processes.")
+                    logger.debug(future.exception())
+                    break
         self.data_file = data_file
         self.image_file = image_file
         self.image_format = image_formate
         self.admin_uid = admin_uid
         self.portal_count = portal_count
-
-        if not os.path.exists(data_file):
-            passcode_data.dump(data_file, self.passcode_data)
-        
-        self.passcode_data = passcode_data.load(data_file)
+        self.backend = backend
+        self.storage_args = storage_args or {}
+        self.history_args = history_args or {}
 
         self.dump_interval = dump_interval
         self.broadcast_interval = broadcast_interval
-
-        self.cache_time_last_dump = time.time()
-        self.cache_time_last_broadcast = time.time()
-        self.cache_reports_last_broadcast_submit = ()
-        self.cache_reports_last_broadcast_send = ()
-
-
-    def dump(self):
-        time.sleep(self.dump_interval)
-        logger.info(f"Dumping data to {self.data_file}.")
-        with self.lock:
-            passcode_data.dump(self.data_file, self.passcode_data)
-            now = time.time()
-            if now > self.cache_time_last_dump + self.dump_interval:
-                self.cache_time_last_dump = now
-
-
-    def broadcast(self):
-        time.sleep(self.broadcast_interval)
-        with self.lock:
-            if not self.admin_uid in self.passcode_data.user_info:
-                logger.warning(f"Admin user does not exist. Canceled broadcasting.")
-                return
-            
-            patt = self.passcode_data.get_passcode_patt()
-            url = self.passcode_data.get_passcode_url()
-            
-            user_admin = self.passcode_data.user_info[self.admin_uid]
-            trustable_reports, trustable_users = self.passcode_data.get_trustable()
-
-            for user in trustable_users:
-                self.passcode_data.add_trusted_user(user)
-            trusted_users = self.passcode_data.get_trusted_users()
-            
-            cache_trustable_reports = tuple(trustable_reports)
-            if cache_trustable_reports == self.cache_reports_last_broadcast_send:
+        self.dump_max_wait = dump_max_wait
+        self.broadcast_max_wait = broadcast_max_wait
+        # Workers sharing a session's data only broadcast it from the one
+        # that owns it, see `poll_broadcasts`.
+        self.broadcast_owner = broadcast_owner
+
+        # Sessions are loaded on first use and unloaded after `session_idle`
+        # seconds without commands; `sessions_lock` only guards the maps.
+        self.sessions_lock = TracedLock("sessions")
+        self.sessions: dict[str, PasscodeSession] = {}
+        # Sessions being unloaded; their name stays taken until the files
+        # are closed, so nothing loads them again halfway through.
+        self.sessions_closing: dict[str, Event] = {}
+        self.session_bindings = SessionBindings(sessions_file)
+        # Subcommands resolved once, rather than looked up per message.
+        self.commands = {
+            name[len(COMMAND_PREFIX):]: getattr(self, name)
+            for name in dir(self)
+            if name.startswith(COMMAND_PREFIX)
+        }
+        self.session_idle = session_idle
+        if session_idle > 0:
+            self.scheduler.schedule(SCHEDULE_SESSIONS, self._sweep_sessions, session_idle)
+
+
+    def get_session(self, name):
+        while True:
+            with self.sessions_lock.site("get_session"):
+                closing = self.sessions_closing.get(name)
+                if closing is None:
+                    session = self.sessions.get(name)
+                    if session is None:
+                        session = self.sessions[name] = PasscodeSession(
+                            name=name,
+                            data_file=self.data_file,
+                            image_file=self.image_file,
+                            backend=self.backend,
+                            storage_args=self.storage_args,
+                            **self.history_args,
+                        )
+                    session.time_last_used = time.time()
+                    return session
+            closing.wait()
+
+
+    def session_exists(self, name):
+        if name == SESSION_DEFAULT or name in self.session_bindings.names():
+            return True
+        with self.sessions_lock.site("session_exists"):
+            if name in self.sessions:
+                return True
+        return os.path.exists(session_file(self.data_file, name))
+
+
+    def register_metrics(self, registry = metrics.REGISTRY):
+        if self.loop is None:
+            registry.register(metrics.GaugeFunc(
+                "ingressfsbot_work_queue_depth",
+                "Tasks waiting for a pool worker, per pool.",
+                lambda: {
+                    ("handle",): self.pool._work_queue.qsize(),
+                    ("send",): self.send_pool._work_queue.qsize(),
+                    ("background",): self.background_pool._work_queue.qsize(),
+                },
+                ("pool",),
+            ))
+        else:
+            registry.register(metrics.GaugeFunc(
+                "ingressfsbot_tasks",
+                "Tasks spawned on the event loop and not done yet.",
+                lambda: len(self.tasks),
+            ))
+        registry.register(metrics.GaugeFunc(
+            "ingressfsbot_delivery_queue_depth",
+            "Outbound messages queued or in flight.",
+            self.delivery.queue.depth,
+        ))
+        registry.register(metrics.GaugeFunc(
+            "ingressfsbot_sessions_loaded",
+            "Passcode sessions held in memory.",
+            lambda: len(self.sessions),
+        ))
+        registry.register(metrics.GaugeFunc(
+            "ingressfsbot_broadcast_messages",
+            "Progress of the latest broadcast of each loaded session.",
+            self._broadcast_progress,
+            ("session", "state"),
+        ))
+
+
+    def _broadcast_progress(self):
+        progress = {}
+        with self.sessions_lock.site("progress"):
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            if (status := session.broadcast_status) is None:
+                continue
+            progress[(session.name, "total")] = status.total
+            progress[(session.name, "sent")] = status.sent
+            progress[(session.name, "failed")] = status.failed
+            progress[(session.name, "retried")] = status.retried
+        return progress
+
+
+    def owns_broadcast(self, name):
+        return self.broadcast_owner is None or self.broadcast_owner(name)
+
+
+    def _check_broadcast(self, session, snapshot):
+        # Called with the data lock held.
+        cache_trustable_reports = snapshot.trustable_reports
+        if (
+            (cache_trustable_reports != session.cache_reports_last_broadcast_submit) and
+            (cache_trustable_reports != session.cache_reports_last_broadcast_send)
+        ):
+            session.cache_reports_last_broadcast_submit = cache_trustable_reports
+            self.submit_broadcast(session)
+
+
+    def poll_broadcasts(self, names):
+        # Other processes write to a shared session too; its owner picks
+        # their changes up here and broadcasts them like its own.
+        for name in names:
+            if not self.owns_broadcast(name):
+                continue
+            session = self.get_session(name)
+            with session.lock.site("poll_broadcasts"):
+                self._check_broadcast(session, session.passcode_data.publish())
+
+
+    def flush_sessions(self, names):
+        # Writes the pending dump of each loaded session right away.
+        for name in names:
+            with self.sessions_lock.site("flush"):
+                session = self.sessions.get(name)
+            if session is None:
+                continue
+            key_dump, _ = self._session_keys(session)
+            self.scheduler.cancel(key_dump)
+            session.dump()
+
+
+    def _session_keys(self, session):
+        return f"{SCHEDULE_DUMP}:{session.name}", f"{SCHEDULE_BROADCAST}:{session.name}"
+
+
+    def _sweep_sessions(self):
+        now = time.time()
+        idle = []
+        with self.sessions_lock.site("sweep"):
+            for name, session in list(self.sessions.items()):
+                if now < session.time_last_used + self.session_idle:
+                    continue
+                if any(self.scheduler.pending(key) for key in self._session_keys(session)):
+                    continue
+                idle.append(self.sessions.pop(name))
+                self.sessions_closing[name] = Event()
+        for session in idle:
+            try:
+                session.close()
+            finally:
+                with self.sessions_lock.site("sweep"):
+                    self.sessions_closing.pop(session.name).set()
+        self.scheduler.schedule(SCHEDULE_SESSIONS, self._sweep_sessions, self.session_idle)
+
+
+    def _broadcast_prepare(self, session):
+        # Reads the published snapshot only, so broadcasting never holds
+        # the data lock; `broadcast_lock` just guards the dedup cache.
+        snapshot = session.passcode_data.snapshot
+        user_admin = session.passcode_data.get_user(self.admin_uid)
+        if not user_admin:
+            logger.warning(f"Admin user does not exist. Canceled broadcasting.")
+            return None
+
+        with session.broadcast_lock.site("broadcast"):
+            if snapshot.trustable_reports == session.cache_reports_last_broadcast_send:
                 logger.warning(f"Duplicated info. Canceled broadcasting.")
-                return
-            self.cache_reports_last_broadcast_send = cache_trustable_reports
-            
-            now = time.time()
-            if now > self.cache_time_last_broadcast + self.broadcast_interval:
-                self.cache_time_last_broadcast = now
-        
-        file_image_dump = self.image_file + time.strftime("_%Y%m%d%H%M%S") + f".{self.image_format}"
+                return None
+            session.cache_reports_last_broadcast_send = snapshot.trustable_reports
+        return (
+            user_admin,
+            snapshot.trusted_users,
+            snapshot.passcode_patt,
+            snapshot.passcode_url,
+            snapshot.trustable_reports,
+        )
+
+
+    def _broadcast_render(self, session, patt, url, trustable_reports):
+        file_image_dump = session.image_file + time.strftime("_%Y%m%d%H%M%S") + f".{self.image_format}"
         logger.info(f"Dumping image to {file_image_dump}.")
         logger.info(f"Broadcasting data.")
 
@@ -215,47 +453,186 @@ class PasscodeHandler:
             patt,
             trustable_reports,
         )
+        t0 = time.perf_counter()
         passcode_image = passcode_resolve.generate_passcode_image(
             url,
             trustable_reports,
             file_image_dump=file_image_dump,
             file_image_dump_format=self.image_format,
+            executor=self.render_pool,
         )
+        metrics.RENDER_SECONDS.observe(time.perf_counter() - t0)
 
         text_list_trustable_reports = "\n".join(
             f"{_index}\t{_name}\t{_media}"
             for _index, _name, _media in trustable_reports
         )
+        text = MESSAGE_BROADCAST_PASSCODE.format(text_list_trustable_reports, passcode_string)
+        if session.name != SESSION_DEFAULT:
+            text = MESSAGE_BROADCAST_SESSION.format(session.name) + text
+        return text, passcode_image
+
+
+    def _broadcast_admin(self, user_admin, text, passcode_image, status):
+        self.delivery.submit(self.broadcaster, user_admin["id"], "sendMessage", {
+            "chat_id": user_admin["id"],
+            "text": text,
+        }, status=status)
+        # Trusted users get the photo by file id, so the upload to the admin
+        # has to finish before fanning out.
+        return self.delivery.submit(
+            self.broadcaster,
+            user_admin["id"],
+            "sendPhoto",
+            {"chat_id": user_admin["id"]},
+            files={"photo": passcode_image},
+            status=status,
+        )
+
+
+    def _broadcast_fanout(self, user_admin, trusted_users, text, photo_file_id, status):
+        for user in trusted_users:
+            if user["id"] == user_admin["id"]:
+                continue
+            self.delivery.submit(self.broadcaster, user["id"], "sendMessage", {
+                "chat_id": user["id"],
+                "text": text,
+            }, status=status)
+            self.delivery.submit(self.broadcaster, user["id"], "sendPhoto", {
+                "chat_id": user["id"],
+                "photo": photo_file_id,
+            }, status=status)
+
+
+    def _broadcast_status(self, session):
+        session.broadcast_count += 1
+        session.broadcast_status = DeliveryStatus(f"Broadcast {session.name} #{session.broadcast_count}")
+        return session.broadcast_status
+
+
+    def broadcast(self, session):
+        prepared = self._broadcast_prepare(session)
+        if prepared is None:
+            return
+        user_admin, trusted_users, patt, url, trustable_reports = prepared
+        text, passcode_image = self._broadcast_render(session, patt, url, trustable_reports)
 
         if self.broadcaster:
-            self.broadcaster.sendMessage({
-                "chat_id": user_admin["id"],
-                "text": MESSAGE_BROADCAST_PASSCODE.format(text_list_trustable_reports, passcode_string),
-            })
-            resp = self.broadcaster.sendPhoto(
-                {"chat_id": user_admin["id"]},
-                files={"photo": passcode_image},
-            )
-            photo_file_id = resp["photo"][-1]["file_id"]
-            for user in trusted_users:
-                if user["id"] == user_admin["id"]:
-                    continue
-                self.pool.submit(self.broadcaster.sendMessage, {
-                    "chat_id": user["id"],
-                    "text": MESSAGE_BROADCAST_PASSCODE.format(text_list_trustable_reports, passcode_string),
-                })
-                self.pool.submit(self.broadcaster.sendPhoto, {
-                    "chat_id": user["id"],
-                    "photo": photo_file_id,
-                })
+            status = self._broadcast_status(session)
+            try:
+                resp = self._broadcast_admin(user_admin, text, passcode_image, status).result()
+                photo_file_id = resp["photo"][-1]["file_id"]
+                self._broadcast_fanout(user_admin, trusted_users, text, photo_file_id, status)
+            except Exception as e:
+                logger.error(f"Failed broadcasting to admin. Canceled broadcasting.")
+                logger.debug(e)
+            finally:
+                self.delivery.queue.seal(status)
+
+
+    async def broadcast_async(self, session):
+        prepared = self._broadcast_prepare(session)
+        if prepared is None:
+            return
+        user_admin, trusted_users, patt, url, trustable_reports = prepared
+        text, passcode_image = await self.loop.run_in_executor(
+            self.pool,
+            self._broadcast_render,
+            session,
+            patt,
+            url,
+            trustable_reports,
+        )
+
+        if self.broadcaster:
+            status = self._broadcast_status(session)
+            try:
+                resp = await asyncio.wrap_future(
+                    self._broadcast_admin(user_admin, text, passcode_image, status)
+                )
+                photo_file_id = resp["photo"][-1]["file_id"]
+                self._broadcast_fanout(user_admin, trusted_users, text, photo_file_id, status)
+            except Exception as e:
+                logger.error(f"Failed broadcasting to admin. Canceled broadcasting.")
+                logger.debug(e)
+            finally:
+                self.delivery.queue.seal(status)
+
+
+    def spawn(self, coro):
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self._task_done)
+        return task
+
+
+    def _task_done(self, task):
+        self.tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.debug(task.exception())
+
+
+    def echo(self, tg, message, text, **kwargs):
+        # Replies jump ahead of broadcast traffic in the delivery queue.
+        return self.delivery.submit(
+            tg,
+            message["chat"]["id"],
+            "sendMessage",
+            _echo_message(message, text, **kwargs),
+            priority=PRIORITY_INTERACTIVE,
+        )
+
+
+    def reply_throttled(self, tg, message, wait):
+        self.echo(tg, message, MESSAGE_THROTTLED.format(math.ceil(wait)))
+
+
+    def _spawn_broadcast(self, session):
+        self.loop.call_soon_threadsafe(lambda: self.spawn(self.broadcast_async(session)))
+
+
+    def submit_dump(self, session):
+        # Dumping is blocking in both engines, so it always runs on the pool;
+        # pending dumps are written when the sessions close.
+        key_dump, _ = self._session_keys(session)
+        self.scheduler.debounce(
+            key_dump,
+            session.dump,
+            self.dump_interval,
+            self.dump_max_wait,
+        )
+
+
+    def submit_broadcast(self, session):
+        _, key_broadcast = self._session_keys(session)
+        self.scheduler.debounce(
+            key_broadcast,
+            partial(self.broadcast if self.loop is None else self._spawn_broadcast, session),
+            self.broadcast_interval,
+            self.broadcast_max_wait,
+        )
+
+
+    def close(self):
+        self.scheduler.close(flush=False)
+        self.delivery.close()
+        for _pool in (self.send_pool, self.background_pool):
+            if _pool is not self.pool:
+                _pool.shutdown(wait=False)
+        if self.render_pool:
+            self.render_pool.shutdown(wait=False, cancel_futures=True)
+        with self.sessions_lock.site("close"):
+            sessions = list(self.sessions.values())
+            self.sessions.clear()
+        for session in sessions:
+            session.close()
 
 
 
 
 
     def command_failed(self, tg, message, text = ""):
-        self.pool.submit(
-            _echo_message,
+        self.echo(
             tg,
             message,
             MESSAGE_CMD_FAILED + text,
@@ -264,9 +641,8 @@ class PasscodeHandler:
         return True
 
 
-    def _cmd_help(self, tg, message):
-        self.pool.submit(
-            _echo_message,
+    def _cmd_help(self, session, tg, message):
+        self.echo(
             tg,
             message,
             MESSAGE_HELP,
@@ -276,7 +652,7 @@ class PasscodeHandler:
 
 
     @_with_data(do_dump=True, do_broadcast=True)
-    def _cmd_report(self, tg, message, index, *args):
+    def _cmd_report(self, session, tg, message, index, *args):
         user = message["from"]
         if len(args) == 1:
             name = ""
@@ -287,13 +663,11 @@ class PasscodeHandler:
             (x, y, media) = tuple(args[:3])
             name = f"({x}{y})"
         else:
-            self.pool.submit(self.command_failed, tg, message, "arguments invalid")
-            return True
-        self.passcode_data.add_report(user, index, name, media)
-        for user in self.passcode_data.get_trustable_users():
-            self.passcode_data.add_trusted_user(user)
-        self.pool.submit(
-            _echo_message,
+            return self.command_failed(tg, message, "arguments invalid")
+        session.passcode_data.add_report(user, index, name, media)
+        for user in session.passcode_data.get_trustable_users():
+            session.passcode_data.add_trusted_user(user)
+        self.echo(
             tg,
             message,
             MESSAGE_REPORT_RECIEVED,
@@ -303,22 +677,16 @@ class PasscodeHandler:
 
 
     # @_with_data_access
-    # def _cmd_unknown(self, tg, message, chat, user, command):
+    # def _cmd_unknown(self, session, tg, message, chat, user, command):
     #     return
     
 
-    @_with_data()
-    def _cmd_status(self, tg, message):
+    def _cmd_status(self, session, tg, message):
         user = message["from"]
-        user_trusted = False
-        user_reports = []
-        trustable_reports = []
-        trustable_users = []
-        user_trusted = self.passcode_data.get_user_trusted(user)
-        user_reports = self.passcode_data.get_user_reports(user)
-        trustable_reports, trustable_users = self.passcode_data.get_trustable()
-        for user in trustable_users:
-            self.passcode_data.add_trusted_user(user)
+        snapshot = session.passcode_data.snapshot
+        user_trusted = str(user["id"]) in snapshot.trusted_uids
+        user_reports = session.passcode_data.get_user_reports(user)
+        trustable_reports = snapshot.trustable_reports
         
         text_list_user_reports = "\n".join(
             f"{_index}\t{_name}\t{_media}"
@@ -330,15 +698,13 @@ class PasscodeHandler:
             for _index, _name, _media in trustable_reports
         )
 
-        self.pool.submit(
-            _echo_message,
+        self.echo(
             tg,
             message,
             MESSAGE_LIST_USER_REPORTS.format(text_list_user_reports)
         )
         if user_trusted:
-            self.pool.submit(
-                _echo_message,
+            self.echo(
                 tg,
                 message,
                 MESSAGE_LIST_TRUSTABLE_REPORTS.format(text_list_trustable_reports)
@@ -349,14 +715,13 @@ class PasscodeHandler:
 
     @_with_admin
     @_with_data(do_dump=True)
-    def _cmd_image(self, tg, message, url):
-        self.passcode_data.set_passcode_url(url)
-        self.pool.submit(
-            _echo_message,
+    def _cmd_image(self, session, tg, message, url):
+        session.passcode_data.set_passcode_url(url)
+        self.echo(
             tg, message,
             MESSAGE_IMAGE_PATT_RECIEVED.format(
-                self.passcode_data.get_passcode_url(),
-                self.passcode_data.get_passcode_patt(),
+                session.passcode_data.get_passcode_url(),
+                session.passcode_data.get_passcode_patt(),
             )
         )
         return True
@@ -364,14 +729,13 @@ class PasscodeHandler:
 
     @_with_admin
     @_with_data(do_dump=True)
-    def _cmd_patt(self, tg, message, patt):
-        self.passcode_data.set_passcode_patt(patt)
-        self.pool.submit(
-            _echo_message,
+    def _cmd_patt(self, session, tg, message, patt):
+        session.passcode_data.set_passcode_patt(patt)
+        self.echo(
             tg, message,
             MESSAGE_IMAGE_PATT_RECIEVED.format(
-                self.passcode_data.get_passcode_url(),
-                self.passcode_data.get_passcode_patt(),
+                session.passcode_data.get_passcode_url(),
+                session.passcode_data.get_passcode_patt(),
             )
         )
         return True
@@ -379,14 +743,13 @@ class PasscodeHandler:
 
     @_with_admin
     @_with_data(do_dump=True)
-    def _cmd_trust(self, tg, message, username):
-        user = self.passcode_data.get_user_by_username(username)
+    def _cmd_trust(self, session, tg, message, username):
+        user = session.passcode_data.get_user_by_username(username)
         if not user:
-            self.pool.submit(_echo_message, tg, message, "User not found.")
+            self.echo(tg, message, "User not found.")
             return True
-        self.passcode_data.add_trusted_user(user)
-        self.pool.submit(
-            _echo_message,
+        session.passcode_data.add_trusted_user(user)
+        self.echo(
             tg,
             message,
             MESSAGE_TRUST_USER.format(f"{user['id']} : @{user['username']}")
@@ -395,14 +758,12 @@ class PasscodeHandler:
 
 
     @_with_admin
-    @_with_data()
-    def _cmd_trusted(self, tg, message):
+    def _cmd_trusted(self, session, tg, message):
         text_list_users = "\n".join(
             f"{user['id']} : @{user['username']}"
-            for user in self.passcode_data.get_trusted_users()
+            for user in session.passcode_data.snapshot.trusted_users
         )
-        self.pool.submit(
-            _echo_message,
+        self.echo(
             tg,
             message,
             MESSAGE_LIST_TRUSTED_USER.format(text_list_users)
@@ -411,34 +772,86 @@ class PasscodeHandler:
 
 
     @_with_admin
-    @_with_data()
-    def _cmd_broadcast(self, tg, message):
-        self.pool.submit(
-            _echo_message,
+    def _cmd_broadcast(self, session, tg, message):
+        self.echo(
             tg,
             message,
             "Preparing Broadcast data..."
         )
-        self.pool.submit(self.broadcast)
+        self.submit_broadcast(session)
 
 
-    def handle(self, tg, update):
-        assert "message" in update and update["message"]
-        assert "chat" in update["message"] and update["message"]["chat"]
-        assert "from" in update["message"] and update["message"]["from"]
-        assert "text" in update["message"] and update["message"]["text"]
-        self.passcode_data.add_user(update["message"]["from"])
-        command = shlex.split(update["message"]["text"])
+    @_with_admin
+    def _cmd_delivery(self, session, tg, message):
+        self.echo(
+            tg,
+            message,
+            str(session.broadcast_status or "No broadcast yet."),
+        )
+        return True
 
-        if len(command) < 1 or command[0] != "/passcode":
-            return False
 
-        if len(command) < 2:
-            return self.command_failed(tg, update["message"])
-        else:
-            try:
-                cmd_method = "_cmd_" + command[1]
-                return getattr(self, cmd_method)(tg, update["message"], *command[2:])
-            except Exception as e:
-                return self.command_failed(tg, update["message"], text = str(e))
+    @_with_admin
+    def _cmd_transport(self, session, tg, message):
+        self.echo(
+            tg,
+            message,
+            "\n".join(f"{key}: {value}" for key, value in sorted(tg.get_stats().items())),
+        )
+        return True
+
+
+    @_with_admin
+    def _cmd_locks(self, session, tg, message, state = None):
+        if state == "on":
+            TRACER.reset()
+            TRACER.enable()
+        elif state == "off":
+            TRACER.disable()
+        elif state is not None:
+            return self.command_failed(tg, message)
+        # Telegram caps a message at 4096 characters.
+        self.echo(tg, message, TRACER.summary()[:4096])
+        return True
+
+
+    def _cmd_session(self, session, tg, message, name = None):
+        if name is None:
+            self.echo(tg, message, MESSAGE_SESSION.format(session.name))
+            return True
+        if not SESSION_NAME_PATTERN.fullmatch(name):
+            return self.command_failed(tg, message, "session name invalid")
+        # Anyone picks an existing session for their own chat; groups follow
+        # the admin, who is also the only one to start new sessions.
+        if str(message["from"]["id"]) != self.admin_uid:
+            if message["chat"].get("type", "private") != "private":
+                return self.command_failed(tg, message)
+            if not self.session_exists(name):
+                return self.command_failed(tg, message, "session not found")
+        self.session_bindings.bind(message["chat"]["id"], name)
+        self.echo(tg, message, MESSAGE_SESSION.format(name))
+        return True
+
+
+    def handle(self, tg, update, session_name = None):
+        # Routed updates only: the router has checked the message shape and
+        # that the text starts with `/passcode`.
+        message = update["message"]
+        try:
+            command = shlex.split(message["text"])
+        except ValueError as e:
+            return self.command_failed(tg, message, text = str(e))
+        if len(command) < 2 or not command[1] in self.commands:
+            return self.command_failed(tg, message)
+        # Workers get the session from the ingestor, which routed the update
+        # by it; otherwise it follows the chat's binding.
+        if session_name is None:
+            session_name = self.session_bindings.get(message["chat"]["id"])
+        session = self.get_session(session_name)
+        with session.lock.site("add_user"):
+            session.passcode_data.add_user(message["from"])
+        try:
+            return self.commands[command[1]](session, tg, message, *command[2:])
+        except Exception as e:
+            return self.command_failed(tg, message, text = str(e))
 
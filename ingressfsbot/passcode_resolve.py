@@ -10,6 +10,11 @@ import json
 
 import httpx
 
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from threading import Lock
+
 from PIL import Image
 from PIL import ImageDraw
 from PIL import ImageFont
@@ -42,19 +47,134 @@ def generate_passcode_string(patt, reports):
     return "".join(patt_list)
 
 
-def generate_passcode_image(url, reports, file_image_dump, file_image_dump_format, x_offset=640, y_offset=145, y_height=300):
+FONT_NAME = "simhei"
+BASE_IMAGE_TTL = 300
+OUTPUT_CACHE_SIZE = 8
+WARM_FONT_SIZES = (300 * 0.6,)
+
+_cache_lock = Lock()
+_base_images = {}
+_outputs = OrderedDict()
+_worker_images = {}
+
+
+@dataclass
+class BaseImage:
+    content: bytes
+    version: int
+    etag: str | None
+    last_modified: str | None
+    time_checked: float
+    image: Image.Image | None = None
+
+
+def _decode(content):
+    with Image.open(io.BytesIO(content)) as im:
+        return im.copy()
+
+
+def get_base_image(url, ttl=BASE_IMAGE_TTL):
+    # Fetched once per URL, then revalidated with a conditional request at
+    # most every `ttl` seconds.
+    with _cache_lock:
+        base = _base_images.get(url)
+    if base and time.time() < base.time_checked + ttl:
+        return base
+    headers = {}
+    if base and base.etag:
+        headers["if-none-match"] = base.etag
+    if base and base.last_modified:
+        headers["if-modified-since"] = base.last_modified
+    resp = httpx.get(url, headers=headers)
+    if base and resp.status_code == 304:
+        base.time_checked = time.time()
+        return base
+    resp.raise_for_status()
+    base = BaseImage(
+        content=resp.content,
+        version=(base.version + 1) if base else 0,
+        etag=resp.headers.get("etag"),
+        last_modified=resp.headers.get("last-modified"),
+        time_checked=time.time(),
+    )
+    logger.info(f"Fetched passcode image {url}.")
+    with _cache_lock:
+        _base_images[url] = base
+    return base
+
+
+@lru_cache(maxsize=16)
+def get_font(size):
+    return ImageFont.truetype(FONT_NAME, size=size)
+
+
+def warm_worker(font_name=FONT_NAME, sizes=WARM_FONT_SIZES):
+    # Initializer for render processes, so the first job does not pay for
+    # loading the font.
+    global FONT_NAME
+    FONT_NAME = font_name
+    for size in sizes:
+        get_font(size)
+
+
+def _draw(image, reports, file_image_dump_format, x_offset, y_offset, y_height):
+    im = image.copy()
+    font = get_font(y_height * 0.6)
+    draw = ImageDraw.Draw(im)
+    for _index, _name, _media in reports:
+        if len(_name) > 10:
+            _name = _name[:8] + "..."
+        text = f"{_name} : {_media}"
+        x = x_offset
+        y = y_offset + y_height * (int(_index) - 1 + 0.2)
+        draw.text((x, y), text=text, fill=(255, 0, 0), font=font)
     im_io = io.BytesIO()
-    with Image.open(io.BytesIO(httpx.get(url).content)) as im:
-        font = ImageFont.truetype("simhei", size=y_height * 0.6)
-        draw = ImageDraw.Draw(im)
-        for _index, _name, _media in reports:
-            if len(_name) > 10:
-                _name = _name[:8] + "..."
-            text = f"{_name} : {_media}"
-            x = x_offset
-            y = y_offset + y_height * (int(_index) - 1 + 0.2)
-            draw.text((x, y), text=text, fill=(255, 0, 0), font=font)
-        im.save(im_io, format=file_image_dump_format)
-        im.save(file_image_dump)
-    return im_io
+    im.save(im_io, format=file_image_dump_format)
+    return im_io.getvalue()
+
+
+def draw_passcode_image(key, content, reports, file_image_dump_format, x_offset, y_offset, y_height):
+    # Runs in a render process: only bytes and plain tuples cross the
+    # process boundary; the decoded base image stays cached per worker.
+    image = _worker_images.get(key)
+    if image is None:
+        _worker_images.clear()
+        image = _worker_images[key] = _decode(content)
+    return _draw(image, reports, file_image_dump_format, x_offset, y_offset, y_height)
+
+
+def render_passcode_image(url, reports, file_image_dump_format, x_offset=640, y_offset=145, y_height=300, executor=None):
+    base = get_base_image(url)
+    key = (url, base.version, tuple(reports), file_image_dump_format, x_offset, y_offset, y_height)
+    with _cache_lock:
+        if key in _outputs:
+            _outputs.move_to_end(key)
+            return _outputs[key]
+    if executor is None:
+        if base.image is None:
+            base.image = _decode(base.content)
+        data = _draw(base.image, reports, file_image_dump_format, x_offset, y_offset, y_height)
+    else:
+        data = executor.submit(
+            draw_passcode_image,
+            (url, base.version),
+            base.content,
+            tuple(reports),
+            file_image_dump_format,
+            x_offset,
+            y_offset,
+            y_height,
+        ).result()
+    with _cache_lock:
+        _outputs[key] = data
+        while len(_outputs) > OUTPUT_CACHE_SIZE:
+            _outputs.popitem(last=False)
+    return data
+
 
+def generate_passcode_image(url, reports, file_image_dump, file_image_dump_format, x_offset=640, y_offset=145, y_height=300, executor=None):
+    data = render_passcode_image(url, reports, file_image_dump_format, x_offset, y_offset, y_height, executor)
+    # The same encoded bytes go to disk and to the upload.
+    with open(file_image_dump, "wb") as fp:
+        fp.write(data)
+    return io.BytesIO(data)
@@ -0,0 +1,158 @@
+# -*- coding=utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+
+import json
+import os
+import re
+import time
+
+from threading import Lock
+
+from . import metrics
+from . import passcode_data
+from . import passcode_storage
+from .locktrace import TracedLock
+
+from ._config import (
+    CONF_PASSCODE_DATA_FILE_DEFAULT,
+    CONF_PASSCODE_IMAGE_FILE_DEFAULT,
+    CONF_PASSCODE_BACKEND_DEFAULT,
+    CONF_PASSCODE_SESSIONS_FILE_DEFAULT,
+    CONF_PASSCODE_HISTORY_DEFAULT,
+    CONF_PASSCODE_HISTORY_LIMIT_DEFAULT,
+    CONF_PASSCODE_ARCHIVE_FILE_DEFAULT,
+    CONF_PASSCODE_HISTORY_ARCHIVE,
+)
+
+
+SESSION_DEFAULT = "default"
+SESSION_NAME_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,32}")
+
+
+def session_file(filename, name):
+    # The default session keeps the configured file names, so existing data
+    # is picked up as is; other sessions get `<root>.<name><ext>`.
+    if name == SESSION_DEFAULT:
+        return filename
+    root, ext = os.path.splitext(filename)
+    return f"{root}.{name}{ext}"
+
+
+
+
+class SessionBindings:
+
+    # Chat id to session name, kept in `sessions_file`. The file is read
+    # again whenever it changes on disk, so an ingestor and several workers
+    # all follow the bindings made by whichever worker ran the command.
+
+    def __init__(self, sessions_file = CONF_PASSCODE_SESSIONS_FILE_DEFAULT) -> None:
+        self.sessions_file = sessions_file
+        self.lock = Lock()
+        self.bindings = {}
+        self.mtime = None
+        self._reload()
+
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.sessions_file).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self.mtime:
+            return
+        with open(self.sessions_file, "r") as fp:
+            self.bindings = json.load(fp)
+        self.mtime = mtime
+
+
+    def get(self, chat_id):
+        with self.lock:
+            self._reload()
+            return self.bindings.get(str(chat_id), SESSION_DEFAULT)
+
+
+    def names(self):
+        with self.lock:
+            self._reload()
+            return {SESSION_DEFAULT, *self.bindings.values()}
+
+
+    def bind(self, chat_id, name):
+        with self.lock:
+            self._reload()
+            if name == SESSION_DEFAULT:
+                self.bindings.pop(str(chat_id), None)
+            else:
+                self.bindings[str(chat_id)] = name
+            passcode_data.write(self.sessions_file, json.dumps(self.bindings))
+
+
+
+
+class PasscodeSession:
+
+    def __init__(
+        self,
+        name = SESSION_DEFAULT,
+        data_file = CONF_PASSCODE_DATA_FILE_DEFAULT,
+        image_file = CONF_PASSCODE_IMAGE_FILE_DEFAULT,
+        backend = CONF_PASSCODE_BACKEND_DEFAULT,
+        storage_args: dict | None = None,
+        history = CONF_PASSCODE_HISTORY_DEFAULT,
+        history_limit = CONF_PASSCODE_HISTORY_LIMIT_DEFAULT,
+        archive_file = CONF_PASSCODE_ARCHIVE_FILE_DEFAULT,
+    ) -> None:
+        self.name = name
+        self.data_file = session_file(data_file, name)
+        self.image_file = session_file(image_file, name)
+        self.lock = TracedLock("data")
+        self.broadcast_lock = TracedLock("broadcast")
+
+        storage_args = dict(storage_args or {})
+        if storage_args.get("journal_file"):
+            storage_args["journal_file"] = session_file(storage_args["journal_file"], name)
+        self.storage = passcode_storage.open_storage(backend, self.data_file, **storage_args)
+        self.passcode_data = self.storage.load()
+        self.archive = None
+        if history == CONF_PASSCODE_HISTORY_ARCHIVE:
+            self.archive = passcode_storage.ReportArchive(session_file(archive_file, name))
+        self.passcode_data.set_history(history, history_limit, self.archive)
+        for user in self.passcode_data.get_trustable_users():
+            self.passcode_data.add_trusted_user(user)
+        self.passcode_data.publish()
+
+        self.cache_reports_last_broadcast_submit = ()
+        self.cache_reports_last_broadcast_send = ()
+        self.broadcast_count = 0
+        self.broadcast_status = None
+        self.time_last_used = time.time()
+        logger.info(f"Loaded passcode session {name} from {self.data_file}.")
+
+
+    def dump(self):
+        logger.info(f"Dumping data to {self.data_file}.")
+        t0 = time.perf_counter()
+        archived = None
+        with self.lock.site("dump"):
+            payload = self.storage.serialize(self.passcode_data)
+            # Without a payload nothing is snapshotted, the trimmed reports
+            # are still in the data file or the journal.
+            if self.archive is not None and payload is not None:
+                archived = self.archive.take()
+        if archived:
+            self.archive.write(archived)
+        self.storage.write(payload)
+        metrics.DUMP_SECONDS.observe(time.perf_counter() - t0, self.name)
+        if os.path.exists(self.data_file):
+            metrics.DUMP_BYTES.set(os.path.getsize(self.data_file), self.name)
+
+
+    def close(self):
+        self.dump()
+        self.storage.close()
+        if self.archive is not None:
+            self.archive.close()
+        logger.info(f"Unloaded passcode session {self.name}.")
@@ -0,0 +1,413 @@
+# -*- coding=utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+
+import json
+import sqlite3
+import time
+
+from threading import Lock
+
+import click
+
+from . import passcode_data
+from .passcode_data import PasscodeData
+from .passcode_data import PasscodeSnapshot
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key             TEXT PRIMARY KEY,
+    value           TEXT
+);
+CREATE TABLE IF NOT EXISTS users (
+    uid             TEXT PRIMARY KEY,
+    username        TEXT,
+    info            TEXT
+);
+CREATE INDEX IF NOT EXISTS users_username ON users (username);
+CREATE TABLE IF NOT EXISTS reports (
+    uid             TEXT,
+    idx             TEXT,
+    time            REAL,
+    name            TEXT,
+    media           TEXT
+);
+CREATE INDEX IF NOT EXISTS reports_uid_idx ON reports (uid, idx);
+CREATE TABLE IF NOT EXISTS votes (
+    uid             TEXT,
+    idx             TEXT,
+    name            TEXT,
+    media           TEXT,
+    media_lower     TEXT,
+    PRIMARY KEY (uid, idx)
+);
+CREATE INDEX IF NOT EXISTS votes_idx_media ON votes (idx, media);
+CREATE TABLE IF NOT EXISTS trusted (
+    uid             TEXT PRIMARY KEY
+);
+"""
+
+META_FIELDS = ("passcode_url", "passcode_patt", "min_correct", "min_count", "min_rate")
+
+
+
+def connect(filename):
+    conn = sqlite3.connect(filename, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA)
+    return conn
+
+
+
+
+class SqlitePasscodeData:
+
+    def __init__(self, conn) -> None:
+        self.conn = conn
+        self.db_lock = Lock()
+        self.journal = None
+        meta = dict(self._query("SELECT key, value FROM meta"))
+        self.passcode_url = json.loads(meta.get("passcode_url", '""'))
+        self.passcode_patt = json.loads(meta.get("passcode_patt", '""'))
+        self.min_correct = json.loads(meta.get("min_correct", json.dumps(PasscodeData.min_correct)))
+        self.min_count = json.loads(meta.get("min_count", json.dumps(PasscodeData.min_count)))
+        self.min_rate = json.loads(meta.get("min_rate", json.dumps(PasscodeData.min_rate)))
+        # `data_version` moves when another connection commits, so several
+        # processes sharing the file still see each other's writes.
+        self._generation = 0
+        self._data_version = None
+        self._trustable = None
+        self.snapshot = PasscodeSnapshot(generation=-1)
+        self.publish()
+
+
+    def _query(self, sql, args=()):
+        with self.db_lock:
+            return self.conn.execute(sql, args).fetchall()
+
+
+    def _execute(self, sql, args=()):
+        with self.db_lock:
+            changes = self.conn.execute(sql, args).rowcount
+        if changes:
+            self._generation += 1
+            self._trustable = None
+        return changes
+
+
+    def _set_meta(self, key, value):
+        self._execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            (key, json.dumps(value)),
+        )
+
+
+    def _version(self):
+        data_version = self._query("PRAGMA data_version")[0][0]
+        if data_version != self._data_version:
+            self._data_version = data_version
+            self._generation += 1
+            self._trustable = None
+            meta = dict(self._query("SELECT key, value FROM meta"))
+            if "passcode_url" in meta:
+                self.passcode_url = json.loads(meta["passcode_url"])
+            if "passcode_patt" in meta:
+                self.passcode_patt = json.loads(meta["passcode_patt"])
+        return self._generation
+
+
+    def publish(self):
+        generation = self._version()
+        if self.snapshot.generation == generation:
+            return self.snapshot
+        trustable_reports, trustable_users = self.get_trustable()
+        trusted_users = self.get_trusted_users()
+        self.snapshot = PasscodeSnapshot(
+            generation=generation,
+            passcode_url=self.passcode_url,
+            passcode_patt=self.passcode_patt,
+            trustable_reports=tuple(trustable_reports),
+            trustable_users=tuple(trustable_users),
+            trusted_users=tuple(trusted_users),
+            trusted_uids=frozenset(str(user["id"]) for user in trusted_users),
+        )
+        return self.snapshot
+
+
+    def set_passcode_url(self, url):
+        self.passcode_url = url
+        self._set_meta("passcode_url", url)
+
+
+    def set_passcode_patt(self, patt):
+        self.passcode_patt = patt
+        self._set_meta("passcode_patt", patt)
+
+
+    def add_user(self, user):
+        uid = str(user["id"])
+        info = json.dumps(user, sort_keys=True)
+        self._execute(
+            "INSERT INTO users (uid, username, info) VALUES (?, ?, ?) "
+            "ON CONFLICT (uid) DO UPDATE SET username = excluded.username, info = excluded.info "
+            "WHERE info != excluded.info",
+            (uid, user.get("username"), info),
+        )
+
+
+    def add_report(self, user, index, name, media, t=None):
+        uid = str(user["id"])
+        t = time.time() if t is None else t
+        with self.db_lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.execute(
+                    "INSERT INTO reports (uid, idx, time, name, media) VALUES (?, ?, ?, ?, ?)",
+                    (uid, index, t, name, media),
+                )
+                changes = self.conn.execute(
+                    "INSERT INTO votes (uid, idx, name, media, media_lower) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (uid, idx) DO UPDATE SET "
+                    "name = excluded.name, media = excluded.media, media_lower = excluded.media_lower "
+                    "WHERE name != excluded.name OR media != excluded.media",
+                    (uid, index, name, media, media.lower()),
+                ).rowcount
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        if changes:
+            self._generation += 1
+            self._trustable = None
+
+
+    def set_history(self, history, limit = 1, archive = None):
+        # Reports stay in the database and never load into memory, keeping
+        # all of them costs neither memory nor dump time.
+        pass
+
+
+    def add_trusted_user(self, user):
+        uid = str(user["id"])
+        self._execute("INSERT OR IGNORE INTO trusted (uid) VALUES (?)", (uid,))
+
+
+    def get_passcode_url(self):
+        return self.passcode_url
+
+
+    def get_passcode_patt(self):
+        return self.passcode_patt
+
+
+    def get_user(self, uid):
+        rows = self._query("SELECT info FROM users WHERE uid = ?", (uid,))
+        if rows:
+            return json.loads(rows[0][0])
+
+
+    def get_user_by_username(self, username):
+        rows = self._query("SELECT info FROM users WHERE username = ?", (username,))
+        if rows:
+            return json.loads(rows[0][0])
+
+
+    def get_user_trusted(self, user):
+        uid = str(user["id"])
+        return bool(self._query("SELECT 1 FROM trusted WHERE uid = ?", (uid,)))
+
+
+    def get_user_trustable(self, user):
+        uid = str(user["id"])
+        _, trustable_users = self.get_trustable()
+        return any(str(_user["id"]) == uid for _user in trustable_users)
+
+
+    def get_user_reports(self, user):
+        uid = str(user["id"])
+        return [
+            tuple(row) for row in self._query(
+                "SELECT idx, name, media FROM votes WHERE uid = ? ORDER BY idx, name, media",
+                (uid,),
+            )
+        ]
+
+
+    def get_trusted_users(self):
+        return [
+            json.loads(info) for info, in self._query(
+                "SELECT users.info FROM trusted JOIN users USING (uid) ORDER BY trusted.rowid"
+            )
+        ]
+
+
+    def get_trustable(self):
+        self._version()
+        if self._trustable is None:
+            trustable_reports = self._trustable_reports()
+            self._trustable = trustable_reports, self._trustable_users(trustable_reports)
+        trustable_reports, trustable_users = self._trustable
+        return list(trustable_reports), list(trustable_users)
+
+
+    def get_trustable_users(self):
+        _, trustable_users = self.get_trustable()
+        return trustable_users
+
+
+    def get_trustable_reports(self):
+        trustable_reports, _ = self.get_trustable()
+        return trustable_reports
+
+
+    def _trustable_reports(self):
+        totals = dict(self._query("SELECT idx, COUNT(*) FROM votes GROUP BY idx"))
+        # Most voted value first; ties go to "", then to the value voted on
+        # earliest, as in PasscodeData.
+        trustable_names = {}
+        for index, name, count in self._query(
+            "SELECT idx, name, COUNT(*) AS n FROM votes GROUP BY idx, name "
+            "ORDER BY idx, n DESC, name = '' DESC, MIN(rowid)"
+        ):
+            if index in trustable_names:
+                continue
+            trustable_names[index] = ""
+            if count >= self.min_count and count >= self.min_rate * totals[index]:
+                trustable_names[index] = name
+        trustable_medias = {}
+        for index, media, count in self._query(
+            "SELECT idx, media, COUNT(*) AS n FROM votes GROUP BY idx, media "
+            "ORDER BY idx, n DESC, media = '' DESC, MIN(rowid)"
+        ):
+            if index in trustable_medias:
+                continue
+            trustable_medias[index] = ""
+            if count >= self.min_count and count > self.min_rate * totals[index]:
+                trustable_medias[index] = media
+        trustable_reports = []
+        for index in totals:
+            _name = trustable_names.get(index, "")
+            _media = trustable_medias.get(index, "")
+            if _name or _media:
+                trustable_reports.append((index, _name, _media))
+        return sorted(trustable_reports)
+
+
+    def _trustable_users(self, trustable_reports):
+        if not trustable_reports:
+            return []
+        consensus = ", ".join("(?, ?)" for _ in trustable_reports)
+        args = []
+        for _index, _name, _media in trustable_reports:
+            args += [_index, _media.lower()]
+        args.append(self.min_correct)
+        return [
+            json.loads(info) for _, info in self._query(
+                f"WITH consensus (idx, media_lower) AS (VALUES {consensus}) "
+                "SELECT votes.uid, users.info FROM votes "
+                "JOIN consensus USING (idx, media_lower) "
+                "JOIN users USING (uid) "
+                "GROUP BY votes.uid HAVING COUNT(*) > ? "
+                "ORDER BY (SELECT MIN(rowid) FROM reports WHERE reports.uid = votes.uid)",
+                args,
+            )
+        ]
+
+
+
+
+class SqliteStorage:
+
+    def __init__(self, data_file) -> None:
+        self.data_file = data_file
+        self.conn = None
+
+
+    def load(self):
+        self.conn = connect(self.data_file)
+        return SqlitePasscodeData(self.conn)
+
+
+    def serialize(self, data):
+        # Every mutation is committed as it happens; a dump only folds the
+        # WAL back into the database file.
+        with data.db_lock:
+            self.conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        return None
+
+
+    def write(self, payload):
+        pass
+
+
+    def close(self):
+        if self.conn:
+            self.conn.close()
+            self.conn = None
+
+
+
+
+def migrate(json_file, db_file):
+    # Safe to run again: a user's reports and votes are replaced, not added
+    # to, and nothing is kept from a run that failed halfway.
+    data = passcode_data.load(json_file)
+    conn = connect(db_file)
+    try:
+        conn.execute("BEGIN")
+        _migrate(conn, data)
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return data
+
+
+def _migrate(conn, data):
+    for key in META_FIELDS:
+        conn.execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            (key, json.dumps(getattr(data, key))),
+        )
+    for uid, user in data.user_info.items():
+        conn.execute(
+            "INSERT OR REPLACE INTO users (uid, username, info) VALUES (?, ?, ?)",
+            (uid, user.get("username"), json.dumps(user, sort_keys=True)),
+        )
+    for uid, reports in data.user_reports.items():
+        conn.execute("DELETE FROM reports WHERE uid = ?", (uid,))
+        conn.execute("DELETE FROM votes WHERE uid = ?", (uid,))
+        for index, history in reports.items():
+            conn.executemany(
+                "INSERT INTO reports (uid, idx, time, name, media) VALUES (?, ?, ?, ?, ?)",
+                [(uid, index, report.time, report.name, report.media) for report in history],
+            )
+            if history:
+                conn.execute(
+                    "INSERT INTO votes (uid, idx, name, media, media_lower) VALUES (?, ?, ?, ?, ?)",
+                    (uid, index, history[-1].name, history[-1].media, history[-1].media.lower()),
+                )
+    for uid in data.user_trusted:
+        conn.execute("INSERT OR IGNORE INTO trusted (uid) VALUES (?)", (uid,))
+
+
+
+
+@click.command()
+@click.argument("json_file",    type=click.Path(exists=True, dir_okay=False))
+@click.argument("db_file",      type=click.Path(dir_okay=False))
+def cli(json_file, db_file):
+    data = migrate(json_file, db_file)
+    click.echo(f"Migrated {len(data.user_info)} users and {len(data.user_reports)} reporters to {db_file}.")
+
+
+if __name__ == "__main__":
+    cli()
+
@@ -0,0 +1,239 @@
+# -*- coding=utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+
+import glob
+import json
+import os
+import time
+
+from threading import Lock
+
+from . import passcode_data
+from .passcode_sqlite import SqliteStorage
+
+from ._config import (
+    CONF_PASSCODE_BACKEND_JSON,
+    CONF_PASSCODE_BACKEND_JOURNAL,
+    CONF_PASSCODE_BACKEND_SQLITE,
+    CONF_PASSCODE_JOURNAL_FSYNC_DEFAULT,
+    CONF_PASSCODE_SNAPSHOT_INTERVAL_DEFAULT,
+)
+
+
+JOURNAL_SEQ = "journal_seq"
+JOURNAL_SUFFIX = ".journal"
+
+
+
+class JsonStorage:
+
+    def __init__(self, data_file) -> None:
+        self.data_file = data_file
+        self.write_lock = Lock()
+        self.serial = 0
+        self.written = 0
+
+
+    def load(self):
+        if not os.path.exists(self.data_file):
+            passcode_data.dump(self.data_file, passcode_data.PasscodeData())
+        return passcode_data.load(self.data_file)
+
+
+    def serialize(self, data):
+        # Under the data lock: only a copy, turned into text by `write`.
+        self.serial += 1
+        return self.serial, passcode_data.copy_data(data)
+
+
+    def write(self, payload):
+        serial, obj = payload
+        if serial <= self.written:
+            return
+        text = json.dumps(passcode_data.as_json(obj))
+        with self.write_lock:
+            # Dumps may finish out of order, never let an older one win.
+            if serial <= self.written:
+                return
+            passcode_data.write(self.data_file, text)
+            self.written = serial
+
+
+    def close(self):
+        pass
+
+
+
+
+class JournalStorage(JsonStorage):
+
+    def __init__(
+        self,
+        data_file,
+        journal_file = None,
+        journal_fsync = CONF_PASSCODE_JOURNAL_FSYNC_DEFAULT,
+        snapshot_interval = CONF_PASSCODE_SNAPSHOT_INTERVAL_DEFAULT,
+    ) -> None:
+        super().__init__(data_file)
+        self.journal_file = journal_file or data_file + JOURNAL_SUFFIX
+        self.journal_fsync = journal_fsync
+        self.snapshot_interval = snapshot_interval
+        self.journal_lock = Lock()
+        self.journal_fp = None
+        self.seq = 0
+        self.cache_time_last_snapshot = 0
+
+
+    def _segments(self):
+        segments = []
+        for filename in glob.glob(glob.escape(self.journal_file) + ".*"):
+            suffix = filename[len(self.journal_file) + 1:]
+            if suffix.isdigit():
+                segments.append((int(suffix), filename))
+        return [filename for _, filename in sorted(segments)]
+
+
+    def _replay(self, data, filename, seq):
+        with open(filename, "r") as fp:
+            for line in fp:
+                try:
+                    _seq, op, args = json.loads(line)
+                except ValueError:
+                    # A torn tail from a crash mid-append, nothing after it
+                    # was acknowledged.
+                    logger.warning(f"Skipped a broken journal entry in {filename}.")
+                    continue
+                if _seq <= seq:
+                    continue
+                getattr(data, op)(*args)
+                self.seq = max(self.seq, _seq)
+
+
+    def load(self):
+        seq = 0
+        if os.path.exists(self.data_file):
+            with open(self.data_file, "r") as fp:
+                obj = json.load(fp)
+            seq = obj.pop(JOURNAL_SEQ, 0)
+            data = passcode_data.from_dict(obj)
+        else:
+            data = passcode_data.PasscodeData()
+        self.seq = seq
+        for filename in self._segments() + [self.journal_file]:
+            if os.path.exists(filename):
+                self._replay(data, filename, seq)
+        logger.info(f"Replayed journal {self.journal_file} up to #{self.seq}.")
+
+        self.journal_fp = open(self.journal_file, "a")
+        data.journal = self
+        # Start from a clean snapshot, which also drops any torn entry so
+        # later appends never follow a broken line.
+        self.write(self.serialize(data, force=True))
+        return data
+
+
+    def append(self, op, *args):
+        with self.journal_lock:
+            self.seq += 1
+            self.journal_fp.write(json.dumps([self.seq, op, args]) + "\n")
+            self.journal_fp.flush()
+            if self.journal_fsync:
+                os.fsync(self.journal_fp.fileno())
+
+
+    def serialize(self, data, force=False):
+        # Between snapshots a dump is only a journal sync; the journal
+        # already holds every mutation.
+        now = time.time()
+        if not force and now < self.cache_time_last_snapshot + self.snapshot_interval:
+            with self.journal_lock:
+                self.journal_fp.flush()
+                os.fsync(self.journal_fp.fileno())
+            return None
+        self.cache_time_last_snapshot = now
+        with self.journal_lock:
+            seq = self.seq
+            # Seal the current journal as a segment; entries after `seq`
+            # go to a fresh file and survive the compaction below.
+            self.journal_fp.close()
+            os.replace(self.journal_file, f"{self.journal_file}.{seq}")
+            self.journal_fp = open(self.journal_file, "a")
+        obj = passcode_data.copy_data(data)
+        obj[JOURNAL_SEQ] = seq
+        self.serial += 1
+        return self.serial, obj, seq
+
+
+    def write(self, payload):
+        if payload is None:
+            return
+        serial, obj, seq = payload
+        super().write((serial, obj))
+        for filename in self._segments():
+            if int(filename[len(self.journal_file) + 1:]) <= seq:
+                os.remove(filename)
+
+
+    def close(self):
+        with self.journal_lock:
+            if self.journal_fp:
+                self.journal_fp.close()
+                self.journal_fp = None
+
+
+
+
+class ReportArchive:
+
+    # Reports pushed out of memory by the history policy, one JSON line
+    # each. They are only held here until the next snapshot of the data
+    # file: that is when they actually leave it, and they are written out
+    # right before it. Trimmed again after a restart from an older snapshot
+    # or a journal, they are still pending, so nothing is archived twice.
+
+    def __init__(self, archive_file) -> None:
+        self.archive_file = archive_file
+        self.lock = Lock()
+        self.pending = []
+        self.fp = open(archive_file, "a")
+
+
+    def append(self, uid, index, reports):
+        with self.lock:
+            self.pending.extend((uid, index, report) for report in reports)
+
+
+    def take(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+            return pending
+
+
+    def write(self, entries):
+        if not entries:
+            return
+        with self.lock:
+            for uid, index, report in entries:
+                self.fp.write(json.dumps([uid, index, *report]) + "\n")
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+
+
+    def close(self):
+        with self.lock:
+            self.fp.close()
+
+
+
+
+def open_storage(backend, data_file, **kwargs):
+    if backend == CONF_PASSCODE_BACKEND_JOURNAL:
+        return JournalStorage(data_file, **kwargs)
+    if backend == CONF_PASSCODE_BACKEND_SQLITE:
+        return SqliteStorage(data_file)
+    if backend != CONF_PASSCODE_BACKEND_JSON:
+        raise ValueError(f"Unknown passcode backend {backend}.")
+    return JsonStorage(data_file)
+
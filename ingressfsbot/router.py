@@ -0,0 +1,137 @@
+# -*- coding=utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+
+import inspect
+import time
+
+from dataclasses import dataclass
+from threading import Lock
+from typing import Callable
+
+from . import metrics
+
+
+@dataclass
+class Route:
+    command: str
+    fn: Callable | None
+    subcommands: frozenset = frozenset()
+
+
+@dataclass
+class RouteStats:
+    count: int = 0
+    errors: int = 0
+    time_total: float = 0
+    time_max: float = 0
+
+
+    def __str__(self):
+        mean = self.time_total / self.count if self.count else 0
+        return (
+            f"{self.count} calls, {self.errors} errors, "
+            f"mean {mean * 1000:.1f}ms, max {self.time_max * 1000:.1f}ms"
+        )
+
+
+
+
+class Router:
+
+    # Sits in front of the handlers: an update is matched on the first word
+    # of its text alone, so chatter never gets tokenized or touches any
+    # handler state. Handlers and their subcommands are registered once.
+
+    def __init__(self) -> None:
+        self.routes: dict[str, Route] = {}
+        self.hooks: list[Callable] = []
+        self.stats_lock = Lock()
+        self.stats: dict[str, RouteStats] = {}
+
+
+    def register(self, command, fn, subcommands = ()):
+        self.routes[command] = Route(command, fn, frozenset(subcommands))
+
+
+    def add_hook(self, hook):
+        # Called as `hook(name, elapsed, error)` after every routed update.
+        self.hooks.append(hook)
+
+
+    def route(self, update):
+        route = self._match(update)
+        metrics.UPDATES.inc(route.command if route else "")
+        return route
+
+
+    def _match(self, update):
+        message = update.get("message")
+        if not message or not message.get("chat") or not message.get("from"):
+            return None
+        text = message.get("text")
+        if not text or text[0] != "/":
+            return None
+        # `/command@botname` is how commands are addressed in groups.
+        command = text.split(None, 1)[0].split("@", 1)[0]
+        return self.routes.get(command)
+
+
+    def _name(self, route, update):
+        if route.subcommands:
+            words = update["message"]["text"].split(None, 2)
+            if len(words) > 1 and words[1] in route.subcommands:
+                return f"{route.command} {words[1]}"
+        return route.command
+
+
+    def _record(self, name, elapsed, error):
+        with self.stats_lock:
+            stats = self.stats.get(name)
+            if stats is None:
+                stats = self.stats[name] = RouteStats()
+            stats.count += 1
+            stats.errors += error is not None
+            stats.time_total += elapsed
+            stats.time_max = max(stats.time_max, elapsed)
+        for hook in self.hooks:
+            try:
+                hook(name, elapsed, error)
+            except Exception as e:
+                logger.error(f"Failed running router hook {hook}.")
+                logger.debug(e, stack_info=True)
+
+
+    def call(self, route, tg, update, **kwargs):
+        t0 = time.perf_counter()
+        error = None
+        try:
+            return route.fn(tg, update, **kwargs)
+        except Exception as e:
+            error = e
+            logger.error(f"Failed handling {route.command}.")
+            logger.debug(e, stack_info=True)
+        finally:
+            self._record(self._name(route, update), time.perf_counter() - t0, error)
+
+
+    async def call_async(self, route, tg, update, **kwargs):
+        t0 = time.perf_counter()
+        error = None
+        try:
+            result = route.fn(tg, update, **kwargs)
+            if inspect.isawaitable(result):
+                result = await result
+            return result
+        except Exception as e:
+            error = e
+            logger.error(f"Failed handling {route.command}.")
+            logger.debug(e, stack_info=True)
+        finally:
+            self._record(self._name(route, update), time.perf_counter() - t0, error)
+
+
+    def get_stats(self):
+        with self.stats_lock:
+            return {name: RouteStats(**vars(stats)) for name, stats in sorted(self.stats.items())}
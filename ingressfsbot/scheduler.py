@@ -0,0 +1,145 @@
+# -*- coding=utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+
+import heapq
+import itertools
+import time
+
+from concurrent.futures import Executor
+from dataclasses import dataclass
+from threading import Condition
+from threading import Thread
+from typing import Callable
+
+
+
+@dataclass
+class Job:
+    key: str
+    fn: Callable
+    due: float
+    deadline: float
+    seq: int
+    flush: bool = False
+
+
+
+
+class Scheduler:
+
+    # A single timer thread keeps every pending job; due jobs are handed to
+    # `executor`, so nothing ever sleeps on a pool worker.
+
+    def __init__(self, executor: Executor | None = None, name = "Scheduler") -> None:
+        self.executor = executor
+        self.cond = Condition()
+        self.jobs: dict[str, Job] = {}
+        self.heap = []
+        self.counter = itertools.count()
+        self.closed = False
+        self.thread = Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+
+    def _push(self, job):
+        self.jobs[job.key] = job
+        heapq.heappush(self.heap, (job.due, job.seq, job.key))
+        self.cond.notify()
+
+
+    def schedule(self, key, fn, delay, flush = False):
+        with self.cond:
+            if self.closed:
+                return
+            due = time.monotonic() + delay
+            self._push(Job(key, fn, due, due, next(self.counter), flush))
+
+
+    def debounce(self, key, fn, delay, max_wait = None, flush = False):
+        # Trailing edge: every call pushes the job back to `delay` from now,
+        # but never past `max_wait` after the call that first queued it.
+        with self.cond:
+            if self.closed:
+                return
+            now = time.monotonic()
+            job = self.jobs.get(key)
+            if job is None:
+                deadline = now + max(delay, max_wait) if max_wait is not None else float("inf")
+            else:
+                deadline = job.deadline
+            due = min(now + delay, deadline)
+            if job is not None and job.due == due:
+                job.fn = fn
+                job.flush = flush
+                return
+            self._push(Job(key, fn, due, deadline, next(self.counter), flush))
+
+
+    def cancel(self, key):
+        with self.cond:
+            # Stale heap entries are skipped by sequence number when popped.
+            return self.jobs.pop(key, None) is not None
+
+
+    def pending(self, key):
+        with self.cond:
+            return key in self.jobs
+
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if self.closed:
+                        return
+                    if self.heap:
+                        due, seq, key = self.heap[0]
+                        job = self.jobs.get(key)
+                        if job is None or job.seq != seq:
+                            heapq.heappop(self.heap)
+                            continue
+                        timeout = due - time.monotonic()
+                        if timeout <= 0:
+                            heapq.heappop(self.heap)
+                            del self.jobs[key]
+                            break
+                    else:
+                        timeout = None
+                    self.cond.wait(timeout)
+            self._submit(job)
+
+
+    def _submit(self, job):
+        try:
+            if self.executor is None:
+                job.fn()
+            else:
+                self.executor.submit(job.fn)
+        except Exception as e:
+            logger.error(f"Failed running scheduled job {job.key}.")
+            logger.debug(e, stack_info=True)
+
+
+    def close(self, flush = True):
+        # Pending jobs marked `flush` run right away in the calling thread.
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            jobs = sorted(self.jobs.values(), key=lambda job: job.due)
+            self.jobs.clear()
+            self.heap.clear()
+            self.cond.notify()
+        self.thread.join()
+        if not flush:
+            return
+        for job in jobs:
+            if not job.flush:
+                continue
+            try:
+                job.fn()
+            except Exception as e:
+                logger.error(f"Failed flushing scheduled job {job.key}.")
+                logger.debug(e, stack_info=True)
@@ -3,21 +3,174 @@
 import logging
 logger = logging.getLogger(__name__)
 
+import asyncio
 import httpx
+import random
+import time
 
+from collections import Counter
 from functools import wraps
+from threading import Lock
 from typing import Any
 
+from httpx._config import DEFAULT_LIMITS
 from httpx._config import DEFAULT_TIMEOUT_CONFIG
+from httpx._config import Timeout
+
+from . import metrics
 
 from ._config import (
     CONF_TELEGRAM_URL_BOT_DEFAULT,
     CONF_TELEGRAM_URL_FILE_DEFAULT,
     CONF_TELEGRAM_USER_AGENT_DEFAULT,
+    CONF_TELEGRAM_RETRIES_DEFAULT,
+    CONF_TELEGRAM_RETRY_BACKOFF_MIN_DEFAULT,
+    CONF_TELEGRAM_RETRY_BACKOFF_MAX_DEFAULT,
+    CONF_TELEGRAM_BREAKER_THRESHOLD_DEFAULT,
+    CONF_TELEGRAM_BREAKER_RESET_DEFAULT,
 )
 
 
-class Telegram:
+class TelegramError(Exception):
+
+    def __init__(self, error_code, description, parameters = None) -> None:
+        super().__init__(f"ERRORCODE {error_code} {description}")
+        self.error_code = error_code
+        self.description = description
+        self.parameters = parameters or {}
+
+
+    @property
+    def retry_after(self):
+        return self.parameters.get("retry_after")
+
+
+class RateLimitError(TelegramError):
+    pass
+
+
+class ClientError(TelegramError):
+    pass
+
+
+class ServerError(TelegramError):
+    pass
+
+
+class NetworkError(TelegramError):
+    pass
+
+
+class CircuitOpenError(TelegramError):
+    pass
+
+
+def _error(error_code, description, parameters = None):
+    if error_code == 429:
+        return RateLimitError(error_code, description, parameters)
+    if error_code is not None and error_code >= 500:
+        return ServerError(error_code, description, parameters)
+    return ClientError(error_code, description, parameters)
+
+
+def _result(resp):
+    try:
+        obj = resp.json()
+    except ValueError:
+        # Proxies and load balancers in front of the API answer in HTML.
+        raise _error(resp.status_code, resp.reason_phrase)
+    if not isinstance(obj, dict) or not isinstance(obj.get("ok"), bool):
+        raise ServerError(resp.status_code, "Malformed response")
+    if not obj["ok"]:
+        raise _error(obj.get("error_code"), obj.get("description"), obj.get("parameters"))
+    if "result" in obj:
+        return obj["result"]
+
+
+# Methods that are safe to repeat when the outcome of a call is unknown.
+IDEMPOTENT_METHODS = {
+    "getUpdates",
+    "getMe",
+    "getFile",
+    "getChat",
+    "getChatMember",
+    "getWebhookInfo",
+    "setWebhook",
+    "deleteWebhook",
+}
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half-open"
+
+
+
+
+class CircuitBreaker:
+
+    # Opens after `threshold` failures in a row, then lets a single probe
+    # through every `reset_timeout` seconds until one succeeds. Only network
+    # and server errors count, a 4xx still proves the API is up.
+
+    def __init__(self, threshold, reset_timeout) -> None:
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.lock = Lock()
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self.probing = False
+        self.time_opened = 0
+
+
+    def _set_state(self, state):
+        if state != self.state:
+            logger.warning(f"Telegram circuit {self.state} -> {state}.")
+            self.state = state
+
+
+    def allow(self):
+        # Returns whether this call is the probe, which has to `release`.
+        with self.lock:
+            if self.state == CIRCUIT_OPEN:
+                remaining = self.time_opened + self.reset_timeout - time.monotonic()
+                if remaining > 0:
+                    raise CircuitOpenError(None, "Circuit open", {"retry_after": remaining})
+                self._set_state(CIRCUIT_HALF_OPEN)
+            if self.state == CIRCUIT_HALF_OPEN:
+                if self.probing:
+                    raise CircuitOpenError(None, "Circuit half-open", {"retry_after": 1})
+                self.probing = True
+                return True
+            return False
+
+
+    def release(self):
+        # A probe that ended in neither success nor failure, like a
+        # cancelled one or a bug on our side, leaves the next call to probe
+        # instead.
+        with self.lock:
+            self.probing = False
+
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.probing = False
+            self._set_state(CIRCUIT_CLOSED)
+
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == CIRCUIT_HALF_OPEN or self.failures >= self.threshold:
+                self.time_opened = time.monotonic()
+                self._set_state(CIRCUIT_OPEN)
+
+
+
+
+class _TelegramBase:
 
     def __init__(
         self,
@@ -26,47 +179,240 @@ class Telegram:
         url_file = CONF_TELEGRAM_URL_FILE_DEFAULT,
         user_agent = CONF_TELEGRAM_USER_AGENT_DEFAULT,
         timeout = DEFAULT_TIMEOUT_CONFIG,
+        limits = DEFAULT_LIMITS,
+        http2 = False,
+        retries = CONF_TELEGRAM_RETRIES_DEFAULT,
+        retry_backoff_min = CONF_TELEGRAM_RETRY_BACKOFF_MIN_DEFAULT,
+        retry_backoff_max = CONF_TELEGRAM_RETRY_BACKOFF_MAX_DEFAULT,
+        breaker_threshold = CONF_TELEGRAM_BREAKER_THRESHOLD_DEFAULT,
+        breaker_reset = CONF_TELEGRAM_BREAKER_RESET_DEFAULT,
     ) -> None:
         self.token = token
         self.url_bot = url_bot
         self.url_file = url_file
         self.user_agent = user_agent
         self.timeout = timeout
+        self.limits = limits
+        self.http2 = http2
+        self.retries = retries
+        self.retry_backoff_min = retry_backoff_min
+        self.retry_backoff_max = retry_backoff_max
+        self.breaker = CircuitBreaker(breaker_threshold, breaker_reset)
+        self.stats_lock = Lock()
+        self.stats = Counter()
+
+
+    def _count(self, key):
+        with self.stats_lock:
+            self.stats[key] += 1
+
+
+    def get_stats(self):
+        with self.stats_lock:
+            stats = dict(self.stats)
+        stats["circuit"] = self.breaker.state
+        stats["circuit_failures"] = self.breaker.failures
+        return stats
+
+
+    def _url(self, method):
+        return self.url_bot + self.token + f"/{method}"
+
+
+    def _check(self, resp):
+        try:
+            result = _result(resp)
+        except (ServerError, NetworkError):
+            self.breaker.failure()
+            raise
+        except TelegramError:
+            self.breaker.success()
+            raise
+        self.breaker.success()
+        return result
+
+
+    def _observe(self, method, t0, error = None):
+        if error is None:
+            status = "ok"
+        elif error.error_code:
+            status = str(error.error_code)
+        else:
+            status = type(error).__name__
+        metrics.TELEGRAM_SECONDS.observe(time.perf_counter() - t0, method, status)
+
+
+    def _retry_delay(self, method, error, attempt):
+        # Returns the seconds to wait before retrying, or None to give up.
+        self._count(f"error_{type(error).__name__}")
+        if method not in IDEMPOTENT_METHODS or attempt >= self.retries:
+            return None
+        if isinstance(error, (RateLimitError, CircuitOpenError)):
+            delay = error.retry_after or self.retry_backoff_min
+        elif isinstance(error, (ServerError, NetworkError)):
+            # Full jitter keeps many clients from retrying in lockstep.
+            delay = random.uniform(0, min(self.retry_backoff_max, self.retry_backoff_min * 2 ** attempt))
+        else:
+            return None
+        if delay > self.retry_backoff_max:
+            return None
+        self._count("retries")
+        logger.debug(f"Retrying {method} in {delay:.2f}s after {error}.")
+        return delay
+
+
+
+
+class Telegram(_TelegramBase):
+
+    def __init__(self, token, **kwargs) -> None:
+        super().__init__(token, **kwargs)
+        self.client = httpx.Client(
+            headers={"user-agent": self.user_agent},
+            timeout=self.timeout,
+            limits=self.limits,
+            http2=self.http2,
+        )
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+    def close(self):
+        self.client.close()
 
 
     def __getattr__(self, __name: str) -> Any:
         @wraps(self.querymethod)
-        def wrapper(obj=None, files=None):
+        def wrapper(obj=None, files=None, timeout=None):
             if not files:
-                return self.query_json(__name, obj=obj)
+                return self.query_json(__name, obj=obj, timeout=timeout)
             else:
-                return self.query_form(__name, obj=obj, files=files)
+                return self.query_form(__name, obj=obj, files=files, timeout=timeout)
         return wrapper
 
 
-    def querymethod(self, obj: dict | None = None, files: dict | None = None):
+    def querymethod(self, obj: dict | None = None, files: dict | None = None, timeout: Timeout | None = None):
         pass
 
 
-    def query_json(self, method, obj=None):
-        url = self.url_bot + self.token + f"/{method}"
-        headers = {"user-agent": self.user_agent}
-        resp = httpx.post(url=url, headers=headers, json=obj, timeout=self.timeout)
-        obj = resp.json()
-        if not obj["ok"]:
-            raise Exception(f"ERRORCODE {obj['error_code']} {obj['description']}")
-        if "result" in obj:
-            return obj["result"]
+    def query(self, method, **kwargs):
+        attempt = 0
+        while True:
+            self._count("requests")
+            t0 = time.perf_counter()
+            try:
+                probe = self.breaker.allow()
+                try:
+                    try:
+                        resp = self.client.post(url=self._url(method), **kwargs)
+                    except httpx.RequestError as e:
+                        self.breaker.failure()
+                        raise NetworkError(None, f"{type(e).__name__} {e}") from e
+                    result = self._check(resp)
+                finally:
+                    if probe:
+                        self.breaker.release()
+                self._observe(method, t0)
+                return result
+            except TelegramError as e:
+                self._observe(method, t0, e)
+                delay = self._retry_delay(method, e, attempt)
+                if delay is None:
+                    raise
+            attempt += 1
+            time.sleep(delay)
 
 
-    def query_form(self, method, obj=None, files=None):
-        url = self.url_bot + self.token + f"/{method}"
-        headers = {"user-agent": self.user_agent}
-        resp = httpx.post(url=url, headers=headers, data=obj, files=files, timeout=self.timeout)
-        obj = resp.json()
-        if not obj["ok"]:
-            raise Exception(f"ERRORCODE {obj['error_code']} {obj['description']}")
-        if "result" in obj:
-            return obj["result"]
+    def query_json(self, method, obj=None, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        return self.query(method, json=obj, timeout=timeout)
+
+
+    def query_form(self, method, obj=None, files=None, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        return self.query(method, data=obj, files=files, timeout=timeout)
+
+
+
+
+class AsyncTelegram(_TelegramBase):
+
+    def __init__(self, token, **kwargs) -> None:
+        super().__init__(token, **kwargs)
+        self.client = httpx.AsyncClient(
+            headers={"user-agent": self.user_agent},
+            timeout=self.timeout,
+            limits=self.limits,
+            http2=self.http2,
+        )
+
+
+    async def __aenter__(self):
+        return self
+
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+    def __getattr__(self, __name: str) -> Any:
+        @wraps(self.querymethod)
+        async def wrapper(obj=None, files=None, timeout=None):
+            if not files:
+                return await self.query_json(__name, obj=obj, timeout=timeout)
+            else:
+                return await self.query_form(__name, obj=obj, files=files, timeout=timeout)
+        return wrapper
+
+
+    async def querymethod(self, obj: dict | None = None, files: dict | None = None, timeout: Timeout | None = None):
+        pass
+
+
+    async def query(self, method, **kwargs):
+        attempt = 0
+        while True:
+            self._count("requests")
+            t0 = time.perf_counter()
+            try:
+                probe = self.breaker.allow()
+                try:
+                    try:
+                        resp = await self.client.post(url=self._url(method), **kwargs)
+                    except httpx.RequestError as e:
+                        self.breaker.failure()
+                        raise NetworkError(None, f"{type(e).__name__} {e}") from e
+                    result = self._check(resp)
+                finally:
+                    if probe:
+                        self.breaker.release()
+                self._observe(method, t0)
+                return result
+            except TelegramError as e:
+                self._observe(method, t0, e)
+                delay = self._retry_delay(method, e, attempt)
+                if delay is None:
+                    raise
+            attempt += 1
+            await asyncio.sleep(delay)
+
+
+    async def query_json(self, method, obj=None, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        return await self.query(method, json=obj, timeout=timeout)
+
 
+    async def query_form(self, method, obj=None, files=None, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        return await self.query(method, data=obj, files=files, timeout=timeout)
 
@@ -0,0 +1,119 @@
+# -*- coding=utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+
+import json
+import sqlite3
+import zlib
+
+from threading import Lock
+
+from ._config import (
+    CONF_CLUSTER_QUEUE_BACKEND_SQLITE,
+    CONF_CLUSTER_PARTITIONS_DEFAULT,
+)
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key             TEXT PRIMARY KEY,
+    value           TEXT
+);
+CREATE TABLE IF NOT EXISTS updates (
+    seq             INTEGER PRIMARY KEY AUTOINCREMENT,
+    partition       INTEGER,
+    update_id       INTEGER UNIQUE,
+    session         TEXT,
+    body            TEXT
+);
+CREATE INDEX IF NOT EXISTS updates_partition_seq ON updates (partition, seq);
+"""
+
+META_OFFSET = "offset"
+
+
+def partition_of(key, partitions):
+    # Stable across processes, unlike `hash`, so the ingestor and every
+    # worker agree on who owns a session (or a user).
+    return zlib.crc32(str(key).encode("utf-8")) % partitions
+
+
+
+
+class SqliteUpdateQueue:
+
+    # Durable update log shared by one ingestor and the workers on the same
+    # machine. Updates are partitioned by `key`, the session unless the
+    # ingestor says otherwise, so everything with one key is only ever
+    # handled by one worker and in the order it was received. A worker
+    # commits by deleting what it handled, so a crash before the commit
+    # hands the same updates to the next run again.
+
+    def __init__(self, queue_file, partitions = CONF_CLUSTER_PARTITIONS_DEFAULT) -> None:
+        self.queue_file = queue_file
+        self.partitions = partitions
+        self.db_lock = Lock()
+        self.conn = sqlite3.connect(queue_file, isolation_level=None, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+
+    def get_offset(self):
+        with self.db_lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (META_OFFSET,)).fetchone()
+        return int(row[0]) if row else 0
+
+
+    def put(self, update, session_name, key = None):
+        # The update and the next `getUpdates` offset go in together, so
+        # Telegram is only told to drop updates that are safely queued. The
+        # offset never goes back; `value` is TEXT, which SQLite would order
+        # above any integer, so both sides are compared as integers.
+        partition = partition_of(session_name if key is None else key, self.partitions)
+        with self.db_lock:
+            with self.conn:
+                self.conn.execute("BEGIN IMMEDIATE")
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO updates (partition, update_id, session, body) VALUES (?, ?, ?, ?)",
+                    (partition, update["update_id"], session_name, json.dumps(update)),
+                )
+                self.conn.execute(
+                    "INSERT INTO meta (key, value) VALUES (?, ?) "
+                    "ON CONFLICT (key) DO UPDATE SET value = MAX(CAST(value AS INTEGER), CAST(excluded.value AS INTEGER))",
+                    (META_OFFSET, update["update_id"] + 1),
+                )
+        return partition
+
+
+    def fetch(self, partition, limit = 100):
+        with self.db_lock:
+            rows = self.conn.execute(
+                "SELECT seq, session, body FROM updates WHERE partition = ? ORDER BY seq LIMIT ?",
+                (partition, limit),
+            ).fetchall()
+        return [(seq, session_name, json.loads(body)) for seq, session_name, body in rows]
+
+
+    def commit(self, partition, seq):
+        with self.db_lock:
+            self.conn.execute("DELETE FROM updates WHERE partition = ? AND seq <= ?", (partition, seq))
+
+
+    def lag(self):
+        with self.db_lock:
+            return dict(self.conn.execute("SELECT partition, COUNT(*) FROM updates GROUP BY partition").fetchall())
+
+
+    def close(self):
+        with self.db_lock:
+            self.conn.close()
+
+
+def open_update_queue(backend, queue_file, **kwargs):
+    # Other brokers plug in here; SQLite is the stand-in that needs nothing
+    # but a local file.
+    if backend != CONF_CLUSTER_QUEUE_BACKEND_SQLITE:
+        raise ValueError(f"Unknown update queue backend {backend}.")
+    return SqliteUpdateQueue(queue_file, **kwargs)
@@ -0,0 +1,113 @@
+# -*- coding=utf-8 -*-
+
+import logging
+logger = logging.getLogger(__name__)
+
+import hmac
+import json
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+
+from ._config import (
+    CONF_WEBHOOK_BIND_DEFAULT,
+    CONF_WEBHOOK_PORT_DEFAULT,
+    CONF_WEBHOOK_PATH_DEFAULT,
+    CONF_WEBHOOK_WORKERS_DEFAULT,
+    CONF_WEBHOOK_SECRET_TOKEN_DEFAULT,
+    CONF_WEBHOOK_MAX_BODY_DEFAULT,
+)
+
+
+HEADER_SECRET_TOKEN = "X-Telegram-Bot-Api-Secret-Token"
+
+
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+
+    timeout = 10
+
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+    def _reply(self, code):
+        self.send_response(code)
+        self.send_header("content-length", "0")
+        self.end_headers()
+
+
+    def do_POST(self):
+        if self.path != self.server.path:
+            return self._reply(404)
+        if self.server.secret_token and not hmac.compare_digest(
+            self.headers.get(HEADER_SECRET_TOKEN, ""),
+            self.server.secret_token,
+        ):
+            logger.warning(f"Rejected update from {self.client_address[0]}: bad secret token.")
+            return self._reply(403)
+        try:
+            length = int(self.headers.get("content-length", 0))
+        except ValueError:
+            return self._reply(400)
+        # Never read more than the cap into memory; the rest of an oversized
+        # body is dropped with the connection.
+        if length > self.server.max_body:
+            logger.warning(f"Rejected update from {self.client_address[0]}: {length} bytes.")
+            self.close_connection = True
+            return self._reply(413)
+        try:
+            update = json.loads(self.rfile.read(max(length, 0)))
+            assert isinstance(update, dict) and "update_id" in update
+        except Exception as e:
+            logger.debug(e)
+            return self._reply(400)
+        # Only hand the update off here; the handler runs on the dispatch
+        # side so Telegram gets its acknowledgement straight away.
+        self.server.dispatch(update)
+        self._reply(200)
+
+
+
+
+class WebhookServer(HTTPServer):
+
+    def __init__(
+        self,
+        dispatch,
+        bind = CONF_WEBHOOK_BIND_DEFAULT,
+        port = CONF_WEBHOOK_PORT_DEFAULT,
+        path = CONF_WEBHOOK_PATH_DEFAULT,
+        workers = CONF_WEBHOOK_WORKERS_DEFAULT,
+        secret_token = CONF_WEBHOOK_SECRET_TOKEN_DEFAULT,
+        max_body = CONF_WEBHOOK_MAX_BODY_DEFAULT,
+    ) -> None:
+        self.dispatch = dispatch
+        self.path = path
+        self.secret_token = secret_token
+        self.max_body = max_body
+        self.workers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Webhook #")
+        super().__init__((bind, port), WebhookRequestHandler)
+        if not secret_token:
+            logger.warning(f"Webhook secret token is not set. Accepting any update.")
+
+
+    def process_request(self, request, client_address):
+        self.workers.submit(self.process_request_worker, request, client_address)
+
+
+    def process_request_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+    def server_close(self):
+        super().server_close()
+        self.workers.shutdown(wait=False)
+
@@ -0,0 +1,101 @@
+# -*- coding=utf-8 -*-
+
+import asyncio
+import random
+import time
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor, wait
+from threading import Event, Lock
+
+from ingressfsbot.ingress import IngressQueue
+from ingressfsbot.keyed import KeyedExecutor
+from ingressfsbot.main_thread import get_submit, make_dispatch
+from ingressfsbot.router import Router
+
+from ingressfsbot._config import (
+    CONF_INGRESS_ORDER_BY_USER,
+    CONF_INGRESS_POLICY_SHED,
+)
+
+
+def make_update(update_id, uid, text = "/passcode status"):
+    return {
+        "update_id": update_id,
+        "message": {"text": text, "from": {"id": uid}, "chat": {"id": uid}},
+    }
+
+
+
+
+class TestDispatch(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = Lock()
+        self.handled = []
+        self.router = Router()
+        self.router.register("/passcode", self.handle)
+        self.pool = ThreadPoolExecutor(max_workers=8)
+        self.keyed = KeyedExecutor(self.pool)
+        self.released = Event()
+        self.released.set()
+        self.throttled = []
+
+
+    def tearDown(self):
+        self.released.set()
+        self.pool.shutdown()
+
+
+    def handle(self, tg, update):
+        self.released.wait()
+        time.sleep(random.random() / 1000)
+        with self.lock:
+            self.handled.append((update["message"]["from"]["id"], update["update_id"]))
+
+
+    def test_each_user_in_order(self):
+        futures = []
+        for update_id in range(200):
+            update = make_update(update_id, update_id % 3)
+            route = self.router.route(update)
+            futures.append(get_submit(self.router, route, None, update, self.pool, self.keyed, CONF_INGRESS_ORDER_BY_USER)())
+        wait(futures)
+        self.assertEqual(len(self.handled), 200)
+        for uid in range(3):
+            update_ids = [update_id for _uid, update_id in self.handled if _uid == uid]
+            self.assertEqual(update_ids, sorted(update_ids))
+
+
+    def test_flood_is_shed_on_the_event_loop(self):
+        # Handlers are held, so admitted updates stay queued; one user past
+        # their burst is throttled, everyone past `capacity` is shed.
+        self.released.clear()
+        ingress = IngressQueue(capacity=10, policy=CONF_INGRESS_POLICY_SHED, user_rate=0.01, user_burst=5)
+        dispatch = make_dispatch(
+            self.router, None, self.pool, self.keyed, ingress, CONF_INGRESS_ORDER_BY_USER,
+            lambda tg, message, wait: self.throttled.append(message["from"]["id"]),
+        )
+
+        async def flood():
+            for update_id in range(100):
+                dispatch(make_update(update_id, 1))
+            for update_id in range(100, 120):
+                dispatch(make_update(update_id, update_id))
+
+        t0 = time.monotonic()
+        asyncio.run(flood())
+        self.assertLess(time.monotonic() - t0, 1)
+        stats = ingress.get_stats()
+        self.assertEqual(stats.throttled, 95)
+        self.assertEqual(self.throttled, [1])
+        self.assertEqual(stats.admitted, 10)
+        self.assertEqual(stats.shed, 15)
+        self.released.set()
+        while ingress.get_stats().depth:
+            time.sleep(0.01)
+        self.assertEqual(len(self.handled), 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
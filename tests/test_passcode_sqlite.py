@@ -0,0 +1,54 @@
+# -*- coding=utf-8 -*-
+
+import os
+import random
+import tempfile
+import unittest
+
+from ingressfsbot import passcode_data
+from ingressfsbot import passcode_sqlite
+from ingressfsbot.passcode_data import PasscodeData
+
+
+TABLES = ("meta", "users", "reports", "votes", "trusted")
+
+
+class TestMigrate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.json_file = os.path.join(self.tmp.name, "passcode_data.json")
+        self.db_file = os.path.join(self.tmp.name, "passcode_data.db")
+        rng = random.Random(0)
+        data = PasscodeData()
+        for uid in range(20):
+            data.add_user({"id": uid, "username": f"u{uid}"})
+        for _ in range(300):
+            data.add_report({"id": rng.randrange(20)}, str(rng.randint(1, 11)), rng.choice("AB"), rng.choice("ab"))
+        data.add_trusted_user({"id": 3})
+        passcode_data.dump(self.json_file, data)
+
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+
+    def snapshot(self):
+        conn = passcode_sqlite.connect(self.db_file)
+        try:
+            counts = {table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] for table in TABLES}
+            return counts, passcode_sqlite.SqlitePasscodeData(conn).get_trustable()
+        finally:
+            conn.close()
+
+
+    def test_migrate_twice(self):
+        passcode_sqlite.migrate(self.json_file, self.db_file)
+        first = self.snapshot()
+        self.assertEqual(first[0]["reports"], 300)
+        passcode_sqlite.migrate(self.json_file, self.db_file)
+        self.assertEqual(self.snapshot(), first)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+# -*- coding=utf-8 -*-
+
+import os
+import tempfile
+import unittest
+
+from ingressfsbot import passcode_storage
+
+from ingressfsbot._config import (
+    CONF_PASSCODE_BACKEND_JSON,
+    CONF_PASSCODE_BACKEND_JOURNAL,
+)
+
+
+class TestSerialize(unittest.TestCase):
+
+    def test_payload_is_a_snapshot(self):
+        # The payload is only turned into text after the data lock is gone;
+        # writes made in between must not leak into it.
+        for backend in (CONF_PASSCODE_BACKEND_JSON, CONF_PASSCODE_BACKEND_JOURNAL):
+            with tempfile.TemporaryDirectory() as tmp:
+                data_file = os.path.join(tmp, "passcode_data.json")
+                storage = passcode_storage.open_storage(backend, data_file)
+                data = storage.load()
+                data.add_user({"id": 1, "username": "a"})
+                data.add_report({"id": 1}, "1", "A", "a")
+                data.add_trusted_user({"id": 1})
+                payload = storage.serialize(data, force=True) if backend == CONF_PASSCODE_BACKEND_JOURNAL else storage.serialize(data)
+                data.add_user({"id": 2, "username": "b"})
+                data.add_report({"id": 1}, "1", "B", "b")
+                data.add_report({"id": 1}, "2", "C", "c")
+                data.add_trusted_user({"id": 2})
+                storage.write(payload)
+                storage.close()
+
+                # The plain JSON file, without replaying a journal.
+                loaded = passcode_storage.JsonStorage(data_file).load()
+                self.assertEqual(list(loaded.user_info), ["1"], backend)
+                self.assertEqual(loaded.user_trusted, ["1"], backend)
+                self.assertEqual({index: [report.name for report in history] for index, history in loaded.user_reports["1"].items()}, {"1": ["A"]}, backend)
+
+
+if __name__ == "__main__":
+    unittest.main()
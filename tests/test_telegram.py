@@ -0,0 +1,54 @@
+# -*- coding=utf-8 -*-
+
+import time
+import unittest
+
+import httpx
+
+from ingressfsbot import telegram
+from ingressfsbot.telegram import CIRCUIT_CLOSED, CIRCUIT_HALF_OPEN, CIRCUIT_OPEN, ServerError, Telegram
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_probe_failure_is_released(self):
+        # Whatever a half-open probe ends in, the next one still gets through.
+        responses = [
+            lambda: httpx.Response(200, json=[1]),
+            lambda: httpx.Response(200, json={"result": 1}),
+            lambda: (_ for _ in ()).throw(httpx.DecodingError("broken")),
+            lambda: httpx.Response(200, json={"ok": True, "result": 5}),
+        ]
+        tg = Telegram("token", retries=0, breaker_threshold=1, breaker_reset=0.01)
+        tg.client = httpx.Client(transport=httpx.MockTransport(lambda request: responses.pop(0)()))
+        for error in (ServerError, ServerError, telegram.NetworkError):
+            time.sleep(0.02)
+            with self.assertRaises(error):
+                tg.query("getMe")
+            self.assertEqual(tg.breaker.state, CIRCUIT_OPEN)
+            self.assertFalse(tg.breaker.probing)
+        time.sleep(0.02)
+        self.assertEqual(tg.query("getMe"), 5)
+        self.assertEqual(tg.breaker.state, CIRCUIT_CLOSED)
+
+
+    def test_local_error_is_not_an_outage(self):
+        # A bug on our side neither counts as a failure nor keeps the probe.
+        def handler(request):
+            raise KeyError("bug")
+
+        tg = Telegram("token", retries=0, breaker_threshold=1, breaker_reset=0.01)
+        tg.client = httpx.Client(transport=httpx.MockTransport(handler))
+        with self.assertRaises(KeyError):
+            tg.query("getMe")
+        self.assertEqual(tg.breaker.state, CIRCUIT_CLOSED)
+        tg.breaker.failure()
+        time.sleep(0.02)
+        with self.assertRaises(KeyError):
+            tg.query("getMe")
+        self.assertEqual(tg.breaker.state, CIRCUIT_HALF_OPEN)
+        self.assertFalse(tg.breaker.probing)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+# -*- coding=utf-8 -*-
+
+import os
+import tempfile
+import unittest
+
+from ingressfsbot.update_queue import SqliteUpdateQueue
+
+
+class TestSqliteUpdateQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.queue = SqliteUpdateQueue(os.path.join(self.tmp.name, "queue.db"), partitions=2)
+
+
+    def tearDown(self):
+        self.queue.close()
+        self.tmp.cleanup()
+
+
+    def test_offset_never_goes_back(self):
+        self.queue.put({"update_id": 100}, "default")
+        self.assertEqual(self.queue.get_offset(), 101)
+        # A late put, say from a webhook worker, must not rewind the offset.
+        self.queue.put({"update_id": 5}, "default")
+        self.assertEqual(self.queue.get_offset(), 101)
+        self.queue.put({"update_id": 1000}, "default")
+        self.assertEqual(self.queue.get_offset(), 1001)
+
+
+    def test_partition_by_key(self):
+        partitions = {self.queue.put({"update_id": update_id}, "default", key=7) for update_id in range(10)}
+        self.assertEqual(len(partitions), 1)
+        partition, = partitions
+        rows = self.queue.fetch(partition)
+        self.assertEqual([update["update_id"] for _, _, update in rows], list(range(10)))
+        self.queue.commit(partition, rows[-1][0])
+        self.assertEqual(self.queue.fetch(partition), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+# -*- coding=utf-8 -*-
+
+import asyncio
+import http.client
+import json
+import threading
+import unittest
+
+from ingressfsbot.main_async import serve_webhook
+from ingressfsbot.webhook import HEADER_SECRET_TOKEN, WebhookServer
+
+
+SECRET_TOKEN = "secret"
+MAX_BODY = 1024
+
+
+class TestWebhookServer(unittest.TestCase):
+
+    def setUp(self):
+        self.updates = []
+        self.server = WebhookServer(
+            self.updates.append,
+            port=0,
+            path="/hook",
+            workers=2,
+            secret_token=SECRET_TOKEN,
+            max_body=MAX_BODY,
+        )
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+    def post(self, body, path = "/hook", secret_token = SECRET_TOKEN, headers = None):
+        conn = http.client.HTTPConnection(*self.server.server_address, timeout=5)
+        try:
+            conn.request("POST", path, body, {HEADER_SECRET_TOKEN: secret_token, **(headers or {})})
+            return conn.getresponse().status
+        finally:
+            conn.close()
+
+
+    def test_update_is_dispatched(self):
+        update = {"update_id": 1, "message": {"text": "/passcode"}}
+        self.assertEqual(self.post(json.dumps(update)), 200)
+        self.assertEqual(self.updates, [update])
+
+
+    def test_rejected(self):
+        self.assertEqual(self.post(json.dumps({"update_id": 1}), path="/other"), 404)
+        self.assertEqual(self.post(json.dumps({"update_id": 1}), secret_token="wrong"), 403)
+        self.assertEqual(self.post("not json"), 400)
+        self.assertEqual(self.post(json.dumps([1])), 400)
+        self.assertEqual(self.updates, [])
+
+
+    def test_oversized_body(self):
+        update = {"update_id": 1, "message": {"text": "x" * MAX_BODY}}
+        self.assertEqual(self.post(json.dumps(update)), 413)
+        # Only the header is trusted, the body is never read.
+        self.assertEqual(self.post("{}", headers={"content-length": str(1 << 40)}), 413)
+        self.assertEqual(self.updates, [])
+
+
+
+
+class TestAsyncWebhook(unittest.TestCase):
+
+    def test_cancel_stops_the_server(self):
+        updates = []
+        server = WebhookServer(updates.append, port=0, workers=1)
+        address = server.server_address
+
+        def post():
+            conn = http.client.HTTPConnection(*address, timeout=5)
+            try:
+                conn.request("POST", "/", json.dumps({"update_id": 1}))
+                return conn.getresponse().status
+            finally:
+                conn.close()
+
+        async def run():
+            task = asyncio.create_task(serve_webhook(server))
+            status = await asyncio.to_thread(post)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await asyncio.wait_for(task, 5)
+            return status
+
+        self.assertEqual(asyncio.run(run()), 200)
+        self.assertEqual(updates, [{"update_id": 1}])
+        with self.assertRaises(OSError):
+            post()
+
+
+if __name__ == "__main__":
+    unittest.main()